@@ -22,8 +22,76 @@
 #  limitations under the License.
 ###############################################################################
 
+import threading
+
+from .cache_util import getConfig
+from .models.larger_image_item import FinishedJobStatuses, \
+    LargerImageItem, tileSourceCache
+from .models.tile_index import TileIndex
+from .models.tile_overlay import TileOverlay
 from .rest import TilesItemResource
-from girder import plugin
+from .rest.tiles import invalidateColormap
+from girder import events, plugin
+from girder.api.rest import getCurrentUser
+from large_image.exceptions import TileGeneralException
+
+# (itemId, fileId) pairs whose tile index job was scheduled by this process
+_indexScheduled = set()
+_indexScheduledLock = threading.Lock()
+
+
+def _invalidateOnSave(event):
+    item = event.info
+    if item.get('largeImageStyles'):
+        LargerImageItem().removeStaleStyles(item)
+    if 'largeImage' not in item:
+        LargerImageItem.invalidateTileSources(item)
+        if 'largeImageHistogram' in item:
+            LargerImageItem().update({'_id': item['_id']}, {
+                '$unset': {'largeImageHistogram': True}})
+        return
+    itemId = str(item['_id'])
+    record = LargerImageItem.largeImageRecord(item)
+    tileSourceCache.removeIf(lambda k: k[0] == itemId and k[3] != record)
+
+
+def _invalidateOnRemove(event):
+    LargerImageItem.invalidateTileSources(event.info)
+    TileIndex().removeForItem(event.info)
+    TileOverlay().removeForItem(event.info)
+
+
+def _scheduleIndexOnSave(event):
+    item = event.info
+    largeImage = item.get('largeImage', {})
+    if (not largeImage.get('fileId') or not largeImage.get('sourceName') or
+            largeImage.get('expected') or
+            str(getConfig('index_on_import', True)).lower() in (
+                'false', '0', 'no')):
+        return
+    key = (str(item['_id']), str(largeImage['fileId']))
+    with _indexScheduledLock:
+        if key in _indexScheduled:
+            return
+        _indexScheduled.add(key)
+    if TileIndex().getLevels(item, 0):
+        return
+    # Other images are indexed when a level's occupancy is requested; the
+    # index mostly helps label images, whose tiles are often empty
+    try:
+        tileSource = LargerImageItem._loadTileSource(item)
+    except TileGeneralException:
+        return
+    if not hasattr(tileSource, 'isLabelImage') or not tileSource.isLabelImage():
+        return
+    LargerImageItem().scheduleTileIndex(item, getCurrentUser())
+
+
+def _continueImportOnJobUpdate(event):
+    job = event.info.get('job') or {}
+    importId = job.get('meta', {}).get('importId')
+    if importId and job.get('status') in FinishedJobStatuses:
+        LargerImageItem().startImportConversions(importId)
 
 
 class LargerImagePlugin(plugin.GirderPlugin):
@@ -31,3 +99,13 @@ class LargerImagePlugin(plugin.GirderPlugin):
     CLIENT_SOURCE_PATH = 'web_client'
     def load(self, info):
         TilesItemResource(info['apiRoot'])
+        events.bind('model.item.save.after', 'larger_image', _invalidateOnSave)
+        events.bind('model.item.remove', 'larger_image', _invalidateOnRemove)
+        events.bind('model.item.save.after', 'larger_image_index',
+                    _scheduleIndexOnSave)
+        events.bind('jobs.job.update.after', 'larger_image',
+                    _continueImportOnJobUpdate)
+        events.bind('model.colormap.save.after', 'larger_image',
+                    invalidateColormap)
+        events.bind('model.colormap.remove', 'larger_image',
+                    invalidateColormap)
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from girder import config
+
+# All named caches, so that they can be reported and cleared together.
+_caches = {}
+
+
+def getConfig(key, default=None):
+    """
+    Get a value from the ``[larger_image]`` section of the Girder config.
+
+    :param key: the name of the value.
+    :param default: the value to return if the key is not set.
+    :returns: the configured value or the default.
+    """
+    return config.getConfig().get('larger_image', {}).get(key, default)
+
+
+class LruCache(object):
+    """
+    A thread-safe least-recently-used cache.
+
+    Entries are discarded when there are more than maxSize of them or, if
+    maxAge is set, when they have not been used for that many seconds.
+
+    :param maxSize: the maximum number of entries to keep.
+    :param maxAge: the maximum idle time of an entry in seconds, or None to
+        keep entries until they are pushed out by newer ones.
+    """
+    def __init__(self, maxSize=100, maxAge=None):
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            self._expire()
+            return key in self._entries
+
+    def _expire(self):
+        if self.maxAge is None:
+            return
+        oldest = time.time() - self.maxAge
+        while self._entries:
+            key, (value, lastUsed) = next(iter(self._entries.items()))
+            if lastUsed >= oldest:
+                break
+            del self._entries[key]
+
+    def get(self, key, default=None):
+        """
+        Get an entry from the cache, marking it as recently used.
+
+        :param key: the key of the entry.
+        :param default: the value to return if the key is not cached.
+        :returns: the cached value or the default.
+        """
+        with self._lock:
+            self._expire()
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value = self._entries.pop(key)[0]
+            self._entries[key] = (value, time.time())
+            return value
+
+    def put(self, key, value):
+        """
+        Add or replace an entry in the cache.
+
+        :param key: the key of the entry.
+        :param value: the value to store.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+            self._expire()
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """
+        Remove an entry from the cache.
+
+        :param key: the key of the entry.
+        :param default: the value to return if the key is not cached.
+        :returns: the value that was cached or the default.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            return default if entry is None else entry[0]
+
+    def removeIf(self, predicate):
+        """
+        Remove all entries whose keys match a predicate.
+
+        :param predicate: a function that takes a key and returns True if the
+            entry should be removed.
+        :returns: the number of entries removed.
+        """
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        Report the usage of the cache.
+
+        :returns: a dictionary with hits, misses, size, and maxSize.
+        """
+        with self._lock:
+            self._expire()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxSize': self.maxSize,
+            }
+
+
+class MemoryTileCache(object):
+    """
+    Keep encoded tiles in process memory.
+
+    :param maxSize: the maximum number of tiles to keep.
+    :param maxAge: the maximum idle time of a tile in seconds, or None.
+    """
+    def __init__(self, maxSize=1000, maxAge=None):
+        self._cache = LruCache(maxSize=maxSize, maxAge=maxAge)
+
+    def get(self, key):
+        """
+        Get an encoded tile.
+
+        :param key: the tile key.
+        :returns: a tuple of the tile data and mime type, or None.
+        """
+        return self._cache.get(key)
+
+    def set(self, key, data, mime):
+        """
+        Store an encoded tile.
+
+        :param key: the tile key.
+        :param data: the encoded tile.
+        :param mime: the mime type of the tile.
+        """
+        self._cache.put(key, (data, mime))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class _SerializedTileCache(object):
+    """
+    Common code for tile caches that store tiles as bytes.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _hashKey(self, key):
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _pack(self, data, mime):
+        return mime.encode('utf8') + b'\0' + data
+
+    def _unpack(self, value):
+        if value is None:
+            self._count(False)
+            return None
+        self._count(True)
+        mime, data = value.split(b'\0', 1)
+        return data, mime.decode('utf8')
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class DiskTileCache(_SerializedTileCache):
+    """
+    Keep encoded tiles in files in a local directory.  When there are more
+    than maxSize files, the least recently used tenth of them are removed.
+
+    :param path: the directory for the cache.  If None, a directory in the
+        system temporary directory is used.
+    :param maxSize: the maximum number of tiles to keep.
+    """
+    def __init__(self, path=None, maxSize=100000):
+        super(DiskTileCache, self).__init__()
+        self.path = path or os.path.join(tempfile.gettempdir(),
+                                         'larger_image_tiles')
+        self.maxSize = maxSize
+        os.makedirs(self.path, exist_ok=True)
+        self._size = len(self._files())
+
+    def _files(self):
+        files = []
+        for dirpath, _, filenames in os.walk(self.path):
+            files.extend(os.path.join(dirpath, name) for name in filenames
+                         if not name.endswith('.tmp'))
+        return files
+
+    def _filePath(self, key):
+        hashed = self._hashKey(key)
+        return os.path.join(self.path, hashed[:2], hashed)
+
+    def get(self, key):
+        path = self._filePath(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            os.utime(path)
+        except OSError:
+            value = None
+        return self._unpack(value)
+
+    def set(self, key, data, mime):
+        path = self._filePath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        existed = os.path.exists(path)
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self._pack(data, mime))
+        os.replace(tempPath, path)
+        with self._lock:
+            if not existed:
+                self._size += 1
+            prune = self._size > self.maxSize
+        if prune:
+            self._prune()
+
+    def _prune(self):
+        files = []
+        for path in self._files():
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        files.sort()
+        remove = len(files) - int(self.maxSize * 0.9)
+        for _, path in files[:max(0, remove)]:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = len(files) - max(0, remove)
+
+    def clear(self):
+        for path in self._files():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        with self._lock:
+            self._size = 0
+            self.hits = self.misses = 0
+
+    def stats(self):
+        result = super(DiskTileCache, self).stats()
+        result.update({'size': self._size, 'maxSize': self.maxSize})
+        return result
+
+
+class MemcachedTileCache(_SerializedTileCache):
+    """
+    Keep encoded tiles in memcached.
+
+    :param servers: a list of memcached server addresses.  Ignored if a
+        client is specified.
+    :param client: an object with get, set, and flush_all methods like a
+        pylibmc or pymemcache client.  If None, a pylibmc client is created.
+    :param maxAge: the expiry time of tiles in seconds; 0 for no expiry.
+    """
+    def __init__(self, servers=None, client=None, maxAge=0):
+        super(MemcachedTileCache, self).__init__()
+        if client is None:
+            import pylibmc
+
+            client = pylibmc.Client(servers or ['127.0.0.1'], binary=True)
+        self.client = client
+        self.maxAge = maxAge
+
+    def get(self, key):
+        try:
+            value = self.client.get(self._hashKey(key))
+        except Exception:
+            value = None
+        return self._unpack(value)
+
+    def set(self, key, data, mime):
+        try:
+            self.client.set(self._hashKey(key), self._pack(data, mime),
+                            self.maxAge)
+        except Exception:
+            # A tile that could not be cached is still a valid tile
+            pass
+
+    def clear(self):
+        self.client.flush_all()
+        with self._lock:
+            self.hits = self.misses = 0
+
+
+def createTileCache(backend=None):
+    """
+    Create a tile cache from the ``[larger_image]`` Girder config.  The
+    ``tile_cache_backend`` value selects 'memory' (the default), 'disk',
+    'memcached', or 'none'.
+
+    :param backend: the backend to use instead of the configured one.
+    :returns: a tile cache, or None if tile caching is disabled.
+    """
+    backend = backend or getConfig('tile_cache_backend', 'memory')
+    if backend == 'memory':
+        return MemoryTileCache(
+            maxSize=int(getConfig('tile_cache_size', 1000)))
+    if backend == 'disk':
+        return DiskTileCache(
+            path=getConfig('tile_cache_path'),
+            maxSize=int(getConfig('tile_cache_size', 100000)))
+    if backend == 'memcached':
+        servers = getConfig('tile_cache_servers', '127.0.0.1')
+        if isinstance(servers, str):
+            servers = [server.strip() for server in servers.split(',')]
+        return MemcachedTileCache(servers=servers)
+    return None
+
+
+def registerCache(name, cache):
+    """
+    Register a named cache so it is included in reports and clears.
+
+    :param name: a unique name for the cache.
+    :param cache: an object with stats and clear methods.
+    :returns: the cache.
+    """
+    _caches[name] = cache
+    return cache
+
+
+def getCacheStats():
+    """
+    Report the usage of all registered caches.
+
+    :returns: a dictionary of cache names to cache statistics.
+    """
+    result = {}
+    for name, cache in _caches.items():
+        stats = cache.stats()
+        if stats.get('hits') or stats.get('misses'):
+            stats['hitRate'] = float(stats['hits']) / (
+                stats['hits'] + stats['misses'])
+        result[name] = stats
+    return result
+
+
+def clearCaches():
+    """
+    Clear all registered caches.
+    """
+    for cache in _caches.values():
+        cache.clear()
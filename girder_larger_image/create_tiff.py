@@ -21,17 +21,89 @@
 #  limitations under the License.
 ###############################################################################
 
+# Conversions with the default 'mean' reducer run in the large_image worker
+# task, which has its own converter, unless the local_conversion setting is
+# true.  create_tiff is used by the Girder local conversion job for those
+# conversions and for the label-preserving reducers that the task doesn't
+# support.
+
+import collections
+import math
+import multiprocessing
 import os
+import re
+import shutil
 import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+# tifffile compression names for the vips compression names
+TIFFFILE_COMPRESSION = {
+    'none': None,
+    'jpeg': 'jpeg',
+    'deflate': 'zlib',
+    'packbits': 'packbits',
+    'lzw': 'lzw',
+}
+
+
+def print_progress(current, total):
+    """
+    The default progress reporter.  Each line is flushed so that a job
+    runner watching stdout sees it immediately.
+    """
+    print('Progress: %d/%d' % (current, total))
+    sys.stdout.flush()
+
+
+def create_tiff(in_path, compression, quality, tile_size, out_path,
+                concurrency=None, progress=print_progress, use_vips=None,
+                reducer='mean'):
+    """
+    Convert an image to a tiled pyramidal TIFF.
 
+    :param in_path: the path of the input image.
+    :param compression: one of 'none', 'jpeg', 'deflate', 'packbits', or
+        'lzw'.
+    :param quality: the JPEG quality.
+    :param tile_size: the width and height of the output tiles.
+    :param out_path: the path of the output TIFF.
+    :param concurrency: the number of threads (vips) or processes used for
+        the conversion.  None uses the number of CPUs.
+    :param progress: a function called with (current, total) as the
+        conversion proceeds, or None.
+    :param use_vips: True to require vips, False to use the in-process
+        converter, or None to use vips when it is installed and supports the
+        reducer.
+    :param reducer: how each lower resolution level is computed from the
+        level above it; one of the keys of REDUCERS.  Use 'mode' for label
+        images and 'or' for one-hot encoded label images, since averaging
+        produces labels that don't exist.
+    """
+    if reducer not in REDUCERS:
+        raise ValueError('Unknown reducer: %s' % reducer)
+    if use_vips is None:
+        use_vips = (shutil.which('vips') is not None and
+                    reducer in VIPS_REGION_SHRINK)
+    if use_vips:
+        _vips_tiffsave(in_path, compression, quality, tile_size, out_path,
+                       concurrency, progress, reducer)
+    else:
+        _python_tiffsave(in_path, compression, quality, tile_size, out_path,
+                         concurrency, progress, reducer)
 
-def create_tiff(in_path, compression, quality, tile_size, out_path):
-    convert_command = (
-        'vips',
-        # Additional vips options can be added to aid debugging.  For instance,
-        #   '--vips-concurrency', '1',
-        #   '--vips-progress',
-        # can show how vips is processing a file.
+
+def _vips_tiffsave(in_path, compression, quality, tile_size, out_path,
+                   concurrency, progress, reducer='mean'):
+    convert_command = ['vips']
+    if concurrency:
+        convert_command += ['--vips-concurrency', str(int(concurrency))]
+    if progress:
+        convert_command += ['--vips-progress']
+    convert_command += [
         'tiffsave',
         in_path,
         out_path,
@@ -42,7 +114,9 @@ def create_tiff(in_path, compression, quality, tile_size, out_path):
         '--tile-height', str(tile_size),
         '--pyramid',
         '--bigtiff'
-    )
+    ]
+    if reducer != 'mean':
+        convert_command += ['--region-shrink', VIPS_REGION_SHRINK[reducer]]
 
     try:
         import six.moves
@@ -51,29 +125,279 @@ def create_tiff(in_path, compression, quality, tile_size, out_path):
     except ImportError:
         pass
     proc = subprocess.Popen(convert_command, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
-    out, err = proc.communicate()
+                            stderr=subprocess.STDOUT)
+    # vips rewrites its progress line with carriage returns, so split on
+    # those as well as newlines.  Only the tail of the output is kept.
+    lines = collections.deque(maxlen=20)
+    percent = None
+    partial = b''
+    while True:
+        chunk = proc.stdout.read1(4096)
+        if not chunk:
+            break
+        parts = re.split(b'[\r\n]', partial + chunk)
+        partial = parts.pop()
+        for line in parts:
+            line = line.decode('utf8', 'replace').strip()
+            match = re.search(r'(\d+)% complete', line)
+            if match:
+                if progress and int(match.group(1)) != percent:
+                    percent = int(match.group(1))
+                    progress(percent, 100)
+            elif line:
+                lines.append(line)
+    if partial.strip():
+        lines.append(partial.decode('utf8', 'replace').strip())
+    proc.wait()
 
-    if out.strip():
-        print('stdout: ' + out)
-    if err.strip():
-        print('stderr: ' + err)
+    if lines:
+        print('output: ' + '\n'.join(lines))
     if proc.returncode:
         raise Exception('VIPS command failed (rc=%d): %s' % (
             proc.returncode, ' '.join(convert_command)))
 
 
-try:
-    # Define Girder Worker globals for the style checker
-    _tempdir = _tempdir   # noqa
-    in_path = in_path   # noqa
-    compression = compression   # noqa
-    quality = quality   # noqa
-    tile_size = tile_size   # noqa
-    out_filename = out_filename  # noqa
+# Per worker process state for the in-process converter
+_worker = {}
+
+
+def _init_worker(in_path):
+    import large_image
+
+    _worker['source'] = large_image.getTileSource(in_path)
+    _worker['maps'] = {}
+
+
+def _level_map(path, shape, dtype):
+    maps = _worker.setdefault('maps', {})
+    if path not in maps:
+        # Only one level is reduced at a time
+        maps.clear()
+        maps[path] = numpy.memmap(path, dtype=dtype, mode='r', shape=shape)
+    return maps[path]
+
+
+def _quads(block, tile_size):
+    """
+    Rearrange a block so that the four pixels that become each output pixel
+    are along the last axis.
+
+    :param tile_size: the output size, either a number for square tiles or
+        a (height, width) tuple.
+    :returns: an array of shape (height, width, bands, 4).
+    """
+    height, width = ((tile_size, tile_size) if numpy.isscalar(tile_size)
+                     else tile_size)
+    bands = block.shape[2]
+    return block.reshape(height, 2, width, 2, bands).transpose(
+        0, 2, 4, 1, 3).reshape(height, width, bands, 4)
+
+
+def _reduce_mean(block, tile_size):
+    reduced = _quads(block, tile_size).mean(axis=3)
+    if block.dtype.kind in 'ui':
+        reduced = reduced.round()
+    return reduced.astype(block.dtype)
+
+
+def _reduce_mode(block, tile_size):
+    # The most common of the four values.  Ties go to a nonzero label, then
+    # to the smaller label, so thin labeled structures survive.
+    quads = numpy.sort(_quads(block, tile_size), axis=3)
+    counts = (quads[..., :, numpy.newaxis] ==
+              quads[..., numpy.newaxis, :]).sum(axis=4)
+    score = counts * 2 + (quads != 0)
+    choice = score.argmax(axis=3)[..., numpy.newaxis]
+    return numpy.take_along_axis(quads, choice, axis=3)[..., 0]
+
+
+def _reduce_or(block, tile_size):
+    # One-hot labels: a class is present if any of the four pixels has it
+    return numpy.bitwise_or.reduce(_quads(block, tile_size), axis=3)
+
+
+def _reduce_max(block, tile_size):
+    return _quads(block, tile_size).max(axis=3)
+
+
+def _reduce_min(block, tile_size):
+    return _quads(block, tile_size).min(axis=3)
+
+
+def _reduce_nearest(block, tile_size):
+    return block[::2, ::2]
+
+
+# Functions that reduce a (2 * tile_size, 2 * tile_size, bands) block to a
+# (tile_size, tile_size, bands) tile.  tile_size may also be a (height,
+# width) tuple for tiles that aren't square.  All but 'mean' only produce values
+# that are present in the block, so they are safe for label images.
+REDUCERS = {
+    'mean': _reduce_mean,
+    'mode': _reduce_mode,
+    'or': _reduce_or,
+    'max': _reduce_max,
+    'min': _reduce_min,
+    'nearest': _reduce_nearest,
+}
+
+# The vips tiffsave --region-shrink values for the reducers vips supports
+VIPS_REGION_SHRINK = {
+    'mean': 'mean',
+    'mode': 'mode',
+    'max': 'max',
+    'min': 'min',
+    'nearest': 'nearest',
+}
+
+
+def _read_region(left, top, size, bands, dtype):
+    from large_image.constants import TILE_FORMAT_NUMPY
+
+    array, _ = _worker['source'].getRegion(
+        region=dict(left=left, top=top, width=size, height=size),
+        format=TILE_FORMAT_NUMPY)
+    if array.ndim == 2:
+        array = array[:, :, numpy.newaxis]
+    return array[:, :, :bands].astype(dtype, copy=False)
+
+
+def _pad(block, size):
+    if block.shape[:2] == (size, size):
+        return block
+    return numpy.pad(block, (
+        (0, size - block.shape[0]), (0, size - block.shape[1]), (0, 0)),
+        mode='edge')
+
+
+def _read_base_tile(task):
+    x, y, tile_size, bands, dtype = task
+    return _pad(_read_region(x * tile_size, y * tile_size, tile_size, bands,
+                             dtype), tile_size)
+
+
+def _reduce_tile(task):
+    x, y, tile_size, bands, dtype, previous, reducer = task
+    size = 2 * tile_size
+    if previous is None:
+        # The first reduced level is read from the source, so the full
+        # resolution level never needs to be stored
+        block = _read_region(x * size, y * size, size, bands, dtype)
+    else:
+        level = _level_map(previous[0], previous[1], dtype)
+        block = numpy.asarray(level[y * size:(y + 1) * size,
+                                    x * size:(x + 1) * size])
+    return REDUCERS[reducer](_pad(block, size), tile_size)
+
+
+def _bounded_map(executor, func, tasks, window):
+    """
+    Like executor.map, but with at most window tasks pending so that finished
+    tiles don't pile up in memory while the writer catches up.
+    """
+    pending = collections.deque()
+    for task in tasks:
+        pending.append(executor.submit(func, task))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _python_tiffsave(in_path, compression, quality, tile_size, out_path,
+                     concurrency, progress, reducer='mean'):
+    """
+    Build a tiled pyramidal TIFF without vips.  Each level is produced tile
+    by tile in a process pool.  Tiles are written to the output as they
+    arrive and, except for the full resolution level, to a disk-backed array
+    that the next level is reduced from, so no level is held in memory.
+    """
+    import large_image
+    import tifffile
+
+    source = large_image.getTileSource(in_path)
+    width, height = source.sizeX, source.sizeY
+    probe = _read_probe(source)
+    bands, dtype = probe.shape[2], probe.dtype
+    levels = [(width, height)]
+    while levels[-1][0] > tile_size or levels[-1][1] > tile_size:
+        levels.append((int(math.ceil(levels[-1][0] / 2.0)),
+                       int(math.ceil(levels[-1][1] / 2.0))))
+    grids = [(int(math.ceil(w / float(tile_size))),
+              int(math.ceil(h / float(tile_size)))) for w, h in levels]
+    total = sum(across * down for across, down in grids)
+    state = {'done': 0, 'percent': None}
+    workers = int(concurrency or os.cpu_count() or 1)
+    options = {
+        'tile': (tile_size, tile_size),
+        'compression': TIFFFILE_COMPRESSION[compression.lower()],
+        'photometric': 'rgb' if bands >= 3 else 'minisblack',
+    }
+    if options['compression'] == 'jpeg':
+        options['compressionargs'] = {'level': int(quality)}
+    tempdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_path)))
+    try:
+        # This runs in the Girder server process, which has threads and open
+        # database connections that must not be forked
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker,
+                initargs=(in_path, ),
+                mp_context=multiprocessing.get_context('spawn')) as executor, \
+                tifffile.TiffWriter(out_path, bigtiff=True) as tif:
+            previous = None
+            for index, (across, down) in enumerate(grids):
+                levelMap = None
+                if index and index + 1 < len(grids):
+                    shape = (down * tile_size, across * tile_size, bands)
+                    path = os.path.join(tempdir, 'level%d.raw' % index)
+                    levelMap = numpy.memmap(path, dtype=dtype, mode='w+',
+                                            shape=shape)
+                if not index:
+                    func = _read_base_tile
+                    tasks = ((x, y, tile_size, bands, dtype)
+                             for y in range(down) for x in range(across))
+                else:
+                    func = _reduce_tile
+                    tasks = ((x, y, tile_size, bands, dtype, previous,
+                              reducer)
+                             for y in range(down) for x in range(across))
+                tiles = _bounded_map(executor, func, tasks, workers * 4)
+
+                def level_tiles(tiles=tiles, across=across, levelMap=levelMap):
+                    for number, tile in enumerate(tiles):
+                        if levelMap is not None:
+                            y, x = divmod(number, across)
+                            levelMap[y * tile_size:(y + 1) * tile_size,
+                                     x * tile_size:(x + 1) * tile_size] = tile
+                        state['done'] += 1
+                        percent = state['done'] * 100 // total
+                        if progress and percent != state['percent']:
+                            state['percent'] = percent
+                            progress(state['done'], total)
+                        yield tile[:, :, 0] if bands == 1 else tile
+
+                shape = (levels[index][1], levels[index][0])
+                tif.write(
+                    level_tiles(), shape=shape + ((bands, ) if bands > 1
+                                                  else ()),
+                    dtype=dtype, subfiletype=1 if index else 0, **options)
+                if previous is not None:
+                    os.unlink(previous[0])
+                    previous = None
+                if levelMap is not None:
+                    levelMap.flush()
+                    previous = (levelMap.filename, levelMap.shape)
+                    del levelMap
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
 
-    out_path = os.path.join(_tempdir, out_filename)
+def _read_probe(source):
+    from large_image.constants import TILE_FORMAT_NUMPY
 
-    create_tiff(in_path, compression, quality, tile_size, out_path)
-except NameError:
-    pass
+    array, _ = source.getRegion(
+        region=dict(left=0, top=0, width=1, height=1),
+        format=TILE_FORMAT_NUMPY)
+    if array.ndim == 2:
+        array = array[:, :, numpy.newaxis]
+    return array
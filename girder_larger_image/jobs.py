@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# Girder local jobs.  These run in the Girder server process, so they are used
+# for work that the large_image worker tasks cannot do.
+
+import json
+import os
+import shutil
+import tempfile
+import traceback
+
+from girder.exceptions import FilePathException
+from girder.models.file import File
+from girder.models.item import Item
+from girder.models.upload import Upload
+from girder.models.user import User
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
+
+from . import create_tiff
+
+
+def _localPath(fileObj, tempDir):
+    """
+    Get a local path for a file, copying it from its assetstore if needed.
+
+    :param fileObj: the file document.
+    :param tempDir: a directory for the copy.
+    :returns: the path of the file.
+    """
+    try:
+        return File().getLocalFilePath(fileObj)
+    except (FilePathException, AttributeError):
+        pass
+    path = os.path.join(tempDir, os.path.basename(fileObj['name']))
+    with File().open(fileObj) as src, open(path, 'wb') as dest:
+        shutil.copyfileobj(src, dest)
+    return path
+
+
+def createTiffJob(job):
+    """
+    Convert an item's file to a tiled pyramidal TIFF with create_tiff and
+    make the result the item's large image.
+
+    The job kwargs are itemId, fileId, compression, quality, tileSize,
+    reducer, and, optionally, concurrency.
+
+    :param job: the job document.
+    """
+    from .models.larger_image_item import LargerImageItem
+
+    kwargs = job['kwargs']
+    job = Job().updateJob(job, log='Started TIFF conversion\n',
+                          status=JobStatus.RUNNING)
+
+    def progress(current, total):
+        Job().updateJob(job, progressCurrent=current, progressTotal=total)
+
+    tempDir = tempfile.mkdtemp()
+    try:
+        item = Item().load(kwargs['itemId'], force=True)
+        fileObj = File().load(kwargs['fileId'], force=True)
+        user = User().load(job['userId'], force=True) if job.get(
+            'userId') else None
+        inPath = _localPath(fileObj, tempDir)
+        outName = os.path.splitext(fileObj['name'])[0] + '.tiff'
+        if outName == fileObj['name']:
+            outName = os.path.splitext(fileObj['name'])[0] + '.pyramid.tiff'
+        outPath = os.path.join(tempDir, 'out.tiff')
+        create_tiff.create_tiff(
+            inPath, kwargs['compression'], int(kwargs['quality']),
+            int(kwargs['tileSize']), outPath,
+            concurrency=kwargs.get('concurrency'), progress=progress,
+            reducer=kwargs['reducer'])
+        with open(outPath, 'rb') as f:
+            newFile = Upload().uploadFromFile(
+                f, os.path.getsize(outPath), outName, parentType='item',
+                parent=item, user=user, mimeType='image/tiff')
+        item = Item().load(kwargs['itemId'], force=True)
+        for key in ('expected', 'jobId', 'originalId', 'notify'):
+            item['largeImage'].pop(key, None)
+        # Edits of the image update its lower levels with the same reducer
+        item['largeImage']['reducer'] = kwargs['reducer']
+        LargerImageItem().createImageItem(item, newFile, user=user,
+                                          createJob=False)
+        Job().updateJob(job, log='Finished TIFF conversion\n',
+                        status=JobStatus.SUCCESS)
+    except Exception:
+        Job().updateJob(job, log=traceback.format_exc(),
+                        status=JobStatus.ERROR)
+    finally:
+        shutil.rmtree(tempDir, ignore_errors=True)
+
+
+def tileIndexJob(job):
+    """
+    Build the tile index of an item's large image.
+
+    The job kwargs are itemId and fileId.  If the item's large image file
+    has changed since the job was scheduled, nothing is done.
+
+    :param job: the job document.
+    """
+    from .models.larger_image_item import LargerImageItem
+
+    kwargs = job['kwargs']
+    job = Job().updateJob(job, log='Started tile index\n',
+                          status=JobStatus.RUNNING)
+
+    def progress(current, total):
+        Job().updateJob(job, progressCurrent=current, progressTotal=total)
+
+    try:
+        item = Item().load(kwargs['itemId'], force=True)
+        if item is None or str(item.get('largeImage', {}).get(
+                'fileId')) != kwargs['fileId']:
+            Job().updateJob(job, log='The large image has changed\n',
+                            status=JobStatus.CANCELED)
+            return
+        LargerImageItem().buildTileIndex(item, progress=progress)
+        Job().updateJob(job, log='Finished tile index\n',
+                        status=JobStatus.SUCCESS)
+    except Exception:
+        Job().updateJob(job, log=traceback.format_exc(),
+                        status=JobStatus.ERROR)
+
+
+def renderStyleJob(job):
+    """
+    Render a style for every tile of an item's large image.
+
+    The job kwargs are itemId, fileId, and styleKey.  If the item's large
+    image file or the style's colormap has changed since the job was
+    scheduled, nothing is done.
+
+    :param job: the job document.
+    """
+    from .models.larger_image_item import LargerImageItem
+    from .rest.tiles import _loadColormap, applyColormap
+
+    kwargs = job['kwargs']
+    job = Job().updateJob(job, log='Started rendering style\n',
+                          status=JobStatus.RUNNING)
+
+    def progress(current, total):
+        Job().updateJob(job, progressCurrent=current, progressTotal=total)
+
+    try:
+        item = Item().load(kwargs['itemId'], force=True)
+        if item is None or str(item.get('largeImage', {}).get(
+                'fileId')) != kwargs['fileId']:
+            Job().updateJob(job, log='The large image has changed\n',
+                            status=JobStatus.CANCELED)
+            return
+        params = json.loads(kwargs['styleKey'])
+        colormap = None
+        if 'colormapId' in params:
+            colormap = _loadColormap(params['colormapId'])
+            if colormap['version'] != params['colormapVersion']:
+                Job().updateJob(job, log='The colormap has changed\n',
+                                status=JobStatus.CANCELED)
+                return
+        applyColormap(params, colormap)
+        user = User().load(job['userId'], force=True) if job.get(
+            'userId') else None
+        LargerImageItem().renderStyle(item, kwargs['styleKey'], params,
+                                      user=user, progress=progress)
+        Job().updateJob(job, log='Finished rendering style\n',
+                        status=JobStatus.SUCCESS)
+    except Exception:
+        Job().updateJob(job, log=traceback.format_exc(),
+                        status=JobStatus.ERROR)
+
+
+def foldOverlayJob(job):
+    """
+    Update the coarser levels of an item's large image from its edited
+    tiles.
+
+    The job kwargs are itemId, fileId, and, optionally, reducer.  If the
+    item's large image file has changed since the job was scheduled, nothing
+    is done.
+
+    :param job: the job document.
+    """
+    from .models.larger_image_item import LargerImageItem
+
+    kwargs = job['kwargs']
+    job = Job().updateJob(job, log='Started updating edited levels\n',
+                          status=JobStatus.RUNNING)
+
+    def progress(current, total):
+        Job().updateJob(job, progressCurrent=current, progressTotal=total)
+
+    try:
+        item = Item().load(kwargs['itemId'], force=True)
+        if item is None or str(item.get('largeImage', {}).get(
+                'fileId')) != kwargs['fileId']:
+            Job().updateJob(job, log='The large image has changed\n',
+                            status=JobStatus.CANCELED)
+            return
+        count = LargerImageItem().foldOverlay(
+            item, progress=progress, reducer=kwargs.get('reducer'))
+        Job().updateJob(job, log='Updated %d tiles\n' % count,
+                        status=JobStatus.SUCCESS)
+    except Exception:
+        Job().updateJob(job, log=traceback.format_exc(),
+                        status=JobStatus.ERROR)
+
+
+def importFolderJob(job):
+    """
+    Create large images for the items of a folder.
+
+    The job kwargs are folderId and the parameters of importFolder other
+    than progress, canceled, and importId.  The job finishes when every item
+    has been imported or queued for conversion; queued conversions are
+    started as earlier ones finish.  Canceling the job stops the import and
+    clears the queue; the conversion jobs that were already started
+    continue.
+
+    :param job: the job document.
+    """
+    from girder.models.folder import Folder
+
+    from .models.larger_image_item import LargerImageItem
+
+    kwargs = dict(job['kwargs'])
+    job = Job().updateJob(job, log='Started import\n',
+                          status=JobStatus.RUNNING)
+
+    def progress(current, total):
+        Job().updateJob(job, progressCurrent=current, progressTotal=total)
+
+    def canceled():
+        return Job().load(job['_id'], force=True, fields=['status'])[
+            'status'] == JobStatus.CANCELED
+
+    try:
+        folder = Folder().load(kwargs.pop('folderId'), force=True)
+        user = User().load(job['userId'], force=True) if job.get(
+            'userId') else None
+        counts = LargerImageItem().importFolder(
+            folder, user, progress=progress, canceled=canceled,
+            importId=str(job['_id']), **kwargs)
+        log = 'Imported %d, converting %d, skipped %d, failed %d\n' % (
+            counts['direct'], counts['converting'], counts['skipped'],
+            counts['failed'])
+        if canceled():
+            Job().updateJob(job, log=log)
+            return
+        Job().updateJob(job, log=log, status=JobStatus.SUCCESS)
+    except Exception:
+        Job().updateJob(job, log=traceback.format_exc(),
+                        status=JobStatus.ERROR)
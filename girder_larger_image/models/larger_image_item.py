@@ -21,20 +21,89 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 ###############################################################################
+import datetime
+import hashlib
+import json
 import os.path
-import time
+import tempfile
 
+import numpy
+import pymongo
+
+from bson.objectid import ObjectId
+from girder import events
+from girder.constants import AccessType
+from girder.exceptions import FilePathException
+from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.upload import Upload
+from girder.models.user import User
+from girder_jobs.constants import JobStatus
 from girder_jobs.models.job import Job
+from large_image.constants import TileOutputMimeTypes
 from large_image.exceptions import TileGeneralException
 from girder_large_image.models.image_item import ImageItem
 from girder_worker.girder_plugin import utils as workerUtils
 
+from ..cache_util import LruCache, getConfig, registerCache
+from .tile_index import TileIndex
+from .tile_overlay import TileOverlay
+from ..create_tiff import REDUCERS
 from ..tilesource import AvailableTileSources, TileSourceException
+from ..tilesource.histogram import DefaultPercentiles, packHistogram, \
+    summarizeHistogram, unpackHistogram
+from ..tilesource.sniff import HeaderSize, plausibleSources, sniffHeader
+from ..tilesource.tilestore import TileStoreIndex, levelTileCounts, \
+    writeTileStore
+
+# Constructor arguments that change how a tile source behaves.  Other
+# arguments, such as the tile processing parameters, are applied per call and
+# do not need a separate source.
+SourceKwargs = ('encoding', 'jpegQuality', 'jpegSubsampling',
+                'tiffCompression', 'edge', 'style')
+
+tileSourceCache = registerCache('tilesource', LruCache(
+    maxSize=int(getConfig('source_cache_size', 32)),
+    maxAge=float(getConfig('source_cache_max_age', 600))))
+
+# Indices of pre-rendered style tile stores by file id
+tileStoreCache = registerCache('tilestore', LruCache(maxSize=32))
+
+# The overlay versions of edited tiles by item id, file id, and overlay
+# version of the item
+editVersionCache = registerCache('editversion', LruCache(
+    maxSize=int(getConfig('edit_version_cache_size', 256))))
+
+# Job states after which a job does no more work
+FinishedJobStatuses = (JobStatus.SUCCESS, JobStatus.ERROR, JobStatus.CANCELED)
+
+# The tile source that can read a file, or '' if none can, by file id and
+# content
+sourceDetectCache = registerCache('sourcedetect', LruCache(
+    maxSize=int(getConfig('source_detect_cache_size', 1024))))
 
 
 class LargerImageItem(ImageItem):
     def createImageItem(self, item, fileObj, user=None, token=None,
-                        createJob=True, notify=False, **kwargs):
+                        createJob=True, notify=False, sourceName=None,
+                        save=True, **kwargs):
+        """
+        Make a file the large image of its item, converting it in a job if
+        no tile source can read it.
+
+        :param item: the item.  Modified.
+        :param fileObj: a file of the item.
+        :param user: the user that owns any job.
+        :param token: the token of the user.
+        :param createJob: if False, fail rather than convert the file.
+        :param notify: notify the user when a conversion job is done.
+        :param sourceName: the result of probeTileSource for the file, if it
+            was already called, with False for files that no source can
+            read.  If None, the file is probed.
+        :param save: if False, the item is not saved; see saveImageItems.
+        :param kwargs: the conversion parameters.
+        :returns: the conversion job or None.
+        """
         # Using setdefault ensures that 'largeImage' is in the item
         if 'fileId' in item.setdefault('largeImage', {}):
             # TODO: automatically delete the existing large file
@@ -50,18 +119,16 @@ class LargerImageItem(ImageItem):
         item['largeImage'].pop('expected', None)
         item['largeImage'].pop('sourceName', None)
 
+        if sourceName is None:
+            sourceName = self.probeTileSource(item, fileObj)
         item['largeImage']['fileId'] = fileObj['_id']
         job = None
-        for sourceName in AvailableTileSources:
-            if getattr(AvailableTileSources[sourceName], 'girderSource',
-                       False):
-                if AvailableTileSources[sourceName].canRead(item):
-                    item['largeImage']['sourceName'] = sourceName
-                    break
-        if 'sourceName' not in item['largeImage'] and not createJob:
+        if sourceName:
+            item['largeImage']['sourceName'] = sourceName
+        if not sourceName and not createJob:
             raise TileGeneralException(
                 'A job must be used to generate a largeImage.')
-        if 'sourceName' not in item['largeImage']:
+        if not sourceName:
             # No source was successful
             del item['largeImage']['fileId']
             job = self._createLargeImageJob(item, fileObj, user, token,
@@ -71,10 +138,283 @@ class LargerImageItem(ImageItem):
             item['largeImage']['originalId'] = fileObj['_id']
             item['largeImage']['jobId'] = job['_id']
 
-        self.save(item)
+        if save:
+            self.save(item)
+        return job
+
+    def probeTileSource(self, item, fileObj):
+        """
+        Find a tile source that can read a file of an item directly.  The
+        start of the file is read once to skip the sources that can't read
+        its format, and the result is remembered for the file's content.
+
+        :param item: the item.
+        :param fileObj: a file of the item.
+        :returns: the name of the tile source, or None if the file must be
+            converted.
+        """
+        try:
+            with File().open(fileObj) as f:
+                header = f.read(HeaderSize)
+        except Exception:
+            # A file that can't be read here is left to the sources
+            header = b''
+        key = (str(fileObj['_id']), fileObj.get('sha512') or '%s:%s' % (
+            fileObj.get('size'), hashlib.sha1(header).hexdigest()))
+        cached = sourceDetectCache.get(key)
+        if cached is not None:
+            return cached or None
+        sourceNames = plausibleSources(sniffHeader(header), [
+            sourceName for sourceName in AvailableTileSources
+            if getattr(AvailableTileSources[sourceName], 'girderSource',
+                       False)])
+        largeImage = item.setdefault('largeImage', {})
+        previous = largeImage.get('fileId')
+        largeImage['fileId'] = fileObj['_id']
+        result = None
+        try:
+            for sourceName in sourceNames:
+                if AvailableTileSources[sourceName].canRead(item):
+                    result = sourceName
+                    break
+        finally:
+            if previous is None:
+                del largeImage['fileId']
+            else:
+                largeImage['fileId'] = previous
+        if header:
+            sourceDetectCache.put(key, result or '')
+        return result
+
+    def saveImageItems(self, items):
+        """
+        Store the largeImage records of several items with one database
+        request.  Items that were given a large image since they were loaded
+        are not changed.  The item save events are triggered for each item
+        that was stored.
+
+        :param items: a list of items from createImageItem with save=False.
+        :returns: the items that were stored.
+        """
+        if not items:
+            return []
+        self.collection.bulk_write([
+            pymongo.UpdateOne(
+                {'_id': item['_id'], 'largeImage.fileId': {'$exists': False}},
+                {'$set': {'largeImage': item['largeImage']}})
+            for item in items], ordered=False)
+        fileIds = {doc['_id']: doc.get('largeImage', {}).get('fileId')
+                   for doc in self.find(
+                       {'_id': {'$in': [item['_id'] for item in items]}},
+                       fields=['largeImage.fileId'])}
+        stored = [item for item in items
+                  if fileIds.get(item['_id']) == item['largeImage']['fileId']]
+        for item in stored:
+            events.trigger('model.item.save.after', item)
+        return stored
+
+    def _writableFolders(self, folder, user, recursive):
+        folders = [folder]
+        if recursive:
+            pending = [folder]
+            while pending:
+                for child in Folder().childFolders(
+                        pending.pop(), 'folder', user=user):
+                    if user is None or Folder().hasAccess(
+                            child, user, AccessType.WRITE):
+                        folders.append(child)
+                        pending.append(child)
+        return folders
+
+    def importFolder(self, folder, user=None, recursive=False,
+                     mimeTypes=None, maxConversions=4, priority=None,
+                     progress=None, canceled=None, importId=None, **kwargs):
+        """
+        Create large images for the items of a folder that don't have one.
+        Each item must have exactly one image file.  Each file is probed for
+        a tile source once.  Items that can be read directly are stored in
+        batches.  Items whose files must be converted are queued; conversion
+        jobs are started from the queue by startImportConversions, with no
+        more than maxConversions jobs unfinished at a time.  This never waits
+        for the conversions, so it can run in a Girder local job.
+
+        :param folder: the folder.
+        :param user: the user that owns the conversion jobs.
+        :param recursive: if True, also import the folders in the folder
+            that the user can write to.
+        :param mimeTypes: a list of the mime types of image files, or None to
+            consider every file.
+        :param maxConversions: the maximum number of unfinished conversion
+            jobs.
+        :param priority: the queue priority of the conversion tasks, or None
+            for the default.
+        :param progress: an optional function called with the number of
+            items done and the total number of items.
+        :param canceled: an optional function that returns True to stop the
+            import.
+        :param importId: the id of the import job, if any.  Canceling that
+            job stops starting queued conversions.
+        :param kwargs: the conversion parameters, as for createImageItem.
+        :returns: a dictionary with the number of items that were 'direct'
+            (readable without conversion), 'converting' (started or queued),
+            'skipped' (no single image file, or already imported elsewhere),
+            and 'failed'.
+        """
+        batchSize = int(getConfig('import_batch_size', 100))
+        importId = str(importId or ObjectId())
+        query = {
+            'folderId': {'$in': [f['_id'] for f in self._writableFolders(
+                folder, user, recursive)]},
+            'largeImage.fileId': {'$exists': False},
+            'largeImage.expected': {'$ne': True},
+            'largeImageImport': {'$exists': False},
+        }
+        total = self.collection.count_documents(query)
+        counts = {'direct': 0, 'converting': 0, 'skipped': 0, 'failed': 0}
+        if priority is not None:
+            kwargs['priority'] = priority
+        marker = {
+            'importId': importId,
+            'userId': user['_id'] if user else None,
+            'maxConversions': maxConversions,
+            'params': kwargs,
+        }
+        lastId = None
+        done = 0
+        while not (canceled and canceled()):
+            if lastId is not None:
+                query['_id'] = {'$gt': lastId}
+            items = list(self.find(query, sort=[('_id', 1)], limit=batchSize))
+            if not items:
+                break
+            lastId = items[-1]['_id']
+            fileQuery = {'itemId': {'$in': [item['_id'] for item in items]}}
+            if mimeTypes is not None:
+                fileQuery['mimeType'] = {'$in': list(mimeTypes)}
+            files = {}
+            for fileObj in File().find(fileQuery):
+                files.setdefault(fileObj['itemId'], []).append(fileObj)
+            direct = []
+            queued = []
+            for item in items:
+                if len(files.get(item['_id'], [])) != 1:
+                    counts['skipped'] += 1
+                    continue
+                fileObj = files[item['_id']][0]
+                sourceName = self.probeTileSource(item, fileObj) or False
+                if not sourceName:
+                    queued.append(pymongo.UpdateOne(
+                        {'_id': item['_id'],
+                         'largeImage.fileId': {'$exists': False}},
+                        {'$set': {'largeImageImport': dict(
+                            marker, fileId=fileObj['_id'])}}))
+                    continue
+                try:
+                    self.createImageItem(item, fileObj, user,
+                                         sourceName=sourceName, save=False)
+                    direct.append(item)
+                except TileGeneralException:
+                    counts['failed'] += 1
+            stored = self.saveImageItems(direct)
+            counts['direct'] += len(stored)
+            counts['skipped'] += len(direct) - len(stored)
+            if queued:
+                counts['converting'] += self.collection.bulk_write(
+                    queued, ordered=False).modified_count
+                self.startImportConversions(importId)
+            done += len(items)
+            if progress:
+                progress(min(done, total), total)
+        return counts
+
+    def startImportConversions(self, importId):
+        """
+        Start conversion jobs for the items queued by importFolder until the
+        import's limit of unfinished conversions is reached.  This is called
+        by importFolder and whenever one of the import's conversion jobs
+        finishes.  If the import job was canceled, the remaining items are
+        removed from the queue instead.
+
+        :param importId: the id of the import.
+        :returns: the number of conversion jobs that were started.
+        """
+        queueQuery = {'largeImageImport.importId': importId}
+        first = self.findOne(queueQuery, fields=['largeImageImport'])
+        if first is None:
+            return 0
+        importJob = Job().findOne({'_id': ObjectId(importId)},
+                                  fields=['status'])
+        if importJob and importJob['status'] == JobStatus.CANCELED:
+            self.collection.update_many(
+                queueQuery, {'$unset': {'largeImageImport': True}})
+            return 0
+        unfinished = Job().collection.count_documents({
+            'meta.importId': importId,
+            'status': {'$nin': list(FinishedJobStatuses)}})
+        started = 0
+        while unfinished + started < first['largeImageImport'][
+                'maxConversions']:
+            # Claiming an item removes it from the queue, so concurrent calls
+            # never start the same conversion twice
+            item = self.collection.find_one_and_update(
+                queueQuery, {'$unset': {'largeImageImport': True}},
+                sort=[('_id', 1)])
+            if item is None:
+                break
+            marker = item.pop('largeImageImport')
+            fileObj = File().load(marker['fileId'], force=True)
+            user = User().load(marker['userId'], force=True) if marker.get(
+                'userId') else None
+            if fileObj is None or 'fileId' in item.get('largeImage', {}):
+                continue
+            try:
+                self.createImageItem(item, fileObj, user, sourceName=False,
+                                     importId=importId, **marker['params'])
+                started += 1
+            except TileGeneralException:
+                pass
+        return started
+
+    def scheduleFolderImport(self, folder, user=None, **kwargs):
+        """
+        Import the items of a folder in a Girder local job.
+
+        :param folder: the folder.
+        :param user: the user that owns the job and the conversion jobs.
+        :param kwargs: the importFolder parameters other than progress,
+            canceled, and importId.  They must be JSON serializable.
+        :returns: the job document.
+        """
+        job = Job().createLocalJob(
+            module='girder_larger_image.jobs', function='importFolderJob',
+            title='Import large images: %s' % folder['name'],
+            type='larger_image_import', user=user, public=False,
+            asynchronous=True,
+            kwargs=dict(kwargs, folderId=str(folder['_id'])))
+        Job().scheduleJob(job)
         return job
 
     def _createLargeImageJob(self, item, fileObj, user, token, **kwargs):
+        # The worker task converts in its own process with large_image's
+        # converter, which only reduces levels by averaging and doesn't
+        # report progress.  Other reducers, and all conversions when
+        # local_conversion is set, use create_tiff in a local job.
+        localConversion = str(getConfig(
+            'local_conversion', False)).lower() in ('true', '1', 'yes')
+        if localConversion or kwargs.get('reducer', 'mean') != 'mean':
+            kwargs.setdefault('reducer', 'mean')
+            return self._createLocalTiffJob(item, fileObj, user, **kwargs)
+        kwargs.pop('reducer', None)
+        priority = kwargs.pop('priority', None)
+        meta = {
+            'creator': 'large_image',
+            'itemId': str(item['_id']),
+            'task': 'createImageItem',
+        }
+        if kwargs.get('importId'):
+            meta['importId'] = kwargs.pop('importId')
+        kwargs.pop('importId', None)
+
         import large_image_tasks.tasks
         from girder_worker_utils.transforms.girder_io import GirderUploadToItem
         from girder_worker_utils.transforms.contrib.girder_io import GirderFileIdAllowDirect
@@ -86,11 +426,7 @@ class LargerImageItem(ImageItem):
             localPath = None
         job = large_image_tasks.tasks.create_tiff.apply_async(kwargs=dict(
             girder_job_title='TIFF Conversion: %s' % fileObj['name'],
-            girder_job_other_fields={'meta': {
-                'creator': 'large_image',
-                'itemId': str(item['_id']),
-                'task': 'createImageItem',
-            }},
+            girder_job_other_fields={'meta': meta},
             inputFile=GirderFileIdAllowDirect(str(fileObj['_id']), fileObj['name'], localPath),
             inputName=fileObj['name'],
             outputDir=TemporaryDirectory(),
@@ -98,112 +434,47 @@ class LargerImageItem(ImageItem):
                 GirderUploadToItem(str(item['_id']), False),
             ],
             **kwargs,
-        ), countdown=int(kwargs['countdown']) if kwargs.get('countdown') else None)
+        ), countdown=int(kwargs['countdown']) if kwargs.get('countdown') else None,
+            priority=priority, girder_user=user)
         return job.job
 
-        
-        # path = os.path.join(os.path.dirname(__file__), '..', 'create_tiff.py')
-        # with open(path, 'r') as f:
-        #     script = f.read()
-
-        # title = 'TIFF conversion: %s' % fileObj['name']
-        # job = Job().createJob(
-        #     title=title, type='large_image_tiff', handler='worker_handler',
-        #     user=user)
-        # jobToken = Job().createJobToken(job)
-
-        # outputName = os.path.splitext(fileObj['name'])[0] + '.tiff'
-        # if outputName == fileObj['name']:
-        #     outputName = (os.path.splitext(fileObj['name'])[0] + '.' +
-        #                   time.strftime('%Y%m%d-%H%M%S') + '.tiff')
-
-        # task = {
-        #     'mode': 'python',
-        #     'script': script,
-        #     'name': title,
-        #     'inputs': [{
-        #         'id': 'in_path',
-        #         'target': 'filepath',
-        #         'type': 'string',
-        #         'format': 'text'
-        #     }, {
-        #         'id': 'out_filename',
-        #         'type': 'string',
-        #         'format': 'text'
-        #     }, {
-        #         'id': 'tile_size',
-        #         'type': 'number',
-        #         'format': 'number'
-        #     }, {
-        #         'id': 'quality',
-        #         'type': 'number',
-        #         'format': 'number'
-        #     }, {
-        #         'id': 'compression',
-        #         'type': 'string',
-        #         'format': 'text'
-        #     }],
-        #     'outputs': [{
-        #         'id': 'out_path',
-        #         'target': 'filepath',
-        #         'type': 'string',
-        #         'format': 'text'
-        #     }]
-        # }
-
-        # inputs = {
-        #     'in_path': workerUtils.girderInputSpec(
-        #         fileObj, resourceType='file', token=token),
-        #     'compression': {
-        #         'mode': 'inline',
-        #         'type': 'string',
-        #         'format': 'text',
-        #         'data': compression
-        #     },
-        #     'quality': {
-        #         'mode': 'inline',
-        #         'type': 'number',
-        #         'format': 'number',
-        #         'data': quality
-        #     },
-        #     'tile_size': {
-        #         'mode': 'inline',
-        #         'type': 'number',
-        #         'format': 'number',
-        #         'data': tileSize
-        #     },
-        #     'out_filename': {
-        #         'mode': 'inline',
-        #         'type': 'string',
-        #         'format': 'text',
-        #         'data': outputName
-        #     }
-        # }
-
-        # outputs = {
-        #     'out_path': workerUtils.girderOutputSpec(
-        #         parent=item, token=token, parentType='item')
-        # }
-
-        # # TODO: Give the job an owner
-        # job['kwargs'] = {
-        #     'task': task,
-        #     'inputs': inputs,
-        #     'outputs': outputs,
-        #     'jobInfo': workerUtils.jobInfoSpec(job, jobToken),
-        #     'auto_convert': False,
-        #     'validate': False
-        # }
-        # job['meta'] = {
-        #     'creator': 'large_image',
-        #     'itemId': str(item['_id']),
-        #     'task': 'createImageItem',
-        # }
-
-        # job = Job().save(job)
-        # Job().scheduleJob(job)
-
-        # return job
+    def _createLocalTiffJob(self, item, fileObj, user, **kwargs):
+        """
+        Convert a file with create_tiff in a Girder local job.  This is used
+        for conversions that the large_image worker task cannot do, such as
+        building the lower levels of a label image with a label-preserving
+        reducer, and for all conversions when the local_conversion setting is
+        true.
+
+        :param item: the item that will hold the large image.
+        :param fileObj: the file to convert.
+        :param user: the user that owns the job.
+        :returns: the job document.
+        """
+        meta = {
+            'creator': 'large_image',
+            'itemId': str(item['_id']),
+            'task': 'createImageItem',
+        }
+        if kwargs.get('importId'):
+            meta['importId'] = kwargs['importId']
+        job = Job().createLocalJob(
+            module='girder_larger_image.jobs', function='createTiffJob',
+            title='TIFF Conversion: %s' % fileObj['name'],
+            type='larger_image_tiff', user=user, public=False,
+            asynchronous=True,
+            kwargs={
+                'itemId': str(item['_id']),
+                'fileId': str(fileObj['_id']),
+                'compression': kwargs.get('compression', 'jpeg'),
+                'quality': kwargs.get('quality', 90),
+                'tileSize': kwargs.get('tileSize', 256),
+                'reducer': kwargs['reducer'],
+                'concurrency': kwargs.get('concurrency'),
+            },
+            otherFields={'meta': meta})
+        Job().scheduleJob(job)
+        return job
 
     @classmethod
     def _loadTileSource(cls, item, **kwargs):
@@ -214,19 +485,795 @@ class LargerImageItem(ImageItem):
                                       'still pending creation.')
 
         sourceName = item['largeImage']['sourceName']
-        tileSource = AvailableTileSources[sourceName](item, **kwargs)
+        sourceKwargs = {k: kwargs[k] for k in SourceKwargs if k in kwargs}
+        itemId = str(item['_id'])
+        record = cls.largeImageRecord(item)
+        key = (itemId, str(item['largeImage'].get('fileId')), sourceName,
+               record, json.dumps(sourceKwargs, sort_keys=True, default=str))
+        tileSource = tileSourceCache.get(key)
+        if tileSource is None:
+            # Sources opened for a previous largeImage record are stale
+            tileSourceCache.removeIf(
+                lambda k: k[0] == itemId and k[3] != record)
+            tileSource = AvailableTileSources[sourceName](item, **sourceKwargs)
+            cls._applyIndex(tileSource, item)
+            cls._applyOverlay(tileSource, item)
+            tileSourceCache.put(key, tileSource)
+        elif (getattr(tileSource, 'overlayVersion', None) !=
+                item['largeImage'].get('overlayVersion')):
+            # The file is unchanged, so only the list of edits and the index
+            # levels that edits removed are reloaded
+            cls._applyIndex(tileSource, item)
+            cls._applyOverlay(tileSource, item)
         return tileSource
 
+    @classmethod
+    def _applyIndex(cls, tileSource, item):
+        if not hasattr(tileSource, 'setOccupancy'):
+            return
+        tileIndex = TileIndex()
+        indexed = set()
+        for doc in tileIndex.getLevels(item):
+            arrays = tileIndex.arrays(doc)
+            try:
+                tileSource.setOccupancy(doc['level'], arrays['occupancy'])
+            except ValueError:
+                # The index doesn't match the file, so don't use it
+                continue
+            tileSource.setLabelIndex(doc['level'], arrays['labels'])
+            indexed.add(doc['level'])
+        for level in range(tileSource.levels):
+            if level not in indexed:
+                tileSource.setOccupancy(level, None)
+                tileSource.setLabelIndex(level, None)
+
+    def _dropEditedLevels(self, item, levels):
+        """
+        Remove the tile index and histograms of levels whose tiles were
+        edited, since they describe the pixels from before the edit.  They
+        are computed again, including the edits, when they are next needed.
+
+        :param item: the item with a large image.  Modified.
+        :param levels: the tile levels that were edited.
+        """
+        levels = sorted(set(levels))
+        if not levels:
+            return
+        TileIndex().removeLevels(item, levels)
+        if item.get('largeImageHistogram'):
+            self.update({'_id': item['_id']}, {'$unset': {
+                'largeImageHistogram.levels.%d' % level: True
+                for level in levels}})
+            for level in levels:
+                item['largeImageHistogram'].get('levels', {}).pop(
+                    str(level), None)
+
+    @classmethod
+    def _applyOverlay(cls, tileSource, item):
+        if not hasattr(tileSource, 'setOverlay'):
+            return
+        overlay = TileOverlay()
+
+        def getOverlayTile(z, x, y):
+            return overlay.getTile(item, z, x, y)
+
+        tileSource.setOverlay(item['largeImage'].get('overlayVersion'),
+                              overlay.tileKeys(item), getOverlayTile)
+
+    def _nextOverlayVersion(self, item):
+        """
+        Increment the overlay version of an item.  This is done once before
+        edited tiles are stored, to get a version for them, and once after,
+        so that tile sources loaded while they were being stored reload the
+        list of edits.
+
+        :param item: the item.  Modified.
+        :returns: the new overlay version.
+        """
+        doc = self.collection.find_one_and_update(
+            {'_id': item['_id']}, {'$inc': {'largeImage.overlayVersion': 1}},
+            projection=['largeImage.overlayVersion'],
+            return_document=pymongo.ReturnDocument.AFTER)
+        if doc is not None:
+            item['largeImage']['overlayVersion'] = doc['largeImage'][
+                'overlayVersion']
+        return item['largeImage'].get('overlayVersion')
+
+    def getTileEditVersion(self, item, x, y, z):
+        """
+        Get the overlay version of an edited tile.  Rendered tiles are cached
+        by this value, so an edit only changes the cache keys of the tiles
+        that it changed.
+
+        :param item: the item.
+        :param x: the tile column.
+        :param y: the tile row.
+        :param z: the tile level.
+        :returns: the version, or None if the tile was not edited.
+        """
+        largeImage = item.get('largeImage', {})
+        if largeImage.get('overlayVersion') is None:
+            return None
+        # This is checked before conditional requests are answered, so it
+        # reads the list of edits without opening a tile source
+        key = (str(item['_id']), str(largeImage.get('fileId')),
+               largeImage['overlayVersion'])
+        tiles = editVersionCache.get(key)
+        if tiles is None:
+            tiles = TileOverlay().tileKeys(item)
+            editVersionCache.put(key, tiles)
+        return tiles.get((int(z), int(x), int(y)))
+
+    def _checkTile(self, tileSource, x, y, z):
+        tileCounts = levelTileCounts(
+            tileSource.sizeX, tileSource.sizeY, tileSource.tileWidth,
+            tileSource.tileHeight, tileSource.levels)
+        if not 0 <= z < len(tileCounts) or not (
+                0 <= x < tileCounts[z][0] and 0 <= y < tileCounts[z][1]):
+            raise TileSourceException('Tile %d/%d/%d does not exist.' % (
+                z, x, y))
+        return tileCounts
+
+    def _editTile(self, item, tileSource, x, y, z, edit, version,
+                  pending=True):
+        """
+        Read, change, and store a tile in the tile overlay.  The tile is only
+        stored if no other edit of it was stored since it was read;
+        otherwise, the edit is applied again to the newer tile.
+
+        :param item: the item with a large image.
+        :param tileSource: the tile source of the item.
+        :param x: the tile column.
+        :param y: the tile row.
+        :param z: the tile level.
+        :param edit: a function that is passed a writable array of the
+            current pixels of the tile and returns the new pixels, or None to
+            leave the tile unchanged.
+        :param version: the overlay version of the edit.
+        :param pending: True if the coarser levels must be updated from this
+            tile.
+        :returns: True if the tile was stored.
+        """
+        overlay = TileOverlay()
+        for _ in range(int(getConfig('edit_attempts', 10))):
+            tile, previous = overlay.getTileAndVersion(item, z, x, y)
+            if tile is not None:
+                tile = tile.copy()
+            else:
+                # The source may not have loaded the newest edits, so only
+                # the file is read from it
+                tile = tileSource.getTileArray(x, y, z, edits=False)
+            tile = edit(tile)
+            if tile is None:
+                return False
+            if overlay.setTile(item, z, x, y, tile, version,
+                               pending=pending, previous=previous):
+                return True
+        raise TileSourceException(
+            'Tile %d/%d/%d is being changed by other edits.' % (z, x, y))
+
+    def saveTile(self, item, x, y, z, array):
+        """
+        Replace a tile of an item's large image with edited pixels.  The
+        edit is stored in the tile overlay; the large image file is not
+        changed.
+
+        :param item: the item with a large image.
+        :param x: the tile column.
+        :param y: the tile row.
+        :param z: the tile level.
+        :param array: the unprocessed pixels of the whole tile.  They must
+            have the shape of the tile and fit in the image data type.
+        :returns: the new overlay version.
+        """
+        tileSource = self._loadTileSource(item)
+        if not hasattr(tileSource, 'setOverlay'):
+            raise TileSourceException('This image cannot be edited.')
+        self._checkTile(tileSource, x, y, z)
+        current = tileSource.getTileArray(x, y, z)
+        if array.ndim == 3 and array.shape[2] == 1:
+            array = array[:, :, 0]
+        if array.shape != current.shape:
+            raise TileSourceException('The tile must have a shape of %s.' % (
+                'x'.join(str(v) for v in current.shape), ))
+        if not numpy.array_equal(array.astype(current.dtype), array):
+            raise TileSourceException(
+                'The tile values do not fit in %s.' % current.dtype)
+        array = array.astype(current.dtype)
+        self._editTile(item, tileSource, x, y, z, lambda tile: array,
+                       self._nextOverlayVersion(item))
+        self._dropEditedLevels(item, [z])
+        return self._nextOverlayVersion(item)
+
+    def saveRegionMask(self, item, left, top, mask, value, z=None):
+        """
+        Set the pixels of a region of an item's large image to a value where
+        a mask is nonzero.  The changed tiles are stored in the tile overlay.
+
+        :param item: the item with a large image.
+        :param left: the left edge of the mask in pixels of the level.
+        :param top: the top edge of the mask in pixels of the level.
+        :param mask: a two dimensional array.
+        :param value: the new value of the masked pixels.  Every band is set
+            to this value.
+        :param z: the tile level, or None for the full resolution level.
+        :returns: the new overlay version and a list of the (z, x, y) tiles
+            that changed.
+        """
+        tileSource = self._loadTileSource(item)
+        if not hasattr(tileSource, 'setOverlay'):
+            raise TileSourceException('This image cannot be edited.')
+        if z is None:
+            z = tileSource.levels - 1
+        tileCounts = self._checkTile(tileSource, 0, 0, z)
+        tileWidth, tileHeight = tileSource.tileWidth, tileSource.tileHeight
+        mask = numpy.asarray(mask) != 0
+        changed = []
+        version = None
+        for ty in range(max(0, top // tileHeight), min(
+                tileCounts[z][1], (top + mask.shape[0] - 1) // tileHeight + 1)):
+            for tx in range(max(0, left // tileWidth), min(
+                    tileCounts[z][0],
+                    (left + mask.shape[1] - 1) // tileWidth + 1)):
+                x0, y0 = max(left, tx * tileWidth), max(top, ty * tileHeight)
+                x1 = min(left + mask.shape[1], (tx + 1) * tileWidth)
+                y1 = min(top + mask.shape[0], (ty + 1) * tileHeight)
+                region = mask[y0 - top:y1 - top, x0 - left:x1 - left]
+                if not region.any():
+                    continue
+
+                def edit(tile, region=region, x0=x0, y0=y0, x1=x1, y1=y1,
+                         tx=tx, ty=ty):
+                    if numpy.array(value).astype(tile.dtype) != value:
+                        raise TileSourceException(
+                            'The value does not fit in %s.' % tile.dtype)
+                    tile[y0 - ty * tileHeight:y1 - ty * tileHeight,
+                         x0 - tx * tileWidth:x1 - tx * tileWidth][
+                        region] = value
+                    return tile
+
+                if version is None:
+                    version = self._nextOverlayVersion(item)
+                self._editTile(item, tileSource, tx, ty, z, edit, version)
+                changed.append((z, tx, ty))
+        if changed:
+            self._dropEditedLevels(item, [z])
+            self._nextOverlayVersion(item)
+        return item['largeImage'].get('overlayVersion'), changed
+
+    def discardEdits(self, item):
+        """
+        Remove all edits of an item's large image.
+
+        :param item: the item with a large image.
+        :returns: the new overlay version.
+        """
+        # Pre-rendered styles from before the reset may include the edits
+        reset = self._nextOverlayVersion(item)
+        self.update({'_id': item['_id']},
+                    {'$set': {'largeImage.overlayReset': reset}})
+        item['largeImage']['overlayReset'] = reset
+        levels = {z for z, _, _ in TileOverlay().tileKeys(item)}
+        TileOverlay().removeForItem(item)
+        self._dropEditedLevels(item, levels)
+        return self._nextOverlayVersion(item)
+
+    def scheduleOverlayFold(self, item, user=None, reducer=None):
+        """
+        Update the coarser levels from edited tiles in a Girder local job.
+
+        :param item: the item with a large image.
+        :param user: the user that owns the job.
+        :param reducer: the reducer used to combine finer tiles, or None for
+            the reducer of the image.
+        :returns: the job document.
+        """
+        job = Job().createLocalJob(
+            module='girder_larger_image.jobs', function='foldOverlayJob',
+            title='Update edited levels: %s' % item['name'],
+            type='larger_image_fold', user=user, public=False,
+            asynchronous=True,
+            kwargs={'itemId': str(item['_id']),
+                    'fileId': str(item['largeImage']['fileId']),
+                    'reducer': reducer})
+        Job().scheduleJob(job)
+        return job
+
+    @staticmethod
+    def _reduceQuadrant(tile, reducer):
+        """
+        Halve a tile in each direction.
+
+        :param tile: the pixels of a tile.
+        :param reducer: one of the keys of REDUCERS.
+        :returns: the reduced pixels.
+        """
+        height, width = tile.shape[:2]
+        if height % 2 or width % 2:
+            raise TileSourceException(
+                'Tiles of %d x %d pixels cannot be halved.' % (width, height))
+        block = tile if tile.ndim == 3 else tile[:, :, numpy.newaxis]
+        reduced = REDUCERS[reducer](block, (height // 2, width // 2))
+        return reduced if tile.ndim == 3 else reduced[:, :, 0]
+
+    def _acquireFoldLease(self, item, leaseId):
+        """
+        Claim the right to fold the edits of an item, or extend a claim.  A
+        claim expires, so a fold that stopped without releasing it doesn't
+        block later folds.
+
+        :param item: the item with a large image.
+        :param leaseId: an id for the claim.
+        :returns: True if the claim is held.
+        """
+        now = datetime.datetime.utcnow()
+        expires = now + datetime.timedelta(
+            seconds=float(getConfig('fold_lease_seconds', 600)))
+        return self.collection.find_one_and_update({
+            '_id': item['_id'],
+            '$or': [
+                {'largeImageFoldLease': {'$exists': False}},
+                {'largeImageFoldLease.id': leaseId},
+                {'largeImageFoldLease.expires': {'$lt': now}},
+            ]}, {'$set': {'largeImageFoldLease': {
+                'id': leaseId, 'expires': expires}}},
+            projection=['_id']) is not None
+
+    def _releaseFoldLease(self, item, leaseId):
+        self.collection.update_one(
+            {'_id': item['_id'], 'largeImageFoldLease.id': leaseId},
+            {'$unset': {'largeImageFoldLease': True}})
+
+    def foldOverlay(self, item, progress=None, reducer=None):
+        """
+        Update the coarser tiles that cover edited tiles, level by level.
+        Only the quarter of each coarser tile that covers a changed tile is
+        recomputed; the rest of the tile is kept.  The updated tiles are
+        stored in the tile overlay.
+
+        Only one fold of an item runs at a time.  If another fold is running,
+        this returns at once; that fold continues until no edits are
+        pending, so it includes edits made while it runs.
+
+        :param item: the item with a large image.
+        :param progress: an optional function called with the number of
+            levels done and the total number of levels.
+        :param reducer: one of the keys of REDUCERS, or None to use the
+            reducer that the image was converted with.  Images without a
+            known reducer use 'mode', which keeps label values.
+        :returns: the number of tiles that were updated.
+        """
+        reducer = reducer or item['largeImage'].get('reducer') or 'mode'
+        if reducer not in REDUCERS:
+            raise TileSourceException('Unknown reducer: %s' % reducer)
+        leaseId = str(ObjectId())
+        count = 0
+        # A fold that found another one running may have added the edits
+        # after that fold last checked for them, so they are checked again
+        # after the claim is released
+        while TileOverlay().pendingTiles(item):
+            if not self._acquireFoldLease(item, leaseId):
+                break
+            try:
+                while True:
+                    pending = TileOverlay().pendingTiles(item)
+                    if not pending:
+                        break
+                    count += self._foldPending(
+                        item, pending, reducer, progress, leaseId)
+            finally:
+                self._releaseFoldLease(item, leaseId)
+        return count
+
+    def _foldPending(self, item, pending, reducer, progress, leaseId):
+        """
+        Update the coarser tiles that cover a list of edited tiles.
+
+        :param item: the item with a large image.
+        :param pending: a list of (level, x, y, updated) tuples from
+            TileOverlay.pendingTiles.
+        :param reducer: one of the keys of REDUCERS.
+        :param progress: an optional function called with the number of
+            levels done and the total number of levels.
+        :param leaseId: the id of the fold claim, which is extended as each
+            level is done.
+        :returns: the number of tiles that were updated.
+        """
+        tileSource = self._loadTileSource(item)
+        tileCounts = self._checkTile(tileSource, 0, 0, 0)
+        halfWidth = tileSource.tileWidth // 2
+        halfHeight = tileSource.tileHeight // 2
+        version = self._nextOverlayVersion(item)
+        dirty = {(z, x, y) for z, x, y, _ in pending}
+        rebuilt = {}
+        levels = max(z for z, _, _ in dirty)
+        for z in range(levels, 0, -1):
+            children = sorted((x, y) for tz, x, y in dirty
+                              if tz == z and x < tileCounts[z][0] and
+                              y < tileCounts[z][1])
+            quadrants = {}
+            for x, y in children:
+                child = rebuilt.get((z, x, y))
+                if child is None:
+                    # The source may not have loaded the newest edits
+                    child = TileOverlay().getTile(item, z, x, y)
+                if child is None:
+                    child = tileSource.getTileArray(x, y, z, edits=False)
+                quadrants.setdefault((z - 1, x // 2, y // 2), []).append(
+                    (y % 2, x % 2, self._reduceQuadrant(child, reducer)))
+            for (pz, px, py), parts in quadrants.items():
+
+                def edit(parent, key=(pz, px, py), parts=parts):
+                    for qy, qx, reduced in parts:
+                        quadrant = parent[
+                            qy * halfHeight:(qy + 1) * halfHeight,
+                            qx * halfWidth:(qx + 1) * halfWidth]
+                        quadrant[...] = reduced[
+                            :quadrant.shape[0], :quadrant.shape[1]]
+                    rebuilt[key] = parent
+                    return parent
+
+                # Parents are read and stored like direct edits, so edits of
+                # the parent tiles made meanwhile are kept
+                self._editTile(item, tileSource, px, py, pz, edit, version,
+                               pending=False)
+            dirty |= set(quadrants)
+            self._acquireFoldLease(item, leaseId)
+            if progress:
+                progress(levels - z + 1, levels)
+        TileOverlay().clearPending(item, pending)
+        self._dropEditedLevels(item, {z for z, _, _ in rebuilt})
+        self._nextOverlayVersion(item)
+        return len(rebuilt)
+
+    def buildTileIndex(self, item, levels=None, progress=None):
+        """
+        Scan the levels of an item's large image and store the tile index.
+
+        :param item: the item with a large image.
+        :param levels: a list of levels to scan, or None for all of them.
+        :param progress: an optional function called with the number of
+            levels done and the total number of levels.
+        :returns: a list of the index documents that were stored.
+        """
+        tileSource = self._loadTileSource(item)
+        if not hasattr(tileSource, 'scanLevel'):
+            raise TileSourceException(
+                'This image does not support a tile index.')
+        if levels is None:
+            levels = range(tileSource.levels)
+        levels = list(levels)
+        docs = []
+        for done, level in enumerate(levels):
+            scan = tileSource.scanLevel(level)
+            doc = TileIndex().setLevel(item, level, scan) if (
+                scan is not None) else None
+            if doc is not None:
+                docs.append(doc)
+            if progress:
+                progress(done + 1, len(levels))
+        TileIndex().removeForItem(item, staleOnly=True)
+        # Other sources for this item load the new index when reopened
+        self.invalidateTileSources(item)
+        return docs
+
+    def getTileIndex(self, item, level=None, tiles=False):
+        """
+        Get the tile index of an item.
+
+        :param item: the item with a large image.
+        :param level: if not None, only get this level.
+        :param tiles: if True, include the per-tile data.
+        :returns: a list of level summaries; see TileIndex.summarize.
+        """
+        tileIndex = TileIndex()
+        return [tileIndex.summarize(doc, tiles)
+                for doc in tileIndex.getLevels(item, level)]
+
+    def getTileOccupancy(self, item, level):
+        """
+        Get which tiles of a level of an item have nonzero pixels.  If the
+        level is not in the tile index, it is scanned and added.
+
+        :param item: the item with a large image.
+        :param level: the tile level.
+        :returns: a dictionary with tilesAcross, tilesDown, and the occupancy
+            as base64 encoded bits in row-major order, most significant bit
+            first.
+        """
+        docs = TileIndex().getLevels(item, level)
+        if not docs:
+            docs = self.buildTileIndex(item, [level])
+        if not docs:
+            raise TileSourceException(
+                'No occupancy is available for level %d.' % level)
+        summary = TileIndex().summarize(docs[0], tiles=True)
+        return {key: summary[key]
+                for key in ('tilesAcross', 'tilesDown', 'occupancy')}
+
+    def scheduleTileIndex(self, item, user=None):
+        """
+        Build the tile index of an item in a Girder local job.
+
+        :param item: the item with a large image.
+        :param user: the user that owns the job.
+        :returns: the job document.
+        """
+        job = Job().createLocalJob(
+            module='girder_larger_image.jobs', function='tileIndexJob',
+            title='Tile index: %s' % item['name'], type='larger_image_index',
+            user=user, public=False, asynchronous=True,
+            kwargs={'itemId': str(item['_id']),
+                    'fileId': str(item['largeImage']['fileId'])})
+        Job().scheduleJob(job)
+        return job
+
+    def getHistogram(self, item, level=None, percentiles=DefaultPercentiles,
+                     bins=256):
+        """
+        Get the histogram of each band of a level of an item, including
+        edits.  The counts are computed the first time a level is requested
+        and stored on the item with the id of the large image file, so they
+        are recomputed if the file changes.  Edits remove the counts of the
+        levels they change.
+
+        :param item: the item with a large image.
+        :param level: the tile level, or None for the full resolution level.
+        :param percentiles: a list of percentiles to find, from 0 to 100.
+        :param bins: the number of bins in the reported histograms, or 0 for
+            none.
+        :returns: a dictionary with the level and a list of bands; see
+            summarizeHistogram.
+        """
+        tileSource = self._loadTileSource(item)
+        if not hasattr(tileSource, 'getLevelHistogram'):
+            raise TileSourceException(
+                'This image does not support histograms.')
+        if level is None:
+            level = tileSource.levels - 1
+        fileId = item['largeImage']['fileId']
+        stored = item.get('largeImageHistogram') or {}
+        current = stored.get('fileId') == fileId
+        if not current:
+            stored = {'fileId': fileId, 'levels': {}}
+        bands = stored['levels'].get(str(level))
+        if bands is None:
+            bands = packHistogram(*tileSource.getLevelHistogram(level))
+            stored['levels'][str(level)] = bands
+            # Only store the counts if the large image hasn't changed
+            query = {'_id': item['_id'], 'largeImage.fileId': fileId}
+            if current:
+                query['largeImageHistogram.fileId'] = fileId
+                update = {'largeImageHistogram.levels.%d' % level: bands}
+            else:
+                update = {'largeImageHistogram': stored}
+            self.update(query, {'$set': update})
+            item['largeImageHistogram'] = stored
+        return {
+            'level': level,
+            'bands': [summarizeHistogram(start, counts, percentiles, bins)
+                      for start, counts in unpackHistogram(bands)],
+        }
+
+    @staticmethod
+    def styleId(styleKey):
+        """
+        Get the id of a pre-rendered style.
+
+        :param styleKey: the canonical tile parameters of the style.
+        :returns: a short string that is safe to use as a field name.
+        """
+        return hashlib.sha256(styleKey.encode('utf8')).hexdigest()[:16]
+
+    def scheduleStyle(self, item, styleKey, user=None):
+        """
+        Render a style for every tile of an item in a Girder local job.
+
+        :param item: the item with a large image.
+        :param styleKey: the canonical tile parameters of the style, as
+            JSON.
+        :param user: the user that owns the job.
+        :returns: the job document.
+        """
+        job = Job().createLocalJob(
+            module='girder_larger_image.jobs', function='renderStyleJob',
+            title='Render style: %s' % item['name'], type='larger_image_style',
+            user=user, public=False, asynchronous=True,
+            kwargs={'itemId': str(item['_id']),
+                    'fileId': str(item['largeImage']['fileId']),
+                    'styleKey': styleKey})
+        Job().scheduleJob(job)
+        return job
+
+    def renderStyle(self, item, styleKey, params, user=None, progress=None):
+        """
+        Render every tile of an item with a style and attach the tiles to the
+        item as a tile store file.  A previous rendering of the style is
+        replaced.
+
+        :param item: the item with a large image.
+        :param styleKey: the canonical tile parameters of the style, as
+            JSON.
+        :param params: the tile parameters with any colormap resolved.
+        :param user: the user that owns the tile store file.
+        :param progress: an optional function called with the number of
+            tiles done and the total number of tiles.
+        :returns: the style record.
+        """
+        tileSource = self._loadTileSource(item, **params)
+        tileCounts = levelTileCounts(
+            tileSource.sizeX, tileSource.sizeY, tileSource.tileWidth,
+            tileSource.tileHeight, tileSource.levels)
+
+        def getTile(x, y, z):
+            try:
+                return self.getTile(item, x, y, z, **params)[0]
+            except TileGeneralException:
+                return None
+
+        styleId = self.styleId(styleKey)
+        fd, path = tempfile.mkstemp(suffix='.tiles')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                writeTileStore(f, tileCounts, getTile, progress)
+            with open(path, 'rb') as f:
+                storeFile = Upload().uploadFromFile(
+                    f, os.path.getsize(path),
+                    '%s.style-%s.tiles' % (item['name'], styleId),
+                    parentType='item', parent=item, user=user,
+                    mimeType='application/octet-stream')
+        finally:
+            os.unlink(path)
+        style = {
+            'key': styleKey,
+            'fileId': storeFile['_id'],
+            'largeImageFileId': item['largeImage']['fileId'],
+            'overlayVersion': item['largeImage'].get('overlayVersion'),
+            'mimeType': self.getTileMimeType(tileSource, **params),
+            'created': datetime.datetime.utcnow(),
+        }
+        item = self.load(item['_id'], force=True)
+        previous = item.get('largeImageStyles', {}).get(styleId)
+        self.update({'_id': item['_id']},
+                    {'$set': {'largeImageStyles.%s' % styleId: style}})
+        if previous:
+            oldFile = File().load(previous['fileId'], force=True)
+            if oldFile is not None:
+                File().remove(oldFile)
+        return style
+
+    def getStyles(self, item):
+        """
+        List the pre-rendered styles of an item's current large image.
+
+        :param item: the item.
+        :returns: a list of dictionaries with the style id, its tile
+            parameters, the tile mime type, and the tile store file id.
+        """
+        fileId = item.get('largeImage', {}).get('fileId')
+        return [{
+            'id': styleId,
+            'params': json.loads(style['key']),
+            'mimeType': style['mimeType'],
+            'fileId': style['fileId'],
+            'created': style['created'],
+        } for styleId, style in sorted(item.get('largeImageStyles', {}).items())
+            if style['largeImageFileId'] == fileId]
+
+    def getStyledTile(self, item, x, y, z, styleKey):
+        """
+        Read a tile from a pre-rendered style of an item.
+
+        :param item: the item.
+        :param x: the tile column.
+        :param y: the tile row.
+        :param z: the tile level.
+        :param styleKey: the canonical tile parameters of the request, as
+            JSON.
+        :returns: the tile data and its mime type, or None if the style has
+            not been rendered for the current large image or the tile is not
+            in it.
+        """
+        style = item.get('largeImageStyles', {}).get(self.styleId(styleKey))
+        largeImage = item.get('largeImage', {})
+        if (style is None or style['key'] != styleKey or
+                style['largeImageFileId'] != largeImage.get('fileId')):
+            return None
+        if style.get('overlayVersion') != largeImage.get('overlayVersion'):
+            # Only tiles edited since the style was rendered are stale
+            styleVersion = style.get('overlayVersion') or 0
+            if styleVersion <= largeImage.get('overlayReset', -1):
+                return None
+            editVersion = self.getTileEditVersion(item, x, y, z)
+            if editVersion is not None and editVersion >= styleVersion:
+                return None
+        storeFile = File().load(style['fileId'], force=True)
+        if storeFile is None:
+            return None
+        cacheKey = str(storeFile['_id'])
+        index = tileStoreCache.get(cacheKey)
+        if index is None:
+            with File().open(storeFile) as f:
+                index = TileStoreIndex(f, storeFile['size'])
+            tileStoreCache.put(cacheKey, index)
+        entry = index.lookup(x, y, z)
+        if entry is None:
+            return None
+        with File().open(storeFile) as f:
+            f.seek(entry[0])
+            return f.read(entry[1]), style['mimeType']
+
+    def removeStaleStyles(self, item):
+        """
+        Drop the pre-rendered styles that no longer apply to an item's large
+        image, either because it was replaced or removed or because its edits
+        were discarded, and remove their tile store files.
+
+        :param item: the item.
+        :returns: the number of styles removed.
+        """
+        largeImage = item.get('largeImage', {})
+        removed = 0
+        for styleId, style in item.get('largeImageStyles', {}).items():
+            if (style['largeImageFileId'] == largeImage.get('fileId') and
+                    (style.get('overlayVersion') or 0) >
+                    largeImage.get('overlayReset', -1)):
+                continue
+            # Only drop the record if it wasn't re-rendered in the meantime
+            result = self.update({
+                '_id': item['_id'],
+                'largeImageStyles.%s.fileId' % styleId: style['fileId'],
+            }, {'$unset': {'largeImageStyles.%s' % styleId: True}})
+            if not result.matched_count:
+                continue
+            tileStoreCache.removeIf(lambda k: k == str(style['fileId']))
+            storeFile = File().load(style['fileId'], force=True)
+            if storeFile is not None:
+                File().remove(storeFile)
+            removed += 1
+        return removed
+
+    @staticmethod
+    def largeImageRecord(item):
+        """
+        Get a canonical string of an item's largeImage record.  The overlay
+        versions are left out, since edits don't require reopening the file.
+
+        :param item: an item with a largeImage record.
+        :returns: a string that changes whenever the record changes.
+        """
+        return json.dumps({
+            k: v for k, v in item['largeImage'].items()
+            if k not in ('overlayVersion', 'overlayReset')},
+            sort_keys=True, default=str)
+
+    @classmethod
+    def invalidateTileSources(cls, item):
+        """
+        Discard any cached tile sources for an item.
+
+        :param item: the item whose tile sources should be discarded.
+        :returns: the number of tile sources discarded.
+        """
+        itemId = str(item['_id'])
+        return tileSourceCache.removeIf(lambda k: k[0] == itemId)
+
     def getTile(self, item, x, y, z, mayRedirect=False, **kwargs):
         tileSource = self._loadTileSource(item, **kwargs)
         tileData = tileSource.getTile(x, y, z, mayRedirect=mayRedirect,
                                       **kwargs)
-        tileMimeType = tileSource.getTileMimeType()
+        tileMimeType = self.getTileMimeType(tileSource, **kwargs)
         return tileData, tileMimeType
 
-    # def saveTile(self, item, x, y, z, data, mayRedirect=False, **kwargs):
-    #     tileSource = self._loadTileSource(item, **kwargs)
-    #     tileData = tileSource.saveTile(x, y, z, data, mayRedirect=mayRedirect)
-    #     tileMimeType = tileSource.getTileMimeType()
-    #     return tileData, tileMimeType
-    
\ No newline at end of file
+    @staticmethod
+    def getTileMimeType(tileSource, **kwargs):
+        """
+        Get the mime type of tiles from a tile source.
+
+        :param tileSource: the tile source.
+        :param kwargs: the tile processing parameters.
+        :returns: the mime type.
+        """
+        if hasattr(tileSource, 'getOutputEncoding'):
+            return TileOutputMimeTypes[tileSource.getOutputEncoding(**kwargs)]
+        return tileSource.getTileMimeType()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import base64
+import datetime
+
+import numpy
+import pymongo
+
+from girder.models.model_base import Model
+
+from ..cache_util import getConfig
+
+
+def packBits(array):
+    """
+    Pack a boolean array into bytes, most significant bit first.
+
+    :param array: a boolean array.
+    :returns: the packed bytes.
+    """
+    return numpy.packbits(array, axis=None).tobytes()
+
+
+def unpackBits(data, shape):
+    """
+    Unpack bytes packed with packBits.
+
+    :param data: the packed bytes.
+    :param shape: the shape of the original array.
+    :returns: a boolean array.
+    """
+    count = int(numpy.prod(shape))
+    bits = numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8))
+    return bits[:count].astype(bool).reshape(shape)
+
+
+class TileIndex(Model):
+    """
+    A per-tile summary of one level of an item's large image: which tiles
+    have nonzero pixels, the minimum and maximum of each tile, and, for
+    single band 8-bit images, which values each tile contains.  Each level
+    is stored in one or more documents of consecutive rows of tiles, so that
+    no document of a large level exceeds the database's document size, and
+    documents belong to a specific large image file.
+    """
+    def initialize(self):
+        self.name = 'larger_image_tile_index'
+        self.ensureIndices([
+            ([('itemId', 1), ('fileId', 1), ('level', 1), ('rowStart', 1)],
+             {'unique': True}),
+        ])
+
+    def validate(self, doc):
+        return doc
+
+    def _query(self, item, level=None):
+        query = {
+            'itemId': item['_id'],
+            'fileId': item.get('largeImage', {}).get('fileId'),
+        }
+        if level is not None:
+            query['level'] = int(level)
+        return query
+
+    def getLevels(self, item, level=None):
+        """
+        Get the stored levels of the index of an item's current large image.
+        Levels whose parts are incomplete, such as while a level is being
+        stored, are left out.
+
+        :param item: the item.
+        :param level: if not None, only get this level.
+        :returns: a list of level records, sorted by level.  Each has the
+            level, tilesAcross, tilesDown, dtype, and a list of its parts.
+        """
+        levels = []
+        for part in self.find(self._query(item, level),
+                              sort=[('level', 1), ('rowStart', 1)]):
+            if not levels or levels[-1]['level'] != part['level']:
+                levels.append({
+                    'level': part['level'],
+                    'tilesAcross': part['tilesAcross'],
+                    'tilesDown': part['levelTilesDown'],
+                    'dtype': part['dtype'],
+                    'parts': [],
+                })
+            levels[-1]['parts'].append(part)
+        return [doc for doc in levels if sum(
+            part['tilesDown'] for part in doc['parts']) == doc['tilesDown']]
+
+    def setLevel(self, item, level, scan):
+        """
+        Store the index of a level.
+
+        :param item: the item.
+        :param level: the tile level.
+        :param scan: the result of a tile source's scanLevel method.
+        :returns: the level record; see getLevels.  This is None if another
+            scan of the level replaced part of it.
+        """
+        occupancy = scan['occupancy']
+        labels = scan.get('labels')
+        tilesDown, tilesAcross = occupancy.shape
+        rowBytes = tilesAcross * (0.125 + 2 * scan['min'].dtype.itemsize + (
+            labels.shape[2] if labels is not None else 0))
+        rows = max(1, int(int(getConfig('index_part_bytes', 4 * 1024 ** 2)) //
+                          rowBytes))
+        query = self._query(item, level)
+        updated = datetime.datetime.utcnow()
+        for rowStart in range(0, tilesDown, rows):
+            rowEnd = min(tilesDown, rowStart + rows)
+            fields = {
+                'tilesDown': rowEnd - rowStart,
+                'tilesAcross': int(tilesAcross),
+                'levelTilesDown': int(tilesDown),
+                'dtype': scan['min'].dtype.str,
+                'occupancy': packBits(occupancy[rowStart:rowEnd]),
+                'min': scan['min'][rowStart:rowEnd].tobytes(),
+                'max': scan['max'][rowStart:rowEnd].tobytes(),
+                'labels': (labels[rowStart:rowEnd].tobytes()
+                           if labels is not None else None),
+                'updated': updated,
+            }
+            partQuery = dict(query, rowStart=rowStart)
+            try:
+                self.collection.update_one(
+                    partQuery, {'$set': fields}, upsert=True)
+            except pymongo.errors.DuplicateKeyError:
+                # Another scan of the same level was stored first
+                self.collection.update_one(partQuery, {'$set': fields})
+        # Parts of an earlier scan with a different split are stale
+        self.removeWithQuery(dict(query, rowStart={
+            '$nin': list(range(0, tilesDown, rows))}))
+        levels = self.getLevels(item, level)
+        return levels[0] if levels else None
+
+    def removeLevels(self, item, levels):
+        """
+        Remove levels of the index of an item's current large image, such as
+        levels that were edited.
+
+        :param item: the item.
+        :param levels: a list of tile levels.
+        """
+        query = self._query(item)
+        query['level'] = {'$in': [int(level) for level in levels]}
+        self.removeWithQuery(query)
+
+    def removeForItem(self, item, staleOnly=False):
+        """
+        Remove the index of an item.
+
+        :param item: the item.
+        :param staleOnly: if True, only remove levels that belong to a large
+            image file other than the current one.
+        """
+        query = {'itemId': item['_id']}
+        if staleOnly:
+            query['fileId'] = {
+                '$ne': item.get('largeImage', {}).get('fileId')}
+        self.removeWithQuery(query)
+
+    def arrays(self, doc):
+        """
+        Get the arrays of a level record.
+
+        :param doc: a level record from getLevels.
+        :returns: a dictionary with occupancy, min, max, and labels arrays of
+            (tilesDown, tilesAcross).  labels has an extra axis of the 256
+            possible values packed into 32 bytes, most significant bit
+            first, and is None if it was not stored.
+        """
+        dtype = numpy.dtype(doc['dtype'])
+        arrays = {'occupancy': [], 'min': [], 'max': [], 'labels': []}
+        for part in doc['parts']:
+            shape = (part['tilesDown'], part['tilesAcross'])
+            arrays['occupancy'].append(unpackBits(part['occupancy'], shape))
+            arrays['min'].append(numpy.frombuffer(
+                part['min'], dtype=dtype).reshape(shape))
+            arrays['max'].append(numpy.frombuffer(
+                part['max'], dtype=dtype).reshape(shape))
+            if part.get('labels') is not None:
+                arrays['labels'].append(numpy.frombuffer(
+                    part['labels'], dtype=numpy.uint8).reshape(shape + (32, )))
+        return {
+            'occupancy': numpy.concatenate(arrays['occupancy']),
+            'min': numpy.concatenate(arrays['min']),
+            'max': numpy.concatenate(arrays['max']),
+            'labels': (numpy.concatenate(arrays['labels'])
+                       if len(arrays['labels']) == len(doc['parts']) else None),
+        }
+
+    def summarize(self, doc, tiles=False):
+        """
+        Describe a level record for the REST API.
+
+        :param doc: a level record from getLevels.
+        :param tiles: if True, include the per-tile data as base64 strings.
+        :returns: a dictionary with the level, its size in tiles, the minimum
+            and maximum over the level, and, if known, the values present in
+            the level and the one-hot bits present in the level.
+        """
+        arrays = self.arrays(doc)
+        result = {
+            'level': doc['level'],
+            'tilesAcross': doc['tilesAcross'],
+            'tilesDown': doc['tilesDown'],
+            'occupied': int(arrays['occupancy'].sum()),
+            'min': arrays['min'].min().item(),
+            'max': arrays['max'].max().item(),
+        }
+        if arrays['labels'] is not None:
+            present = numpy.bitwise_or.reduce(
+                arrays['labels'].reshape(-1, 32), axis=0)
+            values = numpy.flatnonzero(numpy.unpackbits(present))
+            result['labels'] = values.tolist()
+            result['bits'] = [
+                bit for bit in range(1, 9)
+                if (values & (1 << (bit - 1))).any()]
+        if tiles:
+            result['dtype'] = doc['dtype']
+            data = {
+                'occupancy': packBits(arrays['occupancy']),
+                'min': arrays['min'].tobytes(),
+                'max': arrays['max'].tobytes(),
+                'labels': (arrays['labels'].tobytes()
+                           if arrays['labels'] is not None else None),
+            }
+            for key, value in data.items():
+                if value is not None:
+                    result[key] = base64.b64encode(value).decode('ascii')
+        return result
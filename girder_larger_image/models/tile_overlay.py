@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import datetime
+import zlib
+
+import numpy
+import pymongo
+
+from girder.models.model_base import Model
+
+
+class TileOverlay(Model):
+    """
+    Edited tiles of an item's large image.  The large image file is never
+    changed; tiles here are read in place of the file's tiles.  There is one
+    document per tile, with the unprocessed pixels compressed and the
+    overlay version of the item when the tile was stored.  Tiles that were
+    edited directly are pending until they have been folded into the coarser
+    levels.
+    """
+    def initialize(self):
+        self.name = 'larger_image_tile_overlay'
+        self.ensureIndices([
+            ([('itemId', 1), ('fileId', 1), ('level', 1), ('x', 1), ('y', 1)],
+             {'unique': True}),
+            ([('itemId', 1), ('pending', 1)], {}),
+        ])
+
+    def validate(self, doc):
+        return doc
+
+    def _query(self, item, level=None, x=None, y=None):
+        query = {
+            'itemId': item['_id'],
+            'fileId': item.get('largeImage', {}).get('fileId'),
+        }
+        if level is not None:
+            query.update({'level': int(level), 'x': int(x), 'y': int(y)})
+        return query
+
+    def setTile(self, item, level, x, y, array, version, pending=True,
+                previous=False):
+        """
+        Store an edited tile.
+
+        :param item: the item.
+        :param level: the tile level.
+        :param x: the tile column.
+        :param y: the tile row.
+        :param array: the unprocessed pixels of the whole tile.
+        :param version: the overlay version of the edit.  Rendered tiles are
+            cached by this value, so it must not have been used for a
+            previous edit of the item.
+        :param pending: True if the coarser levels must be updated from this
+            tile.
+        :param previous: if not False, only store the tile if the stored
+            tile has this version, or, if None, if the tile was not stored
+            before.  This detects edits made since the tile was read.
+        :returns: True if the tile was stored.
+        """
+        array = numpy.ascontiguousarray(array)
+        query = self._query(item, level, x, y)
+        fields = {
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'data': zlib.compress(array.tobytes(), 1),
+            'version': version,
+            'pending': pending,
+            'updated': datetime.datetime.utcnow(),
+        }
+        if previous is None:
+            try:
+                self.collection.insert_one(dict(query, **fields))
+            except pymongo.errors.DuplicateKeyError:
+                return False
+            return True
+        if previous is not False:
+            query['version'] = previous
+            return self.collection.update_one(
+                query, {'$set': fields}).matched_count == 1
+        try:
+            self.collection.update_one(query, {'$set': fields}, upsert=True)
+        except pymongo.errors.DuplicateKeyError:
+            self.collection.update_one(query, {'$set': fields})
+        return True
+
+    def getTile(self, item, level, x, y):
+        """
+        Get an edited tile.
+
+        :param item: the item.
+        :param level: the tile level.
+        :param x: the tile column.
+        :param y: the tile row.
+        :returns: the pixels of the tile, or None if it was not edited.
+        """
+        doc = self.findOne(self._query(item, level, x, y))
+        return self.tileArray(doc) if doc is not None else None
+
+    def getTileAndVersion(self, item, level, x, y):
+        """
+        Get an edited tile and the overlay version it was stored with.
+
+        :param item: the item.
+        :param level: the tile level.
+        :param x: the tile column.
+        :param y: the tile row.
+        :returns: the pixels of the tile and its version, or (None, None) if
+            it was not edited.
+        """
+        doc = self.findOne(self._query(item, level, x, y))
+        if doc is None:
+            return None, None
+        return self.tileArray(doc), doc.get('version')
+
+    @staticmethod
+    def tileArray(doc):
+        """
+        Get the pixels of an overlay document.
+
+        :param doc: the overlay document.
+        :returns: a read-only array.
+        """
+        return numpy.frombuffer(
+            zlib.decompress(doc['data']), dtype=numpy.dtype(doc['dtype'])
+        ).reshape(doc['shape'])
+
+    def tileKeys(self, item):
+        """
+        Get the tiles of an item's current large image that were edited.
+
+        :param item: the item.
+        :returns: a dictionary of the overlay version of each tile keyed by
+            (level, x, y) tuples.
+        """
+        return {(doc['level'], doc['x'], doc['y']): doc.get('version')
+                for doc in self.find(self._query(item),
+                                     fields=['level', 'x', 'y', 'version'])}
+
+    def pendingTiles(self, item):
+        """
+        Get the tiles whose edits have not been folded into the coarser
+        levels.
+
+        :param item: the item.
+        :returns: a list of (level, x, y, updated) tuples.
+        """
+        query = self._query(item)
+        query['pending'] = True
+        return [(doc['level'], doc['x'], doc['y'], doc['updated'])
+                for doc in self.find(query, fields=['level', 'x', 'y',
+                                                    'updated'])]
+
+    def clearPending(self, item, tiles):
+        """
+        Mark tiles as folded into the coarser levels, unless they were edited
+        again since they were listed.
+
+        :param item: the item.
+        :param tiles: a list of (level, x, y, updated) tuples from
+            pendingTiles.
+        """
+        for level, x, y, updated in tiles:
+            query = self._query(item, level, x, y)
+            query['updated'] = updated
+            self.collection.update_one(query, {'$set': {'pending': False}})
+
+    def removeForItem(self, item, staleOnly=False):
+        """
+        Remove the edited tiles of an item.
+
+        :param item: the item.
+        :param staleOnly: if True, only remove tiles that belong to a large
+            image file other than the current one.
+        """
+        query = {'itemId': item['_id']}
+        if staleOnly:
+            query['fileId'] = {
+                '$ne': item.get('largeImage', {}).get('fileId')}
+        self.removeWithQuery(query)
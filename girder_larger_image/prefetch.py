@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# Tiles that are likely to be requested next are rendered in the background
+# so that they are already in the tile caches when the viewer asks for them.
+
+import collections
+import threading
+import time
+
+from girder import logger
+
+from .cache_util import LruCache
+
+
+def predictTiles(z, x, y, tileCounts):
+    """
+    Get the tiles that are usually requested after a tile: the tiles next to
+    it and its children on the next level.
+
+    :param z: the tile level.
+    :param x: the tile column.
+    :param y: the tile row.
+    :param tileCounts: a list of (tilesAcross, tilesDown) per level.
+    :returns: a list of (z, x, y) tuples of tiles that exist.
+    """
+    candidates = [(z, x + dx, y + dy) for dx, dy in (
+        (1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (-1, 1), (1, -1), (-1, -1))]
+    candidates += [(z + 1, x * 2 + dx, y * 2 + dy)
+                   for dy in (0, 1) for dx in (0, 1)]
+    return [(tz, tx, ty) for tz, tx, ty in candidates
+            if tz < len(tileCounts) and 0 <= tx < tileCounts[tz][0] and
+            0 <= ty < tileCounts[tz][1]]
+
+
+class TilePrefetcher(object):
+    """
+    Render tiles in background threads.  Work is queued with a key that
+    identifies the result; work whose key is already done or queued is
+    skipped.  When the queue is full, the oldest work is dropped, and work
+    that waited longer than maxAge is dropped rather than done, since the
+    viewer has probably moved on.  Each item may queue at most ratePerItem
+    tiles per second.
+
+    :param workers: the number of threads.
+    :param maxQueue: the most work waiting at once.
+    :param maxAge: the longest work may wait, in seconds.
+    :param ratePerItem: the most tiles per second queued for one item.
+    :param maxTracked: the number of recently prefetched keys remembered to
+        find how many prefetched tiles are used.
+    """
+    def __init__(self, workers=4, maxQueue=256, maxAge=5, ratePerItem=64,
+                 maxTracked=4096):
+        self.workers = workers
+        self.maxAge = maxAge
+        self.ratePerItem = ratePerItem
+        self._queue = collections.deque(maxlen=maxQueue)
+        self._queued = set()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._buckets = {}
+        self._prefetched = LruCache(maxSize=maxTracked)
+        self._resetCounts()
+
+    def _resetCounts(self):
+        self.counts = collections.Counter({key: 0 for key in (
+            'queued', 'rendered', 'used', 'dropped', 'stale', 'limited',
+            'errors')})
+
+    def _allow(self, itemId, count):
+        # A token bucket per item that holds up to one second of tiles
+        now = time.time()
+        tokens, last = self._buckets.get(itemId, (self.ratePerItem, now))
+        tokens = min(self.ratePerItem,
+                     tokens + (now - last) * self.ratePerItem)
+        allowed = int(min(tokens, count))
+        self._buckets[itemId] = (tokens - allowed, now)
+        if len(self._buckets) > 1024:
+            self._buckets = {k: v for k, v in self._buckets.items()
+                             if now - v[1] < 1}
+        return allowed
+
+    def _startThreads(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._run, daemon=True,
+                                      name='larger_image prefetch')
+            thread.start()
+            self._threads.append(thread)
+
+    def schedule(self, itemId, work):
+        """
+        Queue work for an item.
+
+        :param itemId: the id of the item, for the rate limit.
+        :param work: a list of (key, func) tuples.  func is called with no
+            arguments in a background thread.
+        """
+        with self._condition:
+            work = [(key, func) for key, func in work
+                    if key not in self._queued and key not in self._prefetched]
+            allowed = self._allow(itemId, len(work))
+            self.counts['limited'] += len(work) - allowed
+            for key, func in work[:allowed]:
+                if len(self._queue) == self._queue.maxlen:
+                    self._queued.discard(self._queue[0][0])
+                    self.counts['dropped'] += 1
+                self._queue.append((key, func, time.time()))
+                self._queued.add(key)
+                self.counts['queued'] += 1
+            if allowed:
+                self._startThreads()
+                self._condition.notify(allowed)
+
+    def noteUsed(self, key):
+        """
+        Record that a tile was served from a cache, so that prefetched tiles
+        that are used are counted.
+
+        :param key: the key of the tile.
+        """
+        if self._prefetched.pop(key) is not None:
+            with self._condition:
+                self.counts['used'] += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                # The newest work is the most likely to still be wanted
+                key, func, queued = self._queue.pop()
+                self._queued.discard(key)
+                if time.time() - queued > self.maxAge:
+                    self.counts['stale'] += 1
+                    continue
+            try:
+                if func() is not False:
+                    self._prefetched.put(key, True)
+                    with self._condition:
+                        self.counts['rendered'] += 1
+            except Exception:
+                logger.exception('Failed to prefetch a tile')
+                with self._condition:
+                    self.counts['errors'] += 1
+
+    def stats(self):
+        """
+        Report the prefetch counts.
+
+        :returns: a dictionary with the number of tiles queued, rendered,
+            used, dropped because the queue was full, dropped because they
+            waited too long, refused by the rate limit, and failed, and the
+            current queue length.
+        """
+        with self._condition:
+            result = dict(self.counts)
+            result['size'] = len(self._queue)
+        return result
+
+    def clear(self):
+        with self._condition:
+            self._queue.clear()
+            self._queued.clear()
+            self._resetCounts()
+        self._prefetched.clear()
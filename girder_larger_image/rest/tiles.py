@@ -1,7 +1,20 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import cherrypy
+import functools
+import hashlib
+import json
 import pathlib
+import time
+import types
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from six import BytesIO
+
+import numpy
+
+import PIL.Image
 
 from girder.api import access, filter_logging
 from girder.api.v1.item import Item as ItemResource
@@ -22,11 +35,241 @@ try:
 except ImportError:
     Colormap = None
 
-from ..models.larger_image_item import LargerImageItem
+from ..cache_util import LruCache, clearCaches, createTileCache, \
+    getCacheStats, getConfig, registerCache
+from ..models.larger_image_item import LargerImageItem, SourceKwargs
+from ..create_tiff import REDUCERS
+from ..tilesource.region import StreamingEncodings, getRegionPlan, \
+    processRegion, streamRegion
+from ..tilesource.composite import getCompositeTile
+from ..tilesource.histogram import DefaultPercentiles
+from ..tilesource.tiff import ProcessingParams, TiffFileTileSource
+from ..tilesource.tilestore import levelTileCounts
+from ..prefetch import TilePrefetcher, predictTiles
 
 
 from large_image.constants import TileInputUnits
 
+# How long browsers may use a tile without checking its ETag, in seconds
+TileMaxAge = 600
+
+# Encoded tiles from the extended zxy endpoint
+tileResultCache = createTileCache()
+if tileResultCache is not None:
+    registerCache('tileresult', tileResultCache)
+
+# Renders the tiles around requested tiles in the background, if enabled
+tilePrefetcher = None
+if str(getConfig('prefetch', False)).lower() in ('true', '1', 'yes'):
+    tilePrefetcher = registerCache('prefetch', TilePrefetcher(
+        workers=int(getConfig('prefetch_threads', 4)),
+        maxQueue=int(getConfig('prefetch_queue_size', 256)),
+        maxAge=float(getConfig('prefetch_max_age', 5)),
+        ratePerItem=float(getConfig('prefetch_rate', 64))))
+
+# Resolved colormaps by id.  Entries are dropped when a colormap is saved or
+# removed in this process and reloaded after colormap_cache_max_age seconds to
+# pick up changes made by other processes.
+colormapCache = registerCache('colormap', LruCache(maxSize=64))
+
+
+def _loadColormap(colormapId):
+    """
+    Get a colormap in the forms used by tile processing.
+
+    :param colormapId: the id of the colormap.
+    :returns: a dictionary with the colormap 'version', the 'palette' as
+        bytes (None if the colormap has no binary form), and the 'colors' as
+        a tuple of RGB tuples.
+    """
+    entry = colormapCache.get(colormapId)
+    maxAge = float(getConfig('colormap_cache_max_age', 60))
+    if entry is None or time.time() - entry['loaded'] > maxAge:
+        colormap = Colormap().load(colormapId, force=True, exc=True)
+        try:
+            palette = bytes(colormap['binary'])
+        except (KeyError, TypeError):
+            palette = None
+        colors = tuple(tuple(color) for color in
+                       colormap.get('colormap') or ())
+        # The version is a hash of the content, since colormaps don't always
+        # record when they were changed
+        entry = {
+            'loaded': time.time(),
+            'version': hashlib.sha1(json.dumps(
+                [palette.hex() if palette is not None else None, colors],
+                default=str).encode('utf8')).hexdigest(),
+            'palette': palette,
+            'colors': colors,
+        }
+        colormapCache.put(colormapId, entry)
+    return entry
+
+
+def applyColormap(params, colormap):
+    """
+    Replace the colormap id and version in tile parameters with the colormap
+    in the form used by the tile source.
+
+    :param params: the parsed tile parameters.  Modified.
+    :param colormap: the colormap from _loadColormap or None.
+    """
+    if colormap is None:
+        return
+    del params['colormapId']
+    del params['colormapVersion']
+    if 'bit' in params or 'bits' in params:
+        params['colormap'] = colormap['colors']
+    else:
+        # TODO: abstract in colormap
+        if colormap['palette'] is None:
+            raise RestException('Invalid colormap on server', code=500)
+        params['colormap'] = colormap['palette']
+
+
+def invalidateColormap(event):
+    """
+    Drop a saved or removed colormap from the colormap cache.
+
+    :param event: a Girder event whose info is the colormap document.
+    """
+    colormapCache.pop(str(event.info['_id']))
+
+
+# Tile processing parameters and their types
+TileParamTypes = [
+    ('normalize', bool),
+    ('normalizeMin', float),
+    ('normalizeMax', float),
+    ('label', bool),
+    ('invertLabel', bool),
+    ('flattenLabel', bool),
+    ('oneHot', bool),
+    ('bit', int),
+]
+
+# The most tiles that can be requested in one batch
+MaxBatchTiles = 1024
+
+# The most overlay layers in one composite tile
+MaxCompositeLayers = 16
+
+# Reads the layers of composite tiles in parallel
+compositeExecutor = ThreadPoolExecutor(
+    max_workers=int(getConfig('composite_threads', 8)))
+
+
+def _parseBits(value):
+    """
+    Parse the bits parameter of a tile request.
+
+    :param value: a JSON list of objects, each with a 'bit' from 0 to 8, and
+        optionally a 'color' as '#rrggbb' or [r, g, b] and an 'opacity' from 0
+        to 1.
+    :returns: a list of [bit, color, opacity] lists.  The color is a list of
+        three integers or None.
+    """
+    try:
+        layers = []
+        for layer in json.loads(value):
+            bit = int(layer['bit'])
+            color = layer.get('color')
+            if isinstance(color, str):
+                color = color.lstrip('#')
+                if len(color) != 6:
+                    raise ValueError('Invalid color')
+                color = [int(color[i:i + 2], 16) for i in (0, 2, 4)]
+            elif color is not None:
+                color = [int(c) for c in color]
+                if len(color) != 3 or not all(0 <= c <= 255 for c in color):
+                    raise ValueError('Invalid color')
+            opacity = float(layer.get('opacity', 1))
+            if not 0 <= bit <= 8 or not 0 <= opacity <= 1:
+                raise ValueError('Invalid bit or opacity')
+            layers.append([bit, color, opacity])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise RestException(
+            'The "bits" parameter must be a JSON list of objects with a "bit" '
+            'from 0 to 8 and an optional "color" and "opacity".')
+    return layers
+
+
+# Tile parameters that are part of a pre-rendered style
+StyleParams = tuple(k for k in ProcessingParams if k != 'colormap') + (
+    'colormapId', 'colormapVersion') + SourceKwargs
+
+
+def styleKey(params):
+    """
+    Get the key of the pre-rendered style matching a tile request.
+
+    :param params: the parsed request parameters, with the colormap version
+        from _loadTileColormap.
+    :returns: a JSON string that is the same for equivalent requests.
+    """
+    return json.dumps({k: params[k] for k in StyleParams if k in params},
+                      sort_keys=True, default=str)
+
+
+def _readImageBody(mask=False):
+    """
+    Decode the image in the body of a request.
+
+    :param mask: if True, read the image as a mask.  Palette images are
+        converted to their colors, and the mask is the alpha channel if there
+        is one, or else where any band is nonzero.
+    :returns: the pixels as a numpy array.  A mask has two dimensions.
+    """
+    data = cherrypy.request.body.read()
+    try:
+        image = PIL.Image.open(BytesIO(data))
+        image.load()
+    except (IOError, OSError, ValueError):
+        raise RestException('The request body must be a PNG or TIFF image.')
+    if not mask:
+        return numpy.asarray(image)
+    if image.mode in ('P', 'PA'):
+        image = image.convert('RGBA' if image.mode == 'PA' or (
+            'transparency' in image.info) else 'RGB')
+    array = numpy.asarray(image)
+    if array.ndim == 3:
+        bands = image.getbands()
+        if 'A' in bands:
+            array = array[:, :, bands.index('A')]
+        else:
+            array = array.any(axis=2)
+    return array
+
+
+def _tileCoordinates(z, x, y):
+    try:
+        x, y, z = int(x), int(y), int(z)
+    except ValueError:
+        raise RestException('x, y, and z must be integers', code=400)
+    if x < 0 or y < 0 or z < 0:
+        raise RestException('x, y, and z must be positive integers',
+                            code=400)
+    return z, x, y
+
+
+def _tileResultKey(item, z, x, y, params):
+    """
+    Get the rendered-tile cache key for a tile request.
+
+    :param item: the item with the tile.
+    :param z: tile layer number.
+    :param x: the X coordinate of the tile.
+    :param y: the Y coordinate of the tile.
+    :param params: the parsed request parameters.
+    :returns: a string that is the same for equivalent requests.  It
+        includes the overlay version of the tile, so editing a tile changes
+        only its own key.
+    """
+    largeImage = item.get('largeImage', {})
+    return json.dumps([
+        str(item['_id']), str(largeImage.get('fileId')),
+        LargerImageItem().getTileEditVersion(item, x, y, z), z, x, y, params],
+        sort_keys=True, default=str)
 
 
 class TilesItemResource(TilesItemResource):
@@ -38,12 +281,39 @@ class TilesItemResource(TilesItemResource):
                            self.createTiles)
         apiRoot.item.route('GET', (':itemId', 'tiles', 'extended', 'zxy', ':z', ':x', ':y'),
                            self.getTile)
+        apiRoot.item.route('POST', (':itemId', 'tiles', 'extended', 'batch'),
+                           self.getTileBatch)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'extended', 'occupancy'),
+                           self.getTileOccupancy)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'extended', 'index'),
+                           self.getTileIndex)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'extended', 'histogram'),
+                           self.getHistogram)
+        apiRoot.item.route('POST', (':itemId', 'tiles', 'extended', 'index'),
+                           self.createTileIndex)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'extended', 'styles'),
+                           self.getStyles)
+        apiRoot.item.route('POST', (':itemId', 'tiles', 'extended', 'styles'),
+                           self.createStyle)
+        apiRoot.item.route('GET', (':itemId', 'tiles', 'extended', 'composite',
+                                   ':z', ':x', ':y'),
+                           self.getCompositeTile)
         # remove and replace original get region route
         apiRoot.item.removeRoute('GET', (':itemId', 'tiles', 'region'))
         apiRoot.item.route('GET', (':itemId', 'tiles', 'extended', 'region'),
                            self.getTilesRegion)
-        # apiRoot.item.route('POST', (':itemId', 'tiles', 'extended', 'zxy', ':z', ':x', ':y'),
-        # self.saveTile)
+        apiRoot.item.route('POST', (':itemId', 'tiles', 'extended', 'zxy', ':z', ':x', ':y'),
+                           self.saveTile)
+        apiRoot.item.route('POST', (':itemId', 'tiles', 'extended', 'region', 'mask'),
+                           self.saveRegionMask)
+        apiRoot.item.route('DELETE', (':itemId', 'tiles', 'extended', 'edits'),
+                           self.discardEdits)
+        apiRoot.folder.route('POST', (':folderId', 'tiles', 'extended'),
+                             self.createFolderTiles)
+        apiRoot.item.route('GET', ('tiles', 'extended', 'cache'),
+                           self.getCacheInfo)
+        apiRoot.item.route('DELETE', ('tiles', 'extended', 'cache'),
+                           self.clearCache)
         filter_logging.addLoggingFilter(
             'GET (/[^/ ?#]+)*/item/[^/ ?#]+/tiles/zxy(/[^/ ?#]+){3}',
             frequency=250)
@@ -66,6 +336,14 @@ class TilesItemResource(TilesItemResource):
         .param('compression', 'The image compression type.',
                required=False, default='JPEG',
                enum=['none', 'JPEG', 'Deflate', 'PackBits', 'LZW'])
+        .param('concurrency', 'The number of threads or processes used to '
+               'convert the image.  By default, all CPUs are used.',
+               dataType='int', required=False)
+        .param('reducer', 'How lower resolution levels are computed.  Use '
+               '"mode" for label images and "or" for one-hot encoded label '
+               'images so that the levels only contain valid labels.',
+               required=False, default='mean',
+               enum=sorted(REDUCERS))
     )
     @access.user
     @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.WRITE)
@@ -88,11 +366,92 @@ class TilesItemResource(TilesItemResource):
             return self.imageItemModel.createImageItem(
                 item, largeImageFile, user, token,
                 notify=self.boolParam('notify', params, default=True),
-                quality=params.get('quality', 90), tileSize=params.get('tileSize', 256),
-                compression=params.get('compression', 'jpeg').lower())
+                **self._conversionParams(params))
         except TileGeneralException as e:
             raise RestException(e.args[0])
 
+    def _conversionParams(self, params):
+        kwargs = {
+            'quality': params.get('quality', 90),
+            'tileSize': params.get('tileSize', 256),
+            'compression': params.get('compression', 'jpeg').lower(),
+        }
+        if params.get('concurrency'):
+            kwargs['concurrency'] = int(params['concurrency'])
+        reducer = params.get('reducer', 'mean')
+        if reducer not in REDUCERS:
+            raise RestException('Unknown reducer: %s' % reducer)
+        if reducer != 'mean':
+            kwargs['reducer'] = reducer
+        return kwargs
+
+    @describeRoute(
+        Description('Create large images for the items of a folder.')
+        .notes('Items that already have a large image or that do not have '
+               'exactly one image file are skipped.  Files that a tile '
+               'source can read are used directly; other files are '
+               'converted in jobs, with no more than maxConversions of them '
+               'unfinished at a time.  This runs in a job.')
+        .param('folderId', 'The ID of the folder.', paramType='path')
+        .param('recursive', 'Also import the folders in the folder.',
+               dataType='boolean', default=False, required=False)
+        .param('maxConversions', 'The maximum number of conversion jobs that '
+               'are unfinished at a time.', dataType='int', required=False)
+        .param('priority', 'The queue priority of conversion tasks, from 0 '
+               'to 9.', dataType='int', required=False)
+        .param('quality', 'The quality of JPEG compression.',
+               dataType='int', default=100, required=False)
+        .param('tileSize', 'The tile Size of WSI.',
+               dataType='int', default=256, required=False)
+        .param('compression', 'The image compression type.',
+               required=False, default='JPEG',
+               enum=['none', 'JPEG', 'Deflate', 'PackBits', 'LZW'])
+        .param('concurrency', 'The number of threads or processes used to '
+               'convert each image.  By default, all CPUs are used.',
+               dataType='int', required=False)
+        .param('reducer', 'How lower resolution levels are computed.',
+               required=False, default='mean', enum=sorted(REDUCERS))
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write access was denied for the folder.', 403)
+    )
+    @access.user
+    @loadmodel(model='folder', map={'folderId': 'folder'},
+               level=AccessType.WRITE)
+    @filtermodel(model='job', plugin='jobs')
+    def createFolderTiles(self, folder, params):
+        try:
+            maxConversions = int(params.get('maxConversions') or getConfig(
+                'import_max_conversions', 4))
+            priority = (int(params['priority'])
+                        if params.get('priority') not in (None, '') else None)
+        except ValueError:
+            raise RestException(
+                'The maxConversions and priority must be integers.')
+        if maxConversions < 1:
+            raise RestException('The maxConversions must be at least 1.')
+        return self.imageItemModel.scheduleFolderImport(
+            folder, self.getCurrentUser(),
+            recursive=self.boolParam('recursive', params, default=False),
+            mimeTypes=list(ImageMimeTypes), maxConversions=maxConversions,
+            priority=priority, **self._conversionParams(params))
+
+    @describeRoute(
+        Description('Get hit and miss counts of the extended tile caches.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    @access.admin
+    def getCacheInfo(self, params):
+        return getCacheStats()
+
+    @describeRoute(
+        Description('Clear the extended tile caches.')
+        .errorResponse('Admin access was denied.', 403)
+    )
+    @access.admin
+    def clearCache(self, params):
+        clearCaches()
+        return getCacheStats()
+
     @describeRoute(
         Description('Get a large image tile.')
         .param('itemId', 'The ID of the item.', paramType='path')
@@ -126,6 +485,11 @@ class TilesItemResource(TilesItemResource):
                required=False, dataType='boolean', default=False)
         .param('bit', 'One-hot encoded bit.',
                required=False, dataType='int')
+        .param('bits', 'Composite several one-hot encoded bits into one RGBA '
+               'image.  A JSON list of objects, each with a "bit" and an '
+               'optional "color" ("#rrggbb" or [r, g, b]; by default, from '
+               'the colormap) and "opacity" (0 to 1, default 1).  Later bits '
+               'are drawn over earlier ones.', required=False)
         .param('colormapId', 'ID of colormap to apply to image.',
                required=False)
         .produces(ImageMimeTypes)
@@ -143,115 +507,723 @@ class TilesItemResource(TilesItemResource):
     #       return self._getTile(item, z, x, y, params, True)
     @access.public(cookie=True) # access.cookie always looks up the token
     def getTile(self, itemId, z, x, y, params):
-        _adjustParams(params)
         item = loadmodelcache.loadModel(
             self, 'item', id=itemId, allowCookie=True, level=AccessType.READ)
         # Explicitly set a expires time to encourage browsers to cache this for
         # a while.
         setResponseHeader('Expires', cherrypy.lib.httputil.HTTPDate(
-            cherrypy.serving.response.time + 600))
+            cherrypy.serving.response.time + TileMaxAge))
         redirect = params.get('redirect', False)
         if redirect not in ('any', 'exact', 'encoding'):
             redirect = False
-        typeList = [
-            ('normalize', bool),
-            ('normalizeMin', float),
-            ('normalizeMax', float),
-            ('label', bool),
-            ('invertLabel', bool),
-            ('flattenLabel', bool),
-            ('oneHot', bool),
-            ('bit', int),
-        ]
-        params = self._parseParams(params, True, typeList)
+        params = self._parseTileParams(params)
+        z, x, y = _tileCoordinates(z, x, y)
+        colormap = self._loadTileColormap(params)
+        tileKey = _tileResultKey(item, z, x, y, params)
+        _handleETag('getTile', item, tileKey, max_age=TileMaxAge)
+        cacheKey = None
+        if tileResultCache is not None:
+            cacheKey = tileKey
+            cached = tileResultCache.get(cacheKey)
+            if cached is not None:
+                if tilePrefetcher is not None:
+                    tilePrefetcher.noteUsed(cacheKey)
+                    self._prefetchAround(item, z, x, y, params, colormap)
+                setResponseHeader('Content-Type', cached[1])
+                setRawResponse()
+                return cached[0]
+        if item.get('largeImageStyles'):
+            styled = self.imageItemModel.getStyledTile(
+                item, x, y, z, styleKey(params))
+            if styled is not None:
+                setResponseHeader('Content-Type', styled[1])
+                setRawResponse()
+                return styled[0]
+        if tilePrefetcher is not None:
+            self._prefetchAround(item, z, x, y, params, colormap)
+        self._applyTileColormap(params, colormap)
+        return self._getExtendedTile(item, z, x, y, params,
+                                     mayRedirect=redirect, cacheKey=cacheKey)
 
+    def _prefetchAround(self, item, z, x, y, params, colormap):
+        """
+        Queue the tiles that are likely to be requested after a tile to be
+        rendered with the same parameters in the background.  This warms the
+        tile source's cache and the rendered tile cache.
+
+        :param item: the item with the tile.
+        :param z: tile layer number.
+        :param x: the X coordinate of the tile.
+        :param y: the Y coordinate of the tile.
+        :param params: the parsed request parameters, before the colormap is
+            applied.
+        :param colormap: the colormap from _loadTileColormap or None.
+        """
+        params = dict(params)
+        try:
+            tileSource = self.imageItemModel._loadTileSource(item, **params)
+        except TileGeneralException:
+            return
+        tileCounts = levelTileCounts(
+            tileSource.sizeX, tileSource.sizeY, tileSource.tileWidth,
+            tileSource.tileHeight, tileSource.levels)
+
+        def render(tz, tx, ty, key):
+            if (tileResultCache is not None and
+                    tileResultCache.get(key) is not None):
+                return False
+            imageArgs = dict(params)
+            applyColormap(imageArgs, colormap)
+            tileData, tileMime = self.imageItemModel.getTile(
+                item, tx, ty, tz, **imageArgs)
+            if tileResultCache is not None and isinstance(tileData, bytes):
+                tileResultCache.set(key, tileData, tileMime)
+
+        work = []
+        for tz, tx, ty in predictTiles(z, x, y, tileCounts):
+            key = _tileResultKey(item, tz, tx, ty, params)
+            work.append((key, functools.partial(render, tz, tx, ty, key)))
+        tilePrefetcher.schedule(str(item['_id']), work)
+
+    def _parseTileParams(self, params, paramTypes=()):
+        """
+        Parse the tile processing parameters of a request.
+
+        :param params: the request parameters.
+        :param paramTypes: a list of other parameters to parse, in the form
+            used by _parseParams.
+        :returns: the parsed parameters.
+        """
+        _adjustParams(params)
+        params = self._parseParams(params, True,
+                                   list(paramTypes) + TileParamTypes)
         if 'exclude' in params:
             # TODO: error handling
             params['exclude'] = [int(s) for s in params['exclude'].split(',')]
-        if Colormap and 'colormapId' in params:
-            # colormap = Colormap().load(params['colormapId'],
-            #                            force=True, exc=True)
-            #                            user=self.getCurrentUser(),
-            #                            level=AccessType.READ)
-            colormap = Colormap().load(params['colormapId'],
-                                       force=True, exc=True)
-            del params['colormapId']
+        if 'bits' in params:
             if 'bit' in params:
-                params['colormap'] = colormap['colormap']
-            else:
-                # TODO: abstract in colormap
-                try:
-                    params['colormap'] = bytearray(colormap['binary'])
-                except (KeyError, TypeError):
-                    raise RestException('Invalid colormap on server',
-                                        code=500)
-        return self._getTile(item, z, x, y, params, mayRedirect=redirect)
-
-    # @describeRoute(
-    #     Description('Get a large image tile.')
-    #     .param('itemId', 'The ID of the item.', paramType='path')
-    #     .param('z', 'The layer number of the tile (0 is the most zoomed-out '
-    #            'layer).', paramType='path')
-    #     .param('x', 'The X coordinate of the tile (0 is the left side).',
-    #            paramType='path')
-    #     .param('y', 'The Y coordinate of the tile (0 is the top).',
-    #            paramType='path')
-    #     .param('data', 'data need to be saved.',
-    #            paramType='path')
-    #     .param('redirect', 'If the tile exists as a complete file, allow an '
-    #            'HTTP redirect instead of returning the data directly.  The '
-    #            'redirect might not have the correct mime type.  "exact" must '
-    #            'match the image encoding and quality parameters, "encoding" '
-    #            'must match the image encoding but disregards quality, and '
-    #            '"any" will redirect to any image if possible.', required=False,
-    #            enum=['false', 'exact', 'encoding', 'any'], default='false')
-    #     .produces(ImageMimeTypes)
-    #     .errorResponse('ID was invalid.')
-    #     .errorResponse('Read access was denied for the item.', 403)
-    # )
-    # @access.public
-    # def saveTile(self, itemId, z, x, y, params):
-    #     _adjustParams(params)
-    #     item = loadmodelcache.loadModel(
-    #         self, 'item', id=itemId, allowCookie=True, level=AccessType.READ)
-    #     # Explicitly set a expires time to encourage browsers to cache this for
-    #     # a while.
-    #     setResponseHeader('Expires', cherrypy.lib.httputil.HTTPDate(
-    #         cherrypy.serving.response.time + 600))
-    #     redirect = params.get('redirect', False)
-    #     if redirect not in ('any', 'exact', 'encoding'):
-    #         redirect = False
-    #     data = []
-    #     return self._saveTile(item, z, x, y, data, params, mayRedirect=redirect)
-
-    # def _saveTile(self, item, z, x, y, data, imageArgs, mayRedirect=False):
-    #     """
-    #     Get an large image tile.
-
-    #     :param item: the item to get a tile from.
-    #     :param z: tile layer number (0 is the most zoomed-out).
-    #     .param x: the X coordinate of the tile (0 is the left side).
-    #     .param y: the Y coordinate of the tile (0 is the top).
-    #     :param imageArgs: additional arguments to use when fetching image data.
-    #     :param mayRedirect: if True or one of 'any', 'encoding', or 'exact',
-    #         allow return a response whcih may be a redirect.
-    #     :return: a function that returns the raw image data.
-    #     """
-    #     try:
-    #         x, y, z = int(x), int(y), int(z)
-    #     except ValueError:
-    #         raise RestException('x, y, and z must be integers', code=400)
-    #     if x < 0 or y < 0 or z < 0:
-    #         raise RestException('x, y, and z must be positive integers',
-    #                             code=400)
-    #     try:
-    #         tileData, tileMime = self.imageItemModel.saveTile(
-    #             item, x, y, z, data, mayRedirect=mayRedirect, **imageArgs)
-    #     except TileGeneralException as e:
-    #         raise RestException(e.args[0], code=404)
-    #     setResponseHeader('Content-Type', tileMime)
-    #     setRawResponse()
-    #     return tileData
+                raise RestException('Only one of "bit" and "bits" may be '
+                                    'specified.')
+            params['bits'] = _parseBits(params['bits'])
+        return params
+
+    def _loadTileColormap(self, params):
+        """
+        Resolve the colormapId parameter, if any.  The colormap version is
+        added to the parameters so that it is part of the tile keys.
+
+        :param params: the parsed request parameters.  Modified.
+        :returns: the colormap from _loadColormap or None.
+        """
+        if not Colormap or 'colormapId' not in params:
+            return None
+        colormap = _loadColormap(params['colormapId'])
+        params['colormapVersion'] = colormap['version']
+        return colormap
+
+    def _applyTileColormap(self, params, colormap):
+        """
+        Replace the colormap id and version in the parameters with the
+        colormap in the form used by the tile source.
+
+        :param params: the parsed request parameters.  Modified.
+        :param colormap: the colormap from _loadTileColormap or None.
+        """
+        applyColormap(params, colormap)
+
+    @describeRoute(
+        Description('Get the tile index of a large image.')
+        .notes('The index is built by a job when a large image is added to '
+               'an item.  For each level, it has the number of tiles with '
+               'nonzero pixels, the minimum and maximum values, and, for '
+               'single band 8-bit images, the values and one-hot bits that '
+               'are present.  The minimum and maximum can be used for '
+               'normalizeMin and normalizeMax.  Per-tile data is base64 '
+               'encoded in row-major order: occupancy and labels as bits, '
+               'most significant first (labels has 256 bits per tile), and '
+               'min and max as arrays of dtype.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('level', 'Only get this level.', required=False,
+               dataType='int')
+        .param('tiles', 'Include the per-tile data.', required=False,
+               dataType='boolean', default=False)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.public(cookie=True)
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getTileIndex(self, item, params):
+        level = params.get('level')
+        try:
+            level = int(level) if level is not None else None
+        except ValueError:
+            raise RestException('The level must be an integer.')
+        return self.imageItemModel.getTileIndex(
+            item, level, self.boolParam('tiles', params, default=False))
+
+    @describeRoute(
+        Description('Rebuild the tile index of a large image.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write access was denied for the item.', 403)
+    )
+    @access.user
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.WRITE)
+    @filtermodel(model='job', plugin='jobs')
+    def createTileIndex(self, item, params):
+        if not item.get('largeImage', {}).get('fileId') or item[
+                'largeImage'].get('expected'):
+            raise RestException('The item does not have a large image.')
+        return self.imageItemModel.scheduleTileIndex(
+            item, self.getCurrentUser())
+
+    @describeRoute(
+        Description('List the pre-rendered styles of a large image.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.public(cookie=True)
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getStyles(self, item, params):
+        return self.imageItemModel.getStyles(item)
+
+    @describeRoute(
+        Description('Pre-render a style for every tile of a large image.')
+        .notes('A job renders every tile with the given processing parameters '
+               'and stores them in a file attached to the item.  Afterwards, '
+               'extended zxy requests with exactly these parameters read the '
+               'stored tile instead of rendering it.  The stored tiles are '
+               'always returned directly, since a tile is a byte range of a '
+               'shared file and cannot be redirected to.  A style stops '
+               'being used when the large image or the colormap changes.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('normalize', 'Normalize image intensity (single band only).',
+               required=False, dataType='boolean', default=False)
+        .param('normalizeMin', 'Minimum threshold intensity.',
+               required=False, dataType='float')
+        .param('normalizeMax', 'Maximum threshold intensity.',
+               required=False, dataType='float')
+        .param('label', 'Return label images (single band only).',
+               required=False, dataType='boolean', default=False)
+        .param('invertLabel', 'Invert label values for transparency.',
+               required=False, dataType='boolean', default=True)
+        .param('flattenLabel', 'Ignore values for transparency.',
+               required=False, dataType='boolean', default=False)
+        .param('exclude', 'Label values to exclude.', required=False)
+        .param('oneHot', 'Label values are one-hot encoded.',
+               required=False, dataType='boolean', default=False)
+        .param('bit', 'One-hot encoded bit.',
+               required=False, dataType='int')
+        .param('bits', 'Composite several one-hot encoded bits into one RGBA '
+               'image.  See the extended zxy endpoint.', required=False)
+        .param('colormapId', 'ID of colormap to apply to image.',
+               required=False)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write access was denied for the item.', 403)
+    )
+    @access.user
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.WRITE)
+    @filtermodel(model='job', plugin='jobs')
+    def createStyle(self, item, params):
+        if not item.get('largeImage', {}).get('fileId') or item[
+                'largeImage'].get('expected'):
+            raise RestException('The item does not have a large image.')
+        params = self._parseTileParams(params)
+        self._loadTileColormap(params)
+        key = styleKey(params)
+        if key == styleKey({}):
+            raise RestException('A style needs processing parameters.')
+        return self.imageItemModel.scheduleStyle(
+            item, key, self.getCurrentUser())
+
+    @describeRoute(
+        Description('Get which tiles of a level have nonzero pixels.')
+        .notes('The level is scanned the first time this is requested.  The '
+               'result is stored with the item and lets the tile endpoints '
+               'answer empty tiles without reading them.  Clients can use it '
+               'to skip requesting empty tiles of label images.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('level', 'The tile level (0 is the most zoomed-out level).',
+               dataType='int')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.public(cookie=True)
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getTileOccupancy(self, item, params):
+        self.requireParams('level', params)
+        try:
+            level = int(params['level'])
+        except ValueError:
+            raise RestException('The level must be an integer.')
+        setResponseTimeLimit(86400)
+        try:
+            occupancy = self.imageItemModel.getTileOccupancy(item, level)
+        except TileGeneralException as e:
+            raise RestException(e.args[0])
+        return dict(occupancy, level=level)
+
+    @describeRoute(
+        Description('Get the histogram of each band of a level.')
+        .notes('The counts are computed in a pool of processes the first '
+               'time a level is requested and are stored with the item until '
+               'its large image file changes.  The values at percentiles '
+               'such as 2 and 98 are suitable for normalizeMin and '
+               'normalizeMax.  Only 8 and 16-bit integer images are '
+               'supported.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('level', 'The tile level (0 is the most zoomed-out level).  '
+               'This defaults to the full resolution level.', required=False,
+               dataType='int')
+        .param('percentiles', 'A JSON list of percentiles from 0 to 100.',
+               required=False, default=json.dumps(list(DefaultPercentiles)))
+        .param('bins', 'The number of bins in each reported histogram, or 0 '
+               'for none.  The bins span the minimum to maximum values.',
+               required=False, dataType='int', default=256)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+    )
+    @access.public(cookie=True)
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
+    def getHistogram(self, item, params):
+        try:
+            level = int(params['level']) if params.get(
+                'level') is not None else None
+            bins = int(params.get('bins', 256))
+        except ValueError:
+            raise RestException('The level and bins must be integers.')
+        if not 0 <= bins <= 65536:
+            raise RestException('The bins must be from 0 to 65536.')
+        percentiles = DefaultPercentiles
+        if params.get('percentiles'):
+            try:
+                percentiles = [float(p) for p in json.loads(
+                    params['percentiles'])]
+            except (ValueError, TypeError):
+                raise RestException('The percentiles must be a JSON list.')
+            if not all(0 <= p <= 100 for p in percentiles):
+                raise RestException(
+                    'The percentiles must be from 0 to 100.')
+        setResponseTimeLimit(86400)
+        try:
+            return self.imageItemModel.getHistogram(
+                item, level, percentiles, bins)
+        except TileGeneralException as e:
+            raise RestException(e.args[0])
+        except NotImplementedError as e:
+            raise RestException(e.args[0])
+
+    @describeRoute(
+        Description('Get a tile of an item with other items drawn over it.')
+        .notes('The overlay items must have the same tiling as the base item, '
+               'as registered images do.  The layers are read in parallel '
+               'and composited in order.  An overlay without the requested '
+               'tile is skipped.  The processing parameters apply to the base '
+               'item; each overlay has its own.')
+        .param('itemId', 'The ID of the base item.', paramType='path')
+        .param('z', 'The layer number of the tile (0 is the most zoomed-out '
+               'layer).', paramType='path')
+        .param('x', 'The X coordinate of the tile (0 is the left side).',
+               paramType='path')
+        .param('y', 'The Y coordinate of the tile (0 is the top).',
+               paramType='path')
+        .param('layers', 'A JSON list of overlays, bottom first.  Each is an '
+               'object with an "itemId", an optional "opacity" from 0 to 1, '
+               'and any of the processing parameters, such as "label", '
+               '"bit", "bits", or "colormapId".', required=True)
+        .param('encoding', 'The output encoding.  JPEG discards '
+               'transparency.', required=False, enum=['PNG', 'JPEG'],
+               default='PNG')
+        .param('normalize', 'Normalize image intensity (single band only).',
+               required=False, dataType='boolean', default=False)
+        .param('label', 'Return label images (single band only).',
+               required=False, dataType='boolean', default=False)
+        .param('colormapId', 'ID of colormap to apply to image.',
+               required=False)
+        .produces(['image/png', 'image/jpeg'])
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for an item.', 403)
+        .errorResponse('Invalid colormap on server.', 500)
+    )
+    @access.public(cookie=True)
+    def getCompositeTile(self, itemId, z, x, y, params):
+        item = loadmodelcache.loadModel(
+            self, 'item', id=itemId, allowCookie=True, level=AccessType.READ)
+        setResponseHeader('Expires', cherrypy.lib.httputil.HTTPDate(
+            cherrypy.serving.response.time + TileMaxAge))
+        try:
+            overlays = json.loads(params.pop('layers', None))
+            if not isinstance(overlays, list) or not all(
+                    isinstance(overlay, dict) and 'itemId' in overlay
+                    for overlay in overlays):
+                raise ValueError('Invalid layers')
+        except (TypeError, ValueError):
+            raise RestException(
+                'The "layers" parameter must be a JSON list of objects with '
+                'an "itemId".')
+        if len(overlays) > MaxCompositeLayers:
+            raise RestException('At most %d layers can be composited.' %
+                                MaxCompositeLayers)
+        encoding = params.pop('encoding', 'PNG').upper()
+        if encoding not in ('PNG', 'JPEG'):
+            raise RestException('The encoding must be PNG or JPEG.')
+        z, x, y = _tileCoordinates(z, x, y)
+        layers = [(item, 1.0, self._parseTileParams(params))]
+        for overlay in overlays:
+            overlayItem = loadmodelcache.loadModel(
+                self, 'item', id=overlay['itemId'], allowCookie=True,
+                level=AccessType.READ)
+            try:
+                opacity = float(overlay.get('opacity', 1))
+            except (TypeError, ValueError):
+                opacity = -1
+            if not 0 <= opacity <= 1:
+                raise RestException('Layer opacity must be from 0 to 1.')
+            layerParams = {}
+            for key, value in overlay.items():
+                if key in ('itemId', 'opacity'):
+                    continue
+                if key == 'exclude' and isinstance(value, list):
+                    value = ','.join(str(entry) for entry in value)
+                elif isinstance(value, (list, dict)):
+                    value = json.dumps(value)
+                layerParams[key] = value
+            layers.append((overlayItem, opacity,
+                           self._parseTileParams(layerParams)))
+        colormaps = [self._loadTileColormap(layerParams)
+                     for _, _, layerParams in layers]
+        tileKey = json.dumps([encoding] + [
+            [_tileResultKey(layerItem, z, x, y, layerParams), opacity]
+            for layerItem, opacity, layerParams in layers])
+        _handleETag('getCompositeTile', item, tileKey,
+                    max_age=TileMaxAge)
+        if tileResultCache is not None:
+            cached = tileResultCache.get(tileKey)
+            if cached is not None:
+                setResponseHeader('Content-Type', cached[1])
+                setRawResponse()
+                return cached[0]
+        sources = []
+        for (layerItem, opacity, layerParams), colormap in zip(
+                layers, colormaps):
+            self._applyTileColormap(layerParams, colormap)
+            try:
+                tileSource = self.imageItemModel._loadTileSource(
+                    layerItem, **layerParams)
+            except TileGeneralException as e:
+                raise RestException(e.args[0])
+            sources.append((tileSource, opacity, layerParams))
+        base = sources[0][0]
+        for tileSource, _, _ in sources[1:]:
+            if (tileSource.tileWidth, tileSource.tileHeight,
+                    tileSource.levels) != (base.tileWidth, base.tileHeight,
+                                           base.levels):
+                raise RestException('All layers must have the same tile size '
+                                    'and number of levels.')
+        try:
+            image = getCompositeTile(compositeExecutor, sources, x, y, z)
+        except TileGeneralException as e:
+            raise RestException(e.args[0], code=404)
+        except NotImplementedError as e:
+            raise RestException(e.args[0])
+        output = BytesIO()
+        if encoding == 'JPEG':
+            image.convert('RGB').save(output, 'JPEG', quality=95)
+        else:
+            image.save(output, 'PNG')
+        tileData = output.getvalue()
+        tileMime = 'image/%s' % encoding.lower()
+        if tileResultCache is not None:
+            tileResultCache.set(tileKey, tileData, tileMime)
+        setResponseHeader('Content-Type', tileMime)
+        setRawResponse()
+        return tileData
+
+    @describeRoute(
+        Description('Get many large image tiles in one response.')
+        .notes('The response is multipart/mixed with one part per requested '
+               'tile, in the order requested.  Each part has a '
+               'Content-Location header of "z/x/y".  A tile that could not be '
+               'read has an empty body and an X-Tile-Error header.  The '
+               'processing parameters are the same as for the extended zxy '
+               'endpoint and apply to every tile.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('tiles', 'A JSON list of [z, x, y] tile coordinates.',
+               required=True)
+        .param('normalize', 'Normalize image intensity (single band only).',
+               required=False, dataType='boolean', default=False)
+        .param('normalizeMin', 'Minimum threshold intensity.',
+               required=False, dataType='float')
+        .param('normalizeMax', 'Maximum threshold intensity.',
+               required=False, dataType='float')
+        .param('label', 'Return label images (single band only).',
+               required=False, dataType='boolean', default=False)
+        .param('invertLabel', 'Invert label values for transparency.',
+               required=False, dataType='boolean', default=True)
+        .param('flattenLabel', 'Ignore values for transparency.',
+               required=False, dataType='boolean', default=False)
+        .param('exclude', 'Label values to exclude.', required=False)
+        .param('oneHot', 'Label values are one-hot encoded.',
+               required=False, dataType='boolean', default=False)
+        .param('bit', 'One-hot encoded bit.',
+               required=False, dataType='int')
+        .param('bits', 'Composite several one-hot encoded bits into one RGBA '
+               'image.  A JSON list of objects, each with a "bit" and an '
+               'optional "color" ("#rrggbb" or [r, g, b]; by default, from '
+               'the colormap) and "opacity" (0 to 1, default 1).  Later bits '
+               'are drawn over earlier ones.', required=False)
+        .param('colormapId', 'ID of colormap to apply to image.',
+               required=False)
+        .produces(['multipart/mixed'])
+        .errorResponse('ID was invalid.')
+        .errorResponse('Read access was denied for the item.', 403)
+        .errorResponse('Invalid colormap on server.', 500)
+    )
+    @access.public(cookie=True)
+    def getTileBatch(self, itemId, params):
+        item = loadmodelcache.loadModel(
+            self, 'item', id=itemId, allowCookie=True, level=AccessType.READ)
+        try:
+            tiles = [_tileCoordinates(*tile)
+                     for tile in json.loads(params.pop('tiles', None))]
+        except (TypeError, ValueError):
+            raise RestException(
+                'The "tiles" parameter must be a JSON list of [z, x, y] '
+                'coordinates.')
+        if len(tiles) > MaxBatchTiles:
+            raise RestException('At most %d tiles can be requested at once.' %
+                                MaxBatchTiles)
+        params = self._parseTileParams(params)
+        params.pop('redirect', None)
+        colormap = self._loadTileColormap(params)
+        tileKeys = [_tileResultKey(item, z, x, y, params) for z, x, y in tiles]
+        self._applyTileColormap(params, colormap)
+        boundary = 'tile-%s' % uuid.uuid4().hex
+        setResponseHeader('Content-Type',
+                          'multipart/mixed; boundary=%s' % boundary)
+
+        def stream():
+            tileSource = None
+            for (z, x, y), tileKey in zip(tiles, tileKeys):
+                headers = ['Content-Location: %d/%d/%d' % (z, x, y)]
+                cached = (tileResultCache.get(tileKey)
+                          if tileResultCache is not None else None)
+                if cached is not None:
+                    tileData, tileMime = cached
+                else:
+                    try:
+                        if tileSource is None:
+                            tileSource = self.imageItemModel._loadTileSource(
+                                item, **params)
+                        tileData = tileSource.getTile(x, y, z, **params)
+                        tileMime = self.imageItemModel.getTileMimeType(
+                            tileSource, **params)
+                        if tileResultCache is not None:
+                            tileResultCache.set(tileKey, tileData, tileMime)
+                    except (TileGeneralException, NotImplementedError,
+                            ValueError) as e:
+                        # The multipart headers are already sent, so errors
+                        # are reported per tile
+                        tileData, tileMime = b'', 'application/octet-stream'
+                        headers.append('X-Tile-Error: %s' % (
+                            ' '.join(str(e).split()) or type(e).__name__))
+                headers[:0] = ['Content-Type: %s' % tileMime]
+                headers.append('Content-Length: %d' % len(tileData))
+                yield ('--%s\r\n%s\r\n\r\n' % (
+                    boundary, '\r\n'.join(headers))).encode('utf8')
+                yield tileData
+                yield b'\r\n'
+            yield ('--%s--\r\n' % boundary).encode('utf8')
+        return stream
+
+    def _getExtendedTile(self, item, z, x, y, imageArgs, mayRedirect=False,
+                         cacheKey=None):
+        """
+        Get a processed large image tile.
+
+        :param item: the item to get a tile from.
+        :param z: tile layer number (0 is the most zoomed-out).
+        :param x: the X coordinate of the tile (0 is the left side).
+        :param y: the Y coordinate of the tile (0 is the top).
+        :param imageArgs: additional arguments to use when fetching image data.
+        :param mayRedirect: if True or one of 'any', 'encoding', or 'exact',
+            allow return a response whcih may be a redirect.
+        :param cacheKey: if not None, store the encoded tile in the rendered
+            tile cache with this key.
+        :return: the raw image data.
+        """
+        try:
+            tileData, tileMime = self.imageItemModel.getTile(
+                item, x, y, z, mayRedirect=mayRedirect, **imageArgs)
+        except TileGeneralException as e:
+            raise RestException(e.args[0], code=404)
+        except (NotImplementedError, ValueError) as e:
+            # Processing parameters that don't apply to the image
+            raise RestException(str(e) or type(e).__name__, code=400)
+        if cacheKey is not None and isinstance(tileData, bytes):
+            tileResultCache.set(cacheKey, tileData, tileMime)
+        setResponseHeader('Content-Type', tileMime)
+        setRawResponse()
+        return tileData
+
+    @describeRoute(
+        Description('Replace a tile of a large image with edited pixels.')
+        .notes('The request body is the new tile as a PNG or TIFF image with '
+               'the unprocessed values, the same size as the tile (edge tiles '
+               'include their padding) and with the same number of bands as '
+               'the image.  Edits are stored with the item; the large image '
+               'file is not changed.  By default, a job then updates the '
+               'coarser levels.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('z', 'The layer number of the tile (0 is the most zoomed-out '
+               'layer).', paramType='path')
+        .param('x', 'The X coordinate of the tile (0 is the left side).',
+               paramType='path')
+        .param('y', 'The Y coordinate of the tile (0 is the top).',
+               paramType='path')
+        .param('fold', 'Update the coarser levels in a job.', required=False,
+               dataType='boolean', default=True)
+        .param('reducer', 'How the coarser levels are updated.  This '
+               'defaults to the reducer the image was converted with, or '
+               '"mode" for images converted elsewhere.', required=False,
+               enum=sorted(REDUCERS))
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write access was denied for the item.', 403)
+    )
+    @access.user
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.WRITE)
+    def saveTile(self, item, z, x, y, params):
+        z, x, y = _tileCoordinates(z, x, y)
+        self._checkReducer(params)
+        array = _readImageBody()
+        try:
+            version = self.imageItemModel.saveTile(item, x, y, z, array)
+        except TileGeneralException as e:
+            raise RestException(e.args[0])
+        return self._editResult(item, version, [(z, x, y)], params)
+
+    @describeRoute(
+        Description('Set the pixels of a region of a large image to a value.')
+        .notes('The request body is a PNG or TIFF mask image; the pixels of '
+               'the region where the mask is nonzero are set to the value in '
+               'every band.  The mask of an image with an alpha channel is '
+               'its alpha channel.  Edits are stored with the item; the large image '
+               'file is not changed.  By default, a job then updates the '
+               'coarser levels.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .param('left', 'The left edge of the mask in pixels of the level.',
+               dataType='int')
+        .param('top', 'The top edge of the mask in pixels of the level.',
+               dataType='int')
+        .param('value', 'The new value of the masked pixels.', dataType='int')
+        .param('level', 'The tile level of the mask.  This defaults to the '
+               'full resolution level.', required=False, dataType='int')
+        .param('fold', 'Update the coarser levels in a job.', required=False,
+               dataType='boolean', default=True)
+        .param('reducer', 'How the coarser levels are updated.  This '
+               'defaults to the reducer the image was converted with, or '
+               '"mode" for images converted elsewhere.', required=False,
+               enum=sorted(REDUCERS))
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write access was denied for the item.', 403)
+    )
+    @access.user
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.WRITE)
+    def saveRegionMask(self, item, params):
+        self.requireParams(['left', 'top', 'value'], params)
+        try:
+            left, top, value = (int(params[key])
+                                for key in ('left', 'top', 'value'))
+            level = int(params['level']) if params.get(
+                'level') is not None else None
+        except ValueError:
+            raise RestException(
+                'The left, top, value, and level must be integers.')
+        self._checkReducer(params)
+        mask = _readImageBody(mask=True)
+        try:
+            version, tiles = self.imageItemModel.saveRegionMask(
+                item, left, top, mask, value, level)
+        except TileGeneralException as e:
+            raise RestException(e.args[0])
+        return self._editResult(item, version, tiles, params)
+
+    def _checkReducer(self, params):
+        if params.get('reducer') and params['reducer'] not in REDUCERS:
+            raise RestException('Unknown reducer: %s' % params['reducer'])
+
+    def _editResult(self, item, version, tiles, params):
+        job = None
+        if tiles and self.boolParam('fold', params, default=True):
+            job = self.imageItemModel.scheduleOverlayFold(
+                item, self.getCurrentUser(), params.get('reducer') or None)
+        return {
+            'overlayVersion': version,
+            'tiles': [list(tile) for tile in tiles],
+            'jobId': str(job['_id']) if job else None,
+        }
+
+    @describeRoute(
+        Description('Discard all edits of a large image.')
+        .param('itemId', 'The ID of the item.', paramType='path')
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write access was denied for the item.', 403)
+    )
+    @access.user
+    @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.WRITE)
+    def discardEdits(self, item, params):
+        if not item.get('largeImage', {}).get('fileId'):
+            raise RestException('The item does not have a large image.')
+        return {'overlayVersion': self.imageItemModel.discardEdits(item)}
+
+    def _streamRegion(self, item, params):
+        """
+        Encode a PNG or TIFF region as it is read, so that the whole region
+        is never held in memory.
+
+        :param item: the item with the large image.
+        :param params: the parsed region parameters.
+        :returns: a generator of the encoded region and its mime type, or
+            (None, None) if the region cannot be streamed.
+        """
+        if params.get('encoding', 'JPEG') not in StreamingEncodings:
+            return None, None
+        tileSource = self.imageItemModel._loadTileSource(
+            item, **{k: params[k] for k in ('style', ) if k in params})
+        iterInfo = getRegionPlan(tileSource, **params)
+        if iterInfo is None:
+            return None, None
+        return streamRegion(tileSource, iterInfo, **params)
+
+    def _processedRegion(self, item, params):
+        """
+        Get a region with the tile processing parameters applied.  Regions
+        that can be streamed are processed one block at a time as they are
+        encoded.  Others are processed one tile at a time and then resized.
+
+        :param item: the item with the large image.
+        :param params: the parsed region parameters, with any colormap
+            already applied.
+        :returns: the region data and its mime type.
+        """
+        tileSource = self.imageItemModel._loadTileSource(
+            item, **{k: params[k] for k in ('style', ) if k in params})
+        if not hasattr(tileSource, 'processArray'):
+            raise RestException('This image does not support processing '
+                                'parameters.')
+        encoding = params.get('encoding', 'JPEG')
+        if encoding == 'TILED':
+            # The streamed TIFF is tiled, and has no size limit
+            params['encoding'] = 'TIFF'
+        elif encoding == 'JPEG' and tileSource.getOutputEncoding(
+                **params) == 'PNG':
+            # Transparency and palettes need PNG
+            params['encoding'] = 'PNG'
+        regionData, regionMime = self._streamRegion(item, params)
+        if regionData is None:
+            regionData, regionMime = processRegion(tileSource, **params)
+        return regionData, regionMime
 
     @describeRoute(
         Description('Get any region of a large image item, optionally scaling '
@@ -261,7 +1233,10 @@ class TilesItemResource(TilesItemResource):
                'aspect ratio is always preserved (if both are given, the '
                'resulting image may be smaller in one of the two '
                'dimensions).  When scaling must be applied, the image is '
-               'downsampled from a higher resolution layer, never upsampled.')
+               'downsampled from a higher resolution layer, never upsampled.  '
+               'The processing parameters are the same as for the extended '
+               'zxy endpoint.  Processed regions that need transparency or a '
+               'palette are returned as PNG instead of JPEG.')
         .param('itemId', 'The ID of the item.', paramType='path')
         .param('left', 'The left column (0-based) of the region to process.  '
                'Negative values are offsets from the right edge.',
@@ -331,6 +1306,30 @@ class TilesItemResource(TilesItemResource):
                'a specific interpolation method (0-nearest, 1-lanczos, '
                '2-bilinear, 3-bicubic)', required=False,
                enum=['false', 'true', '0', '1', '2', '3'])
+        .param('normalize', 'Normalize image intensity (single band only).',
+               required=False, dataType='boolean', default=False)
+        .param('normalizeMin', 'Minimum threshold intensity.',
+               required=False, dataType='float')
+        .param('normalizeMax', 'Maximum threshold intensity.',
+               required=False, dataType='float')
+        .param('label', 'Return label images (single band only).',
+               required=False, dataType='boolean', default=False)
+        .param('invertLabel', 'Invert label values for transparency.',
+               required=False, dataType='boolean', default=True)
+        .param('flattenLabel', 'Ignore values for transparency.',
+               required=False, dataType='boolean', default=False)
+        .param('exclude', 'Label values to exclude.', required=False)
+        .param('oneHot', 'Label values are one-hot encoded.',
+               required=False, dataType='boolean', default=False)
+        .param('bit', 'One-hot encoded bit.',
+               required=False, dataType='int')
+        .param('bits', 'Composite several one-hot encoded bits into one RGBA '
+               'image.  A JSON list of objects, each with a "bit" and an '
+               'optional "color" ("#rrggbb" or [r, g, b]; by default, from '
+               'the colormap) and "opacity" (0 to 1, default 1).  Later bits '
+               'are drawn over earlier ones.', required=False)
+        .param('colormapId', 'ID of colormap to apply to image.',
+               required=False)
         .param('contentDisposition', 'Specify the Content-Disposition response '
                'header disposition-type value.', required=False,
                enum=['inline', 'attachment'])
@@ -340,13 +1339,12 @@ class TilesItemResource(TilesItemResource):
         .errorResponse('ID was invalid.')
         .errorResponse('Read access was denied for the item.', 403)
         .errorResponse('Insufficient memory.')
+        .errorResponse('Invalid colormap on server.', 500)
     )
     @access.public(cookie=True)
     @loadmodel(model='item', map={'itemId': 'item'}, level=AccessType.READ)
     def getTilesRegion(self, item, params):
-
-        _adjustParams(params)
-        params = self._parseParams(params, True, [
+        params = self._parseTileParams(params, [
             ('left', float, 'region', 'left'),
             ('top', float, 'region', 'top'),
             ('right', float, 'region', 'right'),
@@ -372,13 +1370,25 @@ class TilesItemResource(TilesItemResource):
             ('contentDisposition', str),
             ('contentDispositionFileName', str)
         ])
-        _handleETag('getTilesRegion', item, params)
+        colormap = self._loadTileColormap(params)
+        # Edits change the pixels of a region without changing its item
+        largeImage = item.get('largeImage', {})
+        _handleETag('getTilesRegion', item, str(largeImage.get('fileId')),
+                    largeImage.get('overlayVersion'), params)
+        self._applyTileColormap(params, colormap)
         setResponseTimeLimit(86400)
         try:
-            regionData, regionMime = self.imageItemModel.getRegion(
-                item, **params)
+            if TiffFileTileSource.hasProcessing(**params):
+                regionData, regionMime = self._processedRegion(item, params)
+            else:
+                regionData, regionMime = self._streamRegion(item, params)
+                if regionData is None:
+                    regionData, regionMime = self.imageItemModel.getRegion(
+                        item, **params)
         except TileGeneralException as e:
             raise RestException(e.args[0])
+        except NotImplementedError as e:
+            raise RestException(e.args[0])
         except ValueError as e:
             raise RestException('Value Error: %s' % e.args[0])
 
@@ -389,6 +1399,8 @@ class TilesItemResource(TilesItemResource):
             params.get('contentDispositionFilename'))
         setResponseHeader('Content-Type', regionMime)
 
+        if isinstance(regionData, types.GeneratorType):
+            return lambda: regionData
         if isinstance(regionData, pathlib.Path):
             BUF_SIZE = 65536
 
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+from six import BytesIO
+
+import numpy
+
+import PIL.Image
+
+from large_image.exceptions import TileSourceException
+
+
+def getLayerImage(tileSource, x, y, z, **kwargs):
+    """
+    Get a tile as an RGBA image.
+
+    :param tileSource: the tile source.
+    :param x: the tile column.
+    :param y: the tile row.
+    :param z: the tile level.
+    :param kwargs: the tile processing parameters.
+    :returns: a PIL image in RGBA mode.
+    """
+    tile = tileSource.getTile(x, y, z, pilImageAllowed=True, **kwargs)
+    if isinstance(tile, numpy.ndarray):
+        tile = PIL.Image.fromarray(tile)
+    elif not isinstance(tile, PIL.Image.Image):
+        tile = PIL.Image.open(BytesIO(tile))
+    if tile.mode.startswith('I'):
+        # 16-bit images are shown with their high byte
+        tile = PIL.Image.fromarray(
+            (numpy.asarray(tile) >> 8).astype(numpy.uint8), 'L')
+    return tile.convert('RGBA')
+
+
+def compositeLayers(layers):
+    """
+    Draw layers over each other.
+
+    :param layers: a list of (image, opacity) tuples, bottom first.  Images
+        are RGBA PIL images; the first image sets the size of the result.
+        Opacity scales the alpha of an image.
+    :returns: a PIL image in RGBA mode.
+    """
+    result = None
+    for image, opacity in layers:
+        if opacity < 1:
+            alpha = numpy.asarray(image.getchannel('A'), dtype=numpy.float32)
+            image.putalpha(PIL.Image.fromarray(
+                (alpha * opacity).round().astype(numpy.uint8), 'L'))
+        if result is None:
+            result = image
+            continue
+        if image.size != result.size:
+            # Edge tiles of images with slightly different sizes
+            canvas = PIL.Image.new('RGBA', result.size, (0, 0, 0, 0))
+            canvas.paste(image.crop((0, 0) + result.size), (0, 0))
+            image = canvas
+        result = PIL.Image.alpha_composite(result, image)
+    return result
+
+
+def getCompositeTile(executor, layers, x, y, z):
+    """
+    Read the tiles of several layers in parallel and composite them.  The
+    first layer must have a tile; layers after it that do not are skipped.
+
+    :param executor: a concurrent.futures executor for reading tiles.
+    :param layers: a list of (tileSource, opacity, kwargs) tuples, bottom
+        first.
+    :param x: the tile column.
+    :param y: the tile row.
+    :param z: the tile level.
+    :returns: a PIL image in RGBA mode.
+    """
+    futures = [executor.submit(getLayerImage, tileSource, x, y, z, **kwargs)
+               for tileSource, _, kwargs in layers]
+    images = [(futures[0].result(), layers[0][1])]
+    for future, (_, opacity, _) in zip(futures[1:], layers[1:]):
+        try:
+            images.append((future.result(), opacity))
+        except TileSourceException:
+            pass
+    return compositeLayers(images)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# Histograms of a level are counted with one numpy.bincount per tile, with
+# each band offset into its own range of bins.  Rows of tiles are counted in
+# worker processes that open the file themselves, so decoding and counting
+# use every core without contending for the server's GIL.
+
+import multiprocessing
+import os
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from six import BytesIO
+
+import numpy
+
+import PIL.Image
+
+from ..cache_util import getConfig
+
+# The percentiles reported when none are requested
+DefaultPercentiles = (0.5, 2, 50, 98, 99.5)
+
+# The number of rows of tiles counted by each task
+HistogramRowsPerTask = 4
+
+_executor = None
+_executorLock = threading.Lock()
+
+
+def getHistogramExecutor():
+    """
+    Get the shared pool of processes used to count histograms.  Workers are
+    spawned rather than forked, since the server process has threads and
+    open database connections.
+
+    :returns: a ProcessPoolExecutor.
+    """
+    global _executor
+    with _executorLock:
+        if _executor is None:
+            processes = int(getConfig('histogram_processes', 0) or
+                            multiprocessing.cpu_count())
+            _executor = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def histogramRange(dtype):
+    """
+    Get the bins needed to count an image data type.
+
+    :param dtype: a numpy dtype.
+    :returns: the value of the first bin and the number of bins, or None if
+        the data type cannot be counted in bins of single values.
+    """
+    dtype = numpy.dtype(dtype)
+    if dtype.kind not in 'ui' or dtype.itemsize > 2:
+        return None
+    return int(numpy.iinfo(dtype).min), 1 << (dtype.itemsize * 8)
+
+
+def _tileArray(tile):
+    if isinstance(tile, numpy.ndarray):
+        return tile
+    if not isinstance(tile, PIL.Image.Image):
+        tile = PIL.Image.open(BytesIO(tile))
+    return numpy.asarray(tile)
+
+
+def countTile(tile, start, bins, height, width):
+    """
+    Count the values of a tile.
+
+    :param tile: the pixels of the tile.
+    :param start: the value of the first bin.
+    :param bins: the number of bins per band.
+    :param height: the number of rows of the tile that are in the image.
+    :param width: the number of columns of the tile that are in the image.
+    :returns: an int64 array of (bands, bins).
+    """
+    if tile.ndim == 2:
+        tile = tile[:, :, numpy.newaxis]
+    bands = tile.shape[2]
+    # Edge tiles are padded past the image
+    values = tile[:height, :width].reshape(-1, bands).astype(numpy.int64)
+    values += numpy.arange(bands, dtype=numpy.int64) * bins - start
+    return numpy.bincount(
+        values.ravel(), minlength=bands * bins).reshape(bands, bins)
+
+
+def countRows(path, directoryNum, rowStart, rowEnd, occupancy=None):
+    """
+    Count the values of some rows of tiles of a TIFF directory.
+
+    :param path: the path of the TIFF file.
+    :param directoryNum: the directory of the level.
+    :param rowStart: the first row of tiles.
+    :param rowEnd: one more than the last row of tiles.
+    :param occupancy: an optional boolean array of (rowEnd - rowStart,
+        tilesAcross) that is False for tiles with only zero pixels.
+    :returns: an int64 array of (bands, bins).
+    """
+    from large_image_source_tiff.tiff_reader import IOTiffException
+
+    from .tiff_reader import TiledTiffDirectory
+
+    directory = TiledTiffDirectory(path, directoryNum)
+    start, bins = histogramRange(
+        directory._arrayDtype() or numpy.dtype(numpy.uint8))
+    bands = directory._tiffInfo.get('samplesperpixel') or 1
+    counts = numpy.zeros((bands, bins), dtype=numpy.int64)
+    for y in range(rowStart, rowEnd):
+        height = min(directory._tileHeight,
+                     directory._imageHeight - y * directory._tileHeight)
+        for x in range(directory._tilesAcross):
+            width = min(directory._tileWidth,
+                        directory._imageWidth - x * directory._tileWidth)
+            # Empty tiles, including tiles that were never written, are
+            # counted as zero without decoding them
+            if ((occupancy is not None and not occupancy[y - rowStart, x]) or
+                    directory.isTileEmpty(x, y)):
+                counts[:, -start] += width * height
+                continue
+            try:
+                tile = _tileArray(directory.getTile(x, y, asArray=True))
+            except IOTiffException:
+                counts[:, -start] += width * height
+                continue
+            counts += countTile(tile, start, bins, height, width)
+    return counts
+
+
+def countDirectory(directory, executor=None):
+    """
+    Count the values of every pixel of a TIFF directory.
+
+    :param directory: a TiledTiffDirectory.
+    :param executor: the executor for the rows of tiles.  If None, the
+        shared process pool is used when the file is local, and the rows are
+        counted in this process otherwise.
+    :returns: the value of the first bin and an int64 array of (bands, bins).
+    """
+    dtype = directory._arrayDtype()
+    binRange = histogramRange(dtype) if dtype is not None else None
+    if binRange is None:
+        raise NotImplementedError('8 and 16-bit integer images only')
+    path = directory._filePath
+    if executor is None and os.path.isfile(path):
+        executor = getHistogramExecutor()
+    occupancy = directory._occupancy
+    tasks = []
+    for rowStart in range(0, directory._tilesDown, HistogramRowsPerTask):
+        rowEnd = min(directory._tilesDown, rowStart + HistogramRowsPerTask)
+        args = (path, directory._directoryNum, rowStart, rowEnd,
+                occupancy[rowStart:rowEnd] if occupancy is not None else None)
+        tasks.append(executor.submit(countRows, *args) if executor else args)
+    counts = None
+    for task in tasks:
+        result = task.result() if executor else countRows(*task)
+        counts = result if counts is None else counts + result
+    return binRange[0], counts
+
+
+def packHistogram(start, counts):
+    """
+    Compress a histogram for storage.  Each band keeps the bins from its
+    smallest to its largest value.
+
+    :param start: the value of the first bin.
+    :param counts: an integer array of (bands, bins).
+    :returns: a list with a dictionary per band.
+    """
+    bands = []
+    for band in counts:
+        used = numpy.flatnonzero(band)
+        first, last = (used[0], used[-1]) if len(used) else (0, -1)
+        bands.append({
+            'start': int(start + first),
+            'counts': zlib.compress(
+                band[first:last + 1].astype('<u8').tobytes()),
+        })
+    return bands
+
+
+def unpackHistogram(bands):
+    """
+    Expand a histogram stored with packHistogram.
+
+    :param bands: the stored list.
+    :returns: a list of (start, counts) tuples, one per band, where counts
+        has a bin for each value from start to the largest value.
+    """
+    return [(band['start'], numpy.frombuffer(
+        zlib.decompress(band['counts']), dtype='<u8').astype(numpy.int64))
+        for band in bands]
+
+
+def summarizeHistogram(start, counts, percentiles=DefaultPercentiles,
+                       bins=256):
+    """
+    Describe the histogram of one band.
+
+    :param start: the value of the first bin.
+    :param counts: an integer array with a bin per value.
+    :param percentiles: a list of percentiles to find, from 0 to 100.
+    :param bins: the number of bins in the reported histogram, or 0 for
+        none.
+    :returns: a dictionary with the number of samples, the minimum, maximum,
+        and mean values, the value at each percentile, and, if bins is not
+        zero, the histogram with its bin edges.  The histogram spans the
+        minimum to maximum values.
+    """
+    total = int(counts.sum())
+    result = {'samples': total}
+    if not total:
+        return result
+    values = numpy.arange(start, start + len(counts))
+    used = numpy.flatnonzero(counts)
+    # The value at a percentile is the first one whose cumulative count
+    # reaches that fraction of the samples
+    cumulative = numpy.cumsum(counts)
+    positions = numpy.searchsorted(cumulative, [
+        max(1, total * percentile / 100.0) for percentile in percentiles])
+    result.update({
+        'min': int(values[used[0]]),
+        'max': int(values[used[-1]]),
+        'mean': float((values * counts).sum()) / total,
+        'percentiles': {
+            '%g' % percentile: int(values[min(position, len(values) - 1)])
+            for percentile, position in zip(percentiles, positions)},
+    })
+    if bins:
+        hist, edges = numpy.histogram(
+            values, bins=bins, range=(result['min'], result['max'] + 1),
+            weights=counts)
+        result['histogram'] = hist.astype(numpy.int64).tolist()
+        result['binEdges'] = edges.tolist()
+    return result
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# Every tile transform (normalize, oneHot, bit, label, colormap) maps each
+# input value to an output value independently of its neighbors, so the whole
+# chain can be evaluated once over every possible input value and then applied
+# to a tile with a single numpy.take.
+
+import numpy
+
+from ..cache_util import LruCache, registerCache
+
+lutCache = registerCache('lut', LruCache(maxSize=256))
+
+
+class Lut(object):
+    """
+    A compiled lookup table.
+
+    :param table: a uint8 array with one row per input value.  Rows are
+        scalars for 'L' and 'P' output and RGBA values for 'RGBA' output.
+    :param mode: the PIL mode of the output image.
+    :param palette: for 'P' output, the palette as a bytes object.
+    :param start: the input value of the first row.
+    """
+    def __init__(self, table, mode, palette=None, start=0):
+        self.table = table
+        self.mode = mode
+        self.palette = palette
+        self.start = start
+
+    def apply(self, array):
+        """
+        Apply the table to a single band image array.
+
+        :param array: a two dimensional integer array whose values are all
+            in the table.
+        :returns: the mapped array.
+        """
+        if self.start:
+            array = array.astype(numpy.int32) - self.start
+        return numpy.take(self.table, array, axis=0)
+
+
+def lutDepth(array):
+    """
+    Get the number of table entries needed to map an array.
+
+    :param array: an image array.
+    :returns: 256 for 8-bit integer data, 65536 for 16-bit integer data, or
+        None if the data cannot be mapped by a table.  Wider integers are
+        mapped with directLut.
+    """
+    if array.dtype.kind in 'ui' and array.dtype.itemsize <= 2:
+        return 256 ** array.dtype.itemsize
+    return None
+
+
+def lutStart(array):
+    """
+    Get the smallest value of an array's data type, which is the input value
+    of the first row of its table.
+
+    :param array: an integer image array.
+    :returns: 0 for unsigned data, or a negative number for signed data.
+    """
+    return int(numpy.iinfo(array.dtype).min)
+
+
+def _normalize(values, range_, exclude, oneHot):
+    if oneHot:
+        result = numpy.zeros(values.shape, dtype=numpy.float64)
+        min_, max_ = max(1, int(range_[0])), min(8, int(range_[1]))
+        for i in range(min_, max_ + 1):
+            if exclude and i in exclude:
+                continue
+            result[(values >> (i - 1)) & 1 == 1] = int(i * 255 / 8)
+        return result
+    result = values.astype(numpy.float64)
+    min_, max_ = range_
+    if min_ == max_:
+        result[result != min_] = 0
+        result[result != 0] = min_
+    else:
+        result[(result > max_) | (result < min_)] = 0
+    return numpy.clip(result.round(), 0, 255)
+
+
+def _label(values, invert, flatten):
+    if flatten:
+        mask = numpy.where(values == 0, 0, 255)
+    else:
+        mask = numpy.clip(values, 0, 255)
+    if invert:
+        mask = 255 - mask
+    table = numpy.full((len(values), 4), 255, dtype=numpy.uint8)
+    table[:, 3] = mask
+    return table
+
+
+def _palette(colormap):
+    palette = numpy.zeros((256, 3), dtype=numpy.uint8)
+    colors = numpy.frombuffer(bytes(colormap), dtype=numpy.uint8)
+    colors = colors[:len(colors) - len(colors) % 3].reshape(-1, 3)[:256]
+    palette[:len(colors)] = colors
+    return palette
+
+
+def _bit(values, channel, colormap):
+    table = numpy.zeros((len(values), 4), dtype=numpy.uint8)
+    if colormap is not None:
+        table[:, :3] = colormap[int(round(channel * 255 / 8.0))][:3]
+    table[:, 3] = _bitMask(values, channel) * 255
+    return table
+
+
+def _bitMask(values, channel):
+    if channel:
+        return (values >> (channel - 1)) & 1
+    return (values == 0).astype(numpy.int64)
+
+
+def _composite(values, layers, colormap):
+    # Blend each layer over the ones before it with the "over" operator.
+    # This is done for every input value at once, so the cost per pixel does
+    # not depend on the number of layers.
+    rgb = numpy.zeros((len(values), 3), dtype=numpy.float64)
+    alpha = numpy.zeros(len(values), dtype=numpy.float64)
+    for channel, color, opacity in layers:
+        if color is None:
+            color = (colormap[int(round(channel * 255 / 8.0))][:3]
+                     if colormap is not None else (255, 255, 255))
+        layerAlpha = _bitMask(values, channel) * float(opacity)
+        newAlpha = layerAlpha + alpha * (1 - layerAlpha)
+        blended = (numpy.outer(layerAlpha, color) +
+                   rgb * (alpha * (1 - layerAlpha))[:, numpy.newaxis])
+        rgb = numpy.divide(blended, newAlpha[:, numpy.newaxis],
+                           out=numpy.zeros_like(blended),
+                           where=newAlpha[:, numpy.newaxis] > 0)
+        alpha = newAlpha
+    table = numpy.empty((len(values), 4), dtype=numpy.uint8)
+    table[:, :3] = numpy.clip(rgb.round(), 0, 255)
+    table[:, 3] = numpy.clip((alpha * 255).round(), 0, 255)
+    return table
+
+
+def _compile(values, params):
+    if params.get('bits'):
+        return Lut(_composite(values, params['bits'], params.get('colormap')),
+                   'RGBA')
+    if params.get('bit') is not None:
+        return Lut(_bit(values, params['bit'], params.get('colormap')),
+                   'RGBA')
+    if params.get('normalize') or params.get('oneHot'):
+        values = _normalize(
+            values, (params.get('normalizeMin', 0),
+                     params.get('normalizeMax', 255)),
+            params.get('exclude'), params.get('oneHot', False),
+        ).astype(numpy.int64)
+    if params.get('colormap'):
+        indices = numpy.clip(values, 0, 255).astype(numpy.uint8)
+        palette = _palette(params['colormap'])
+        if not params.get('label'):
+            return Lut(indices, 'P', palette.tobytes())
+        table = numpy.empty((len(values), 4), dtype=numpy.uint8)
+        table[:, :3] = palette[indices]
+        table[:, 3] = numpy.where(values == 0, 0, 255)
+        return Lut(table, 'RGBA')
+    if params.get('label'):
+        return Lut(_label(values, params.get('invertLabel', True),
+                          params.get('flattenLabel', False)), 'RGBA')
+    return Lut(numpy.clip(values, 0, 255).astype(numpy.uint8), 'L')
+
+
+def _cacheKey(value):
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, bytearray):
+        return bytes(value)
+    if isinstance(value, tuple):
+        try:
+            hash(value)
+            return value
+        except TypeError:
+            pass
+    if isinstance(value, (list, tuple)):
+        return tuple(_cacheKey(entry) for entry in value)
+    return value
+
+
+def paramsKey(**params):
+    """
+    Get a hashable key for a set of tile processing parameters.
+
+    :param params: the processing parameters.
+    :returns: a tuple that is the same for equivalent parameters.
+    """
+    return tuple(sorted(
+        (k, _cacheKey(v)) for k, v in params.items() if v is not None))
+
+
+def getLut(depth, start=0, **params):
+    """
+    Get the compiled lookup table for a set of tile processing parameters.
+    Tables are memoized, so requests with the same parameters share them.
+
+    :param depth: the number of possible input values (see lutDepth).
+    :param start: the smallest possible input value (see lutStart).
+    :param params: the processing parameters, as passed to _outputTile.
+    :returns: a Lut.
+    """
+    key = (depth, start) + paramsKey(**params)
+    lut = lutCache.get(key)
+    if lut is None:
+        values = numpy.arange(start, start + depth, dtype=numpy.int64)
+        lut = _compile(values, params)
+        lut.start = start
+        lutCache.put(key, lut)
+    return lut
+
+
+def directLut(array, **params):
+    """
+    Map the values of an array whose data type has too many values for a
+    table by evaluating the processing on the values themselves.
+
+    :param array: a two dimensional integer array.
+    :param params: the processing parameters, as passed to _outputTile.
+    :returns: a Lut whose table is the mapped array.
+    """
+    lut = _compile(array.astype(numpy.int64).ravel(), params)
+    lut.table = lut.table.reshape(array.shape + lut.table.shape[1:])
+    return lut
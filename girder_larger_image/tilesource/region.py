@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# Regions are assembled one row of tiles at a time and encoded as each row is
+# finished, so memory use depends on the region width rather than its area.
+
+import itertools
+import os
+import struct
+import tempfile
+import zlib
+
+from six import BytesIO
+
+import numpy
+
+import PIL.Image
+
+from large_image.exceptions import TileSourceException
+from large_image.tilesource.base import TILE_FORMAT_NUMPY
+from large_image.tilesource.utilities import _letterboxImage
+
+from .tiff import ProcessingParams
+
+# The encodings that can be streamed
+StreamingEncodings = ('PNG', 'TIFF')
+
+# PNG color types for PIL modes
+PngColorTypes = {'L': 0, 'RGB': 2, 'P': 3, 'LA': 4, 'RGBA': 6}
+
+# tifffile compression names for the tiffCompression parameter
+TiffCompression = {
+    'none': None,
+    'raw': None,
+    'lzw': 'lzw',
+    'tiff_lzw': 'lzw',
+    'jpeg': 'jpeg',
+    'deflate': 'adobe_deflate',
+    'tiff_adobe_deflate': 'adobe_deflate',
+}
+
+BandModes = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+RegionMimeTypes = {'JPEG': 'image/jpeg', 'PNG': 'image/png',
+                   'TIFF': 'image/tiff'}
+
+StreamChunkSize = 65536
+
+# Tile processing parameters whose output must not be interpolated
+LabelParams = ('label', 'bit', 'bits', 'oneHot')
+
+
+class RegionStrip(object):
+    """
+    A full width block of rows of a region.
+
+    :param top: the first row of the block within the region.
+    :param array: the pixels as a (rows, width, bands) array.
+    :param mode: the PIL mode of the pixels.
+    :param palette: for 'P' mode, the palette as a bytes object.
+    """
+    def __init__(self, top, array, mode, palette=None):
+        self.top = top
+        self.array = array
+        self.mode = mode
+        self.palette = palette
+
+
+def _matchBands(array, bands):
+    if array.shape[2] >= bands:
+        return array[:, :, :bands]
+    # Repeat a grey band as needed and add an opaque alpha band
+    hasAlpha = array.shape[2] in (2, 4)
+    alpha = bands in (2, 4)
+    result = numpy.empty(array.shape[:2] + (bands, ), dtype=array.dtype)
+    result[:, :, :bands - alpha] = array[
+        :, :, :array.shape[2] - hasAlpha]
+    if alpha:
+        result[:, :, -1] = array[:, :, -1] if hasAlpha else (
+            numpy.iinfo(array.dtype).max if array.dtype.kind in 'ui' else 1)
+    return result
+
+
+def _iterStrips(tileSource, iterInfo, params):
+    region = iterInfo['region']
+    process = getattr(tileSource, 'processArray', None)
+    strip = None
+    bands = mode = palette = None
+    for tile in tileSource._tileIterator(iterInfo):
+        array = tile['tile']
+        if process is not None:
+            array, tileMode, palette = process(array, **params)
+        else:
+            tileMode = None
+        array = array[:tile['height'], :tile['width']]
+        if array.ndim == 2:
+            array = array[:, :, numpy.newaxis]
+        if strip is None or tile['y'] - region['top'] != strip.top:
+            if strip is not None:
+                yield strip
+            if bands is None:
+                bands = array.shape[2]
+                mode = tileMode or BandModes.get(bands)
+            strip = RegionStrip(
+                tile['y'] - region['top'],
+                numpy.zeros((tile['height'], region['width'], bands),
+                            dtype=array.dtype),
+                mode, palette)
+        x0 = tile['x'] - region['left']
+        strip.array[:, x0:x0 + array.shape[1]] = _matchBands(array, bands)
+    if strip is not None:
+        yield strip
+
+
+def getRegionPlan(tileSource, **kwargs):
+    """
+    Check if a region can be streamed and get the information used to
+    iterate through it.  Regions that must be resampled to a size that is not
+    a level of the image cannot be streamed.
+
+    :param tileSource: the tile source.
+    :param kwargs: the getRegion parameters.
+    :returns: the tile iterator information, or None if the region cannot be
+        streamed.
+    """
+    if kwargs.get('encoding', 'JPEG') not in StreamingEncodings:
+        return None
+    if kwargs.get('fill') not in (None, 'none'):
+        return None
+    kwargs = {k: v for k, v in kwargs.items() if k != 'format'}
+    iterInfo = tileSource._tileIteratorInfo(
+        format=(TILE_FORMAT_NUMPY, ), **kwargs)
+    if iterInfo is None:
+        return None
+    region, output = iterInfo['region'], iterInfo['output']
+    if ((region['width'], region['height']) !=
+            (output['width'], output['height']) and
+            kwargs.get('resample', True) is not False):
+        return None
+    return iterInfo
+
+
+def _pngChunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+
+def _encodePng(strips, width, height):
+    compressor = zlib.compressobj(6)
+    dtype = None
+    for strip in strips:
+        array = strip.array
+        if dtype is None:
+            dtype = numpy.dtype('>u2' if array.dtype == numpy.uint16 else 'u1')
+            header = struct.pack(
+                '>IIBBBBB', width, height, dtype.itemsize * 8,
+                PngColorTypes[strip.mode], 0, 0, 0)
+            data = b'\x89PNG\r\n\x1a\n' + _pngChunk(b'IHDR', header)
+            if strip.mode == 'P':
+                data += _pngChunk(b'PLTE', strip.palette)
+            yield data
+        # Each row starts with a filter type of 0 (none)
+        rows = numpy.zeros(
+            (array.shape[0], 1 + width * array.shape[2] * dtype.itemsize),
+            dtype=numpy.uint8)
+        rows[:, 1:] = array.astype(dtype, copy=False).view(
+            numpy.uint8).reshape(array.shape[0], -1)
+        data = compressor.compress(rows.tobytes())
+        if data:
+            yield _pngChunk(b'IDAT', data)
+    yield _pngChunk(b'IDAT', compressor.flush()) + _pngChunk(b'IEND', b'')
+
+
+def _tiffTiles(strips, tileWidth, tileHeight):
+    # Regroup rows of tiles that may have uneven heights into rows of
+    # tileHeight and cut them into tiles
+    pending = None
+    for strip in strips:
+        pending = strip.array if pending is None else numpy.concatenate(
+            (pending, strip.array))
+        while pending.shape[0] >= tileHeight:
+            for left in range(0, pending.shape[1], tileWidth):
+                yield pending[:tileHeight, left:left + tileWidth]
+            pending = pending[tileHeight:]
+    if pending is not None and pending.shape[0]:
+        for left in range(0, pending.shape[1], tileWidth):
+            yield pending[:, left:left + tileWidth]
+
+
+def _writeTiff(first, strips, width, height, path, compression, quality,
+               tileWidth, tileHeight):
+    import tifffile
+
+    array = first.array
+    options = {
+        'compression': TiffCompression.get(compression or 'raw'),
+        'photometric': 'minisblack',
+    }
+    if first.mode == 'P':
+        palette = numpy.frombuffer(first.palette, dtype=numpy.uint8)
+        options['photometric'] = 'palette'
+        options['colormap'] = (
+            palette.reshape(-1, 3).T.astype(numpy.uint16) * 257)
+    elif array.shape[2] >= 3:
+        options['photometric'] = 'rgb'
+    if array.shape[2] in (2, 4):
+        options['extrasamples'] = ('unassalpha', )
+    if options['compression'] == 'jpeg' and quality:
+        options['compressionargs'] = {'level': int(quality)}
+    bands = array.shape[2]
+    tiles = _tiffTiles(itertools.chain([first], strips), tileWidth,
+                       tileHeight)
+    if bands == 1:
+        tiles = (tile[:, :, 0] for tile in tiles)
+    else:
+        options['planarconfig'] = 'contig'
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.write(
+            tiles, shape=(height, width, bands)[:3 if bands > 1 else 2],
+            dtype=array.dtype, tile=(tileHeight, tileWidth), **options)
+
+
+def _streamTiff(first, strips, width, height, compression, quality,
+                tileWidth, tileHeight):
+    fd, path = tempfile.mkstemp(suffix='.tiff')
+    os.close(fd)
+    try:
+        _writeTiff(first, strips, width, height, path, compression, quality,
+                   tileWidth, tileHeight)
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(StreamChunkSize)
+                if not data:
+                    break
+                yield data
+    finally:
+        os.unlink(path)
+
+
+def streamRegion(tileSource, iterInfo, **kwargs):
+    """
+    Encode a region while it is being read.
+
+    :param tileSource: the tile source.
+    :param iterInfo: the value returned by getRegionPlan.
+    :param kwargs: the getRegion parameters, plus any of the tile processing
+        parameters supported by the tile source.
+    :returns: a generator of encoded data and the mime type.
+    """
+    region = iterInfo['region']
+    width, height = region['width'], region['height']
+    strips = _iterStrips(tileSource, iterInfo, kwargs)
+    # Read the first strip now so that errors are reported before the
+    # response starts
+    first = next(strips)
+    if kwargs.get('encoding') == 'TIFF':
+        return _streamTiff(
+            first, strips, width, height, kwargs.get('tiffCompression'),
+            kwargs.get('jpegQuality'), iterInfo['metadata']['tileWidth'],
+            iterInfo['metadata']['tileHeight']), 'image/tiff'
+    return _encodePng(itertools.chain([first], strips), width,
+                      height), 'image/png'
+
+
+def processRegion(tileSource, **kwargs):
+    """
+    Get a region that cannot be streamed.  The tile processing parameters are
+    applied to each tile as it is read, so only the processed region is held
+    in memory, and it is then resized to the output size.  Processed labels,
+    bits, and one-hot values are resized to the nearest pixel, since
+    interpolating them would make values that are not in the image.
+
+    :param tileSource: a tile source with a processArray method.
+    :param kwargs: the getRegion parameters, plus the tile processing
+        parameters.
+    :returns: the encoded region and its mime type.
+    """
+    encoding = kwargs.get('encoding', 'JPEG')
+    regionKwargs = {k: v for k, v in kwargs.items()
+                    if k not in ProcessingParams + ('format', 'encoding')}
+    iterInfo = tileSource._tileIteratorInfo(
+        format=(TILE_FORMAT_NUMPY, ), **regionKwargs)
+    if iterInfo is None:
+        raise TileSourceException('The region is empty.')
+    region, output = iterInfo['region'], iterInfo['output']
+    image = mode = palette = None
+    for strip in _iterStrips(tileSource, iterInfo, kwargs):
+        array = strip.array
+        if array.shape[2] == 1:
+            array = array[:, :, 0]
+        if image is None:
+            mode, palette = strip.mode, strip.palette
+            image = PIL.Image.new('L' if mode == 'P' else mode,
+                                  (region['width'], region['height']))
+        image.paste(PIL.Image.fromarray(array, 'L' if mode == 'P' else mode),
+                    (0, strip.top))
+    if image is None:
+        raise TileSourceException('The region is empty.')
+    size = (int(output['width']), int(output['height']))
+    if size != image.size:
+        resampling = getattr(PIL.Image, 'Resampling', PIL.Image)
+        if mode == 'P' or any(kwargs.get(k) for k in LabelParams):
+            method = resampling.NEAREST
+        elif size[0] > image.width:
+            method = resampling.BICUBIC
+        else:
+            method = resampling.LANCZOS
+        image = image.resize(size, method)
+    if mode == 'P':
+        image.putpalette(palette)
+    maxWidth = (kwargs.get('output') or {}).get('maxWidth')
+    maxHeight = (kwargs.get('output') or {}).get('maxHeight')
+    if kwargs.get('fill') and maxWidth and maxHeight:
+        image = _letterboxImage(image, maxWidth, maxHeight, kwargs['fill'])
+    output = BytesIO()
+    if encoding == 'JPEG':
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        image.save(output, 'JPEG', quality=kwargs.get('jpegQuality', 95),
+                   subsampling=kwargs.get('jpegSubsampling', 0))
+    else:
+        image.save(output, encoding)
+    return output.getvalue(), RegionMimeTypes[encoding]
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# Guess the format of an image file from its first bytes, so that only the
+# tile sources that could read it are asked to open it.  Opening a file with
+# each source in turn is slow, especially on remote assetstores.  A source
+# that isn't known here is always tried.
+
+import struct
+
+# The number of bytes read from the start of a file
+HeaderSize = 16384
+
+# Tiff tags used to recognize files
+TiffTags = {
+    'compression': 259,
+    'description': 270,
+    'tileWidth': 322,
+    'ndpiFormat': 65420,
+}
+GeoTiffTags = (33550, 33922, 34264, 34735)
+
+# Tiff compression schemes for JPEG 2000, which libtiff can't decode
+Jpeg2000Compression = (33003, 33004, 33005, 34712)
+
+# Tiff value types by size
+TiffTypeSizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4,
+                 10: 8, 11: 4, 12: 8, 13: 4, 16: 8, 17: 8, 18: 8}
+TiffTypeFormats = {1: 'B', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 13: 'I',
+                   16: 'Q', 17: 'q', 18: 'Q'}
+
+# Signatures of formats that are not tiff, as (offset, bytes, format)
+Signatures = (
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'\xff\xd8\xff', 'jpeg'),
+    (0, b'\x00\x00\x00\x0cjP  \r\n\x87\n', 'jpeg2000'),
+    (0, b'\xff\x4f\xff\x51', 'jpeg2000'),
+    (0, b'GIF8', 'gif'),
+    (0, b'BM', 'bmp'),
+    (128, b'DICM', 'dicom'),
+    (0, b'ZISRAWFILE', 'czi'),
+)
+
+
+def _readTiffTags(header, byteOrder, bigtiff):
+    """
+    Read the first image directory of a tiff file, as far as it is in the
+    header.
+
+    :returns: a dictionary of tag values by tag number, or None if the
+        directory isn't in the header.  Values that are past the end of the
+        header are None.
+    """
+    if bigtiff:
+        offset = struct.unpack_from(byteOrder + 'Q', header, 8)[0]
+        countFormat, entryFormat, entrySize, inlineSize = 'Q', 'HHQ', 20, 8
+    else:
+        offset = struct.unpack_from(byteOrder + 'I', header, 4)[0]
+        countFormat, entryFormat, entrySize, inlineSize = 'H', 'HHI', 12, 4
+    countSize = struct.calcsize(countFormat)
+    if offset + countSize > len(header):
+        return None
+    count = struct.unpack_from(byteOrder + countFormat, header, offset)[0]
+    if offset + countSize + count * entrySize > len(header):
+        return None
+    tags = {}
+    for entry in range(count):
+        pos = offset + countSize + entry * entrySize
+        tag, valueType, valueCount = struct.unpack_from(
+            byteOrder + entryFormat, header, pos)
+        if tag in tags:
+            # Only the first of repeated tags is used, as libtiff does
+            continue
+        valuePos = pos + struct.calcsize(byteOrder + entryFormat)
+        size = TiffTypeSizes.get(valueType, 1) * valueCount
+        if size > inlineSize:
+            valuePos = struct.unpack_from(
+                byteOrder + ('Q' if bigtiff else 'I'), header, valuePos)[0]
+        if valuePos + size > len(header):
+            tags[tag] = None
+        elif valueType == 2:
+            tags[tag] = header[valuePos:valuePos + size].rstrip(b'\0')
+        elif valueType in TiffTypeFormats and valueCount:
+            tags[tag] = struct.unpack_from(
+                byteOrder + TiffTypeFormats[valueType], header, valuePos)[0]
+        else:
+            tags[tag] = b''
+    return tags
+
+
+def sniffHeader(header):
+    """
+    Describe a file from its first bytes.
+
+    :param header: the first HeaderSize bytes of the file, or all of it if it
+        is shorter.
+    :returns: a dictionary with 'format', one of 'tiff', 'bigtiff', a value
+        from Signatures, or None if it isn't known.  For tiff files, 'tiled'
+        and 'compression' are the values of the first image, and 'vendor' is
+        'aperio', 'hamamatsu', 'ome', 'geotiff', or '' for none of these.
+        Each of these is None if it isn't in the header.
+    """
+    info = {'format': None}
+    if header[:4] in (b'II*\0', b'MM\0*', b'II+\0', b'MM\0+'):
+        byteOrder = '<' if header[:2] == b'II' else '>'
+        bigtiff = header[2:4] in (b'+\0', b'\0+')
+        info.update({'format': 'bigtiff' if bigtiff else 'tiff',
+                     'tiled': None, 'compression': None, 'vendor': None})
+        try:
+            tags = _readTiffTags(header, byteOrder, bigtiff)
+        except struct.error:
+            tags = None
+        if tags is None:
+            return info
+        description = tags.get(TiffTags['description'], b'')
+        info['tiled'] = TiffTags['tileWidth'] in tags
+        info['compression'] = tags.get(TiffTags['compression'], 1)
+        if TiffTags['ndpiFormat'] in tags:
+            info['vendor'] = 'hamamatsu'
+        elif description is None:
+            # The description is past the header
+            pass
+        elif description.startswith(b'Aperio'):
+            info['vendor'] = 'aperio'
+        elif b'<OME' in description:
+            info['vendor'] = 'ome'
+        elif any(tag in tags for tag in GeoTiffTags):
+            info['vendor'] = 'geotiff'
+        else:
+            info['vendor'] = ''
+        return info
+    for offset, signature, format in Signatures:
+        if header[offset:offset + len(signature)] == signature:
+            info['format'] = format
+            break
+    return info
+
+
+def _isTiff(info):
+    return info['format'] in ('tiff', 'bigtiff')
+
+
+def _canReadTiled(info):
+    # The libtiff based sources need tiled images that libtiff can decode
+    return _isTiff(info) and info['tiled'] is not False and (
+        info['compression'] not in Jpeg2000Compression)
+
+
+def _canReadSlide(info):
+    # OpenSlide reads vendor formats, tiled tiff, and formats that are not
+    # recognized here, such as MIRAX and VMS index files
+    if info['format'] is None or info['format'] == 'dicom':
+        return True
+    return _isTiff(info) and (info['tiled'] is not False or info['vendor'] in (
+        'aperio', 'hamamatsu'))
+
+
+def _canReadOme(info):
+    return _isTiff(info) and info['vendor'] in (None, 'ome')
+
+
+def _canReadPil(info):
+    # Pyramidal files are read by the tiled sources rather than as one image
+    if _isTiff(info):
+        return info['tiled'] is not True
+    return info['format'] not in ('dicom', 'czi')
+
+
+def _canReadJpeg2000(info):
+    return info['format'] in ('jpeg2000', None)
+
+
+# Checks for the tile sources whose formats are known, by source name
+SourceChecks = {
+    'tiff': _canReadTiled,
+    'tifffile': _canReadTiled,
+    'openslide': _canReadSlide,
+    'ometiff': _canReadOme,
+    'pil': _canReadPil,
+    'openjpeg': _canReadJpeg2000,
+}
+
+
+def plausibleSources(info, sourceNames):
+    """
+    Select the tile sources that might read a file.
+
+    :param info: the result of sniffHeader for the file.
+    :param sourceNames: the names of the tile sources, in the order they
+        are tried.
+    :returns: the names of the sources that might read the file, in the same
+        order.  If the format of the file isn't known, all of them are
+        returned.
+    """
+    return [name for name in sourceNames
+            if name not in SourceChecks or SourceChecks[name](info)]
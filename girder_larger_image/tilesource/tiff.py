@@ -1,9 +1,6 @@
 from six import BytesIO
 
 import PIL.Image
-import PIL.ImageOps
-import PIL.ImageMath
-import PIL.ImagePalette
 
 import numpy
 
@@ -11,223 +8,567 @@ import large_image_source_tiff as tiff
 # from girder.plugins.large_image.tilesource.base import GirderTileSource, \
 #     TILE_FORMAT_PIL
 
-from large_image.tilesource.base import TILE_FORMAT_PIL
+from large_image.cache_util import methodcache
+from large_image.exceptions import TileSourceException
+from large_image.tilesource.base import TILE_FORMAT_NUMPY, TILE_FORMAT_PIL
 
 from large_image_source_tiff import girder_source
+from large_image_source_tiff.tiff_reader import \
+    InvalidOperationTiffException, IOTiffException
 
+from ..cache_util import LruCache, getConfig, registerCache
+from .histogram import countDirectory, countTile, histogramRange
+from .lut import directLut, getLut, lutDepth, lutStart, paramsKey
 from .tiff_reader import TiledTiffDirectory
 
 tiff.TiledTiffDirectory = TiledTiffDirectory
 
+# Encoded tiles with only zero pixels, by tile shape and output parameters
+emptyTileCache = registerCache('emptytile', LruCache(maxSize=256))
+
+# Unprocessed tiles built from coarser levels for levels or tiles that are
+# missing from the file, and the coarser tiles they were built from
+sparseTileCache = registerCache('sparsetile', LruCache(
+    maxSize=int(getConfig('sparse_tile_cache_size', 256))))
+
+# Parameters that change the pixels of an output tile
+ProcessingParams = ('normalize', 'normalizeMin', 'normalizeMax', 'exclude',
+                    'oneHot', 'label', 'invertLabel', 'flattenLabel',
+                    'colormap', 'bit', 'bits')
+
 
 class TiffFileTileSource(tiff.TiffFileTileSource):
     cacheName = 'tilesource'
     name = 'tifffile'
 
-    # def _editing(self, tile, tileEncoding, mask, value):
-    #     if tileEncoding != TILE_FORMAT_PIL:
-    #         tile = PIL.Image.open(BytesIO(tile))
-    #         tileEncoding = TILE_FORMAT_PIL
-    #     tileArray = numpy.asarray(tile)
-    #     newtile = numpy.ma.array(tileArray, mask=mask, fill_value=value)
-    #     newtile = newtile.filled()
-    #     tile = PIL.Image.fromarray(newtile)
-    #     return tile, tileEncoding
-    def _bit(self, tile, tileEncoding, channel, colormap=None):
-        if tileEncoding != TILE_FORMAT_PIL:
-            tile = PIL.Image.open(BytesIO(tile))
-            tileEncoding = TILE_FORMAT_PIL
-        if tile.mode != 'L':
-            raise NotImplementedError('8-bit oneHot images only')
-        if channel:
-            mask = numpy.asarray(tile) >> (channel - 1) & 1
-            mask *= 255
-        else:
-            mask = numpy.zeros((tile.size[1], tile.size[0]), numpy.uint8)
-            mask[numpy.asarray(tile) == 0] = 255
-        if colormap is None:
-            color = None
-        else:
-            color = 'rgb' + str(tuple(colormap[int(round(channel*255/8.0))]))
-        tile = PIL.Image.new('RGBA', tile.size, color)
-        tile.putalpha(PIL.Image.fromarray(mask))
-        return tile, tileEncoding
-
-    def _normalizeImage(self, tile, tileEncoding, range_, exclude=None,
-                        oneHot=False):
-        if tileEncoding != TILE_FORMAT_PIL:
-            tile = PIL.Image.open(BytesIO(tile))
-            tileEncoding = TILE_FORMAT_PIL
-        if len(tile.getbands()) > 1:
-            if range_ == (0, 255) and not exclude and not oneHot:
-                return tile, tileEncoding
-            raise NotImplementedError('single band label images only')
-        if oneHot:
-            if tile.mode != 'L':
-                raise NotImplementedError('8-bit oneHot images only')
-            mask = numpy.asarray(tile)
-            array = numpy.zeros(mask.shape, dtype=numpy.uint8)
-            min_, max_ = max(1, int(range_[0])), min(8, int(range_[1]))
-            for i in range(min_, max_ + 1):
-                if oneHot and exclude and i in exclude:
+    def getTile(self, x, y, z, pilImageAllowed=False, numpyAllowed=False,
+                sparseFallback=False, **kwargs):
+        # Edited tiles are read outside of the tile cache, so an edit doesn't
+        # change the state of the source or the cached tiles of the file.
+        overlay = getattr(self, '_overlay', None)
+        if (overlay is not None and not kwargs.get('frame') and
+                (z, x, y) in overlay[1]):
+            tile = overlay[2](z, x, y)
+            if tile is not None:
+                return self._outputTile(tile, TILE_FORMAT_NUMPY, x, y, z,
+                                        pilImageAllowed, numpyAllowed,
+                                        **kwargs)
+        return self._getFileTile(
+            x, y, z, pilImageAllowed=pilImageAllowed,
+            numpyAllowed=numpyAllowed, sparseFallback=sparseFallback,
+            **kwargs)
+
+    @methodcache()
+    def _getFileTile(self, x, y, z, pilImageAllowed=False,
+                     numpyAllowed=False, sparseFallback=False, **kwargs):
+        # LZW, Deflate, and uncompressed tiles are decoded straight into a
+        # numpy array so processing doesn't round trip through PIL.
+        directory = None
+        if not kwargs.get('frame') and 0 <= z < len(self._tiffDirectories):
+            directory = self._tiffDirectories[z]
+            if directory is None and self._useSparseFallback(sparseFallback):
+                tile = self._synthesizeTile(x, y, z)
+                if tile is not None:
+                    return self._outputTile(
+                        tile, TILE_FORMAT_NUMPY, x, y, z, pilImageAllowed,
+                        numpyAllowed, **kwargs)
+        emptyFastPath = (directory is not None and not kwargs.get('edge') and
+                         self.hasProcessing(**kwargs))
+        if emptyFastPath and (directory.isTileEmpty(x, y) or
+                              self._hasOnlyEmptyLabels(x, y, z, **kwargs)):
+            return self._emptyTile(directory, x, y, z, pilImageAllowed,
+                                   numpyAllowed, **kwargs)
+        if directory is None or not directory.canReadArray():
+            return super(TiffFileTileSource, self).getTile(
+                x, y, z, pilImageAllowed=pilImageAllowed,
+                numpyAllowed=numpyAllowed, sparseFallback=sparseFallback,
+                **kwargs)
+        try:
+            tile = directory.getTile(x, y, asArray=True)
+        except InvalidOperationTiffException as e:
+            raise TileSourceException(e.args[0])
+        except IOTiffException:
+            # A tile that was never written is only built from a coarser
+            # level when asked; otherwise it is handled as large_image does
+            tile = self._synthesizeTile(x, y, z) if sparseFallback else None
+            if tile is None:
+                return super(TiffFileTileSource, self).getTile(
+                    x, y, z, pilImageAllowed=pilImageAllowed,
+                    numpyAllowed=numpyAllowed, sparseFallback=sparseFallback,
+                    **kwargs)
+            return self._outputTile(tile, TILE_FORMAT_NUMPY, x, y, z,
+                                    pilImageAllowed, numpyAllowed, **kwargs)
+        if emptyFastPath and not tile.any():
+            directory.noteEmptyTile(x, y)
+            return self._emptyTile(directory, x, y, z, pilImageAllowed,
+                                   numpyAllowed, **kwargs)
+        return self._outputTile(tile, TILE_FORMAT_NUMPY, x, y, z,
+                                pilImageAllowed, numpyAllowed, **kwargs)
+
+    def setOverlay(self, version, tiles, getOverlayTile):
+        """
+        Read edited tiles in place of the tiles in the file.
+
+        :param version: the overlay version of the item that the edited tiles
+            were listed for.
+        :param tiles: a dictionary of the overlay version of each edited tile
+            keyed by (z, x, y).
+        :param getOverlayTile: a function called with (z, x, y) that returns
+            the unprocessed pixels of an edited tile or None.
+        """
+        self.overlayVersion = version
+        self._overlay = (version, dict(tiles), getOverlayTile) if (
+            tiles) else None
+
+    def getEditVersion(self, x, y, z):
+        """
+        Get the overlay version of an edited tile.
+
+        :param x: the tile column.
+        :param y: the tile row.
+        :param z: the tile level.
+        :returns: the version, or None if the tile was not edited.
+        """
+        overlay = getattr(self, '_overlay', None)
+        return overlay[1].get((z, x, y)) if overlay is not None else None
+
+    def getTileArray(self, x, y, z, edits=True):
+        """
+        Get the unprocessed pixels of a whole tile, including edits.  Edge
+        tiles include the padding past the image.  A tile that is not in the
+        file is built from a coarser level or is all zero.
+
+        :param x: the tile column.
+        :param y: the tile row.
+        :param z: the tile level.
+        :param edits: if False, get the pixels of the file without edits.
+        :returns: a writable array.
+        """
+        if not 0 <= z < len(self._tiffDirectories):
+            raise TileSourceException('z layer does not exist')
+        overlay = getattr(self, '_overlay', None)
+        if edits and overlay is not None and (z, x, y) in overlay[1]:
+            tile = overlay[2](z, x, y)
+            if tile is not None:
+                return tile.copy()
+        directory = self._tiffDirectories[z]
+        tile = (self._readTileArray(directory, x, y)
+                if directory is not None else None)
+        if tile is None:
+            tile = self._synthesizeTile(x, y, z)
+            if tile is not None:
+                return tile.copy()
+        if tile is None:
+            directory = next(d for d in self._tiffDirectories
+                             if d is not None)
+            samples = directory._tiffInfo.get('samplesperpixel') or 1
+            tile = numpy.zeros(
+                (self.tileHeight, self.tileWidth) + (
+                    (samples, ) if samples > 1 else ()),
+                dtype=directory._arrayDtype() or numpy.dtype(numpy.uint8))
+        return tile
+
+    def _useSparseFallback(self, sparseFallback):
+        # Levels of label images that are missing from the file are built
+        # from coarser levels unless this is turned off, since the
+        # large_image default of combining finer tiles is slow and blends
+        # label values.  Other images are left to large_image.
+        if sparseFallback:
+            return True
+        return self.isLabelImage() and str(getConfig(
+            'sparse_fallback', True)).lower() not in ('false', '0', 'no')
+
+    def _readTileArray(self, directory, x, y):
+        """
+        Read a tile of a directory as an array that can be kept.
+
+        :returns: the array, or None if the tile is not in the file.
+        """
+        try:
+            tile = directory.getTile(x, y, asArray=True)
+        except (IOTiffException, InvalidOperationTiffException):
+            return None
+        if isinstance(tile, numpy.ndarray):
+            return tile.copy()
+        return self._tileArray(
+            tile, TILE_FORMAT_PIL if isinstance(tile, PIL.Image.Image)
+            else 'JPEG')
+
+    def _synthesizeTile(self, x, y, z):
+        """
+        Build a tile that is missing from the file from the nearest coarser
+        level that has the area.  Pixels are repeated rather than
+        interpolated, so label values are never blended.
+
+        :param x: the tile column.
+        :param y: the tile row.
+        :param z: the tile level.
+        :returns: the unprocessed tile as an array, or None if no coarser
+            level has the area.
+        """
+        sourceKey = getattr(self, 'largeImagePath', None) or id(self)
+        key = (sourceKey, z, x, y)
+        tile = sparseTileCache.get(key)
+        if tile is not None:
+            return tile
+        for parentZ in range(z - 1, -1, -1):
+            directory = self._tiffDirectories[parentZ]
+            if directory is None:
+                continue
+            scale = 2 ** (z - parentZ)
+            parentX, parentY = x // scale, y // scale
+            parentKey = (sourceKey, parentZ, parentX, parentY)
+            parent = sparseTileCache.get(parentKey)
+            if parent is None:
+                parent = self._readTileArray(directory, parentX, parentY)
+                if parent is None:
+                    continue
+                sparseTileCache.put(parentKey, parent)
+            rows = ((y % scale) * self.tileHeight +
+                    numpy.arange(self.tileHeight)) // scale
+            cols = ((x % scale) * self.tileWidth +
+                    numpy.arange(self.tileWidth)) // scale
+            tile = parent[rows[:, numpy.newaxis], cols]
+            sparseTileCache.put(key, tile)
+            return tile
+        return None
+
+    def _emptyTile(self, directory, x, y, z, pilImageAllowed=False,
+                   numpyAllowed=False, **kwargs):
+        """
+        Get the output for a tile with only zero pixels.  Encoded empty tiles
+        only depend on the tile shape and the output parameters, so they are
+        produced once and shared.
+
+        :param directory: the directory of the tile.
+        :returns: the tile in the same form as getTile.
+        """
+        dtype = directory._arrayDtype() or numpy.dtype(numpy.uint8)
+        samples = directory._tiffInfo.get('samplesperpixel') or 1
+        shape = (self.tileHeight, self.tileWidth) + (
+            (samples, ) if samples > 1 else ())
+        if pilImageAllowed or numpyAllowed:
+            return self._outputTile(
+                numpy.zeros(shape, dtype=dtype), TILE_FORMAT_NUMPY, x, y, z,
+                pilImageAllowed, numpyAllowed, **kwargs)
+        key = (shape, dtype.str, self.getOutputEncoding(**kwargs),
+               self.encoding, self.jpegQuality, self.jpegSubsampling,
+               getattr(self, 'tiffCompression', None), paramsKey(**{
+                   k: kwargs.get(k) for k in ProcessingParams}))
+        tile = emptyTileCache.get(key)
+        if tile is None:
+            tile = self._outputTile(
+                numpy.zeros(shape, dtype=dtype), TILE_FORMAT_NUMPY, x, y, z,
+                **kwargs)
+            emptyTileCache.put(key, tile)
+        return tile
+
+    def isLabelImage(self):
+        """
+        Check if the image has a single band of integers, as label images
+        do.
+
+        :returns: True if the image could be a label image.
+        """
+        directory = next(
+            (d for d in self._tiffDirectories if d is not None), None)
+        if directory is None:
+            return False
+        dtype = directory._arrayDtype()
+        return ((directory._tiffInfo.get('samplesperpixel') or 1) == 1 and
+                dtype is not None and dtype.kind in 'ui')
+
+    def scanLevel(self, z):
+        """
+        Summarize each tile of a level: whether it has nonzero pixels, its
+        minimum and maximum, and, for single band 8-bit images, which values
+        it contains.  This reads every tile of the level that cannot be
+        checked without decoding.  Edited tiles are summarized from their
+        edited pixels.
+
+        :param z: the tile level.
+        :returns: a dictionary with 'occupancy', 'min', 'max', and 'labels'
+            arrays of (tilesDown, tilesAcross), the last with an extra axis
+            of the 256 values packed into 32 bytes or None, or None if the
+            level is not stored in the file.
+        """
+        if not 0 <= z < len(self._tiffDirectories):
+            return None
+        directory = self._tiffDirectories[z]
+        if directory is None:
+            return None
+        directory.setOccupancy(None)
+        shape = (directory._tilesDown, directory._tilesAcross)
+        dtype = directory._arrayDtype() or numpy.dtype(numpy.uint8)
+        samples = directory._tiffInfo.get('samplesperpixel') or 1
+        result = {
+            'occupancy': numpy.zeros(shape, dtype=bool),
+            'min': numpy.zeros(shape, dtype=dtype),
+            'max': numpy.zeros(shape, dtype=dtype),
+            # The values of each tile are kept as packed bits
+            'labels': (numpy.zeros(shape + (32, ), dtype=numpy.uint8)
+                       if dtype == numpy.uint8 and samples == 1 else None),
+        }
+        # Occupancy and label sets that include edits are still right for
+        # the file's tiles, since edited tiles are read before the file's
+        overlay = getattr(self, '_overlay', None)
+        for y in range(shape[0]):
+            for x in range(shape[1]):
+                tile = None
+                edited = overlay is not None and (z, x, y) in overlay[1]
+                if edited:
+                    tile = overlay[2](z, x, y)
+                    edited = tile is not None
+                if not edited and not directory.isTileEmpty(x, y):
+                    try:
+                        tile = directory.getTile(x, y, asArray=True)
+                    except IOTiffException:
+                        pass
+                if tile is not None:
+                    if isinstance(tile, PIL.Image.Image):
+                        tile = numpy.asarray(tile)
+                    elif not isinstance(tile, numpy.ndarray):
+                        tile = self._tileArray(tile, 'JPEG')
+                    # Edge tiles are padded past the image
+                    tile = tile[:directory._imageHeight -
+                                y * directory._tileHeight,
+                                :directory._imageWidth -
+                                x * directory._tileWidth]
+                if tile is None or not tile.any():
+                    if tile is not None and not edited:
+                        directory.noteEmptyTile(x, y)
+                    if result['labels'] is not None:
+                        result['labels'][y, x, 0] = 0x80
                     continue
-                value = int(i*255/8)
-                array[numpy.nonzero(mask & 1 << i - 1)] = value
-            tile = PIL.Image.fromarray(array)
+                result['occupancy'][y, x] = True
+                result['min'][y, x] = tile.min()
+                result['max'][y, x] = tile.max()
+                if result['labels'] is not None:
+                    result['labels'][y, x] = numpy.packbits(numpy.bincount(
+                        tile.ravel(), minlength=256) > 0)
+        directory.setOccupancy(result['occupancy'])
+        self.setLabelIndex(z, result['labels'])
+        return result
+
+    def getOccupancy(self, z):
+        """
+        Find which tiles of a level have nonzero pixels.
+
+        :param z: the tile level.
+        :returns: a boolean array of (tilesDown, tilesAcross), or None if the
+            level is not stored in the file.
+        """
+        scan = self.scanLevel(z)
+        return scan['occupancy'] if scan is not None else None
+
+    def getLevelHistogram(self, z):
+        """
+        Count the values of each band of a level, including edits.
+
+        :param z: the tile level.
+        :returns: the value of the first bin and an int64 array of (bands,
+            bins) with a bin for every value of the image data type.
+        """
+        if (not 0 <= z < len(self._tiffDirectories) or
+                self._tiffDirectories[z] is None):
+            raise TileSourceException('Level %d is not stored in the file.' % z)
+        directory = self._tiffDirectories[z]
+        start, counts = countDirectory(directory)
+        overlay = getattr(self, '_overlay', None)
+        edited = [(x, y) for tz, x, y in (overlay[1] if overlay else ())
+                  if tz == z]
+        for x, y in edited:
+            tile = overlay[2](z, x, y)
+            if tile is None:
+                continue
+            height = min(directory._tileHeight,
+                         directory._imageHeight - y * directory._tileHeight)
+            width = min(directory._tileWidth,
+                        directory._imageWidth - x * directory._tileWidth)
+            # Tiles that are not in the file were counted as zero
+            original = self._readTileArray(directory, x, y)
+            if original is None:
+                original = numpy.zeros_like(tile)
+            bins = histogramRange(tile.dtype)[1]
+            change = (countTile(tile, start, bins, height, width) -
+                      countTile(original, start, bins, height, width))
+            counts += change
+        return start, counts
+
+    def setLabelIndex(self, z, labels):
+        """
+        Use the values found in each tile by a previous scanLevel call, so
+        that tiles whose values are all processed like zero are answered
+        without reading them.
+
+        :param z: the tile level.
+        :param labels: a uint8 array of (tilesDown, tilesAcross, 32) with a
+            bit for each of the 256 values, most significant bit first, or
+            None to forget a previous value.
+        """
+        if not hasattr(self, '_labelIndex'):
+            self._labelIndex = {}
+        if labels is None:
+            self._labelIndex.pop(z, None)
         else:
-            array = numpy.asarray(tile, dtype=numpy.float32)
-            min_, max_ = range_
-            if min_ == max_:
-                array[numpy.where(array != min_)] = 0
-                array[numpy.nonzero(array)] = min_
-            else:
-                array[numpy.where(array > max_)] = 0
-                array[numpy.where(array < min_)] = 0
-                # array[numpy.nonzero(array)] = (array[numpy.nonzero(array)]
-                # - min_)*255/(max_ - min_)
-            # remove artifact generated from visual mistake
-            tile = PIL.Image.fromarray(array.round())
-            tile = tile.convert('L')
-        return tile, tileEncoding
-
-    def _colormapImage(self, tile, tileEncoding, colormap, label=False):
-        if tileEncoding != TILE_FORMAT_PIL:
-            tile = PIL.Image.open(BytesIO(tile))
-            tileEncoding = TILE_FORMAT_PIL
-        if len(tile.getbands()) > 1:
+            self._labelIndex[z] = labels
+
+    def _hasOnlyEmptyLabels(self, x, y, z, **kwargs):
+        """
+        Check if the indexed values of a tile are all processed the same as
+        zero, in which case the tile is the same as an empty tile.
+        """
+        labels = getattr(self, '_labelIndex', {}).get(z)
+        if labels is None or not (0 <= y < labels.shape[0] and
+                                  0 <= x < labels.shape[1]):
+            return False
+        params = {k: kwargs[k] for k in ProcessingParams
+                  if kwargs.get(k) is not None}
+        table = getLut(256, **params).table
+        present = numpy.unpackbits(labels[y, x]).astype(bool)
+        return bool((table[present] == table[0]).all())
+
+    def setOccupancy(self, z, occupancy):
+        """
+        Use the result of a previous getOccupancy call so that empty tiles
+        are found without reading them.
+
+        :param z: the tile level.
+        :param occupancy: a boolean array of (tilesDown, tilesAcross).
+        """
+        if (0 <= z < len(self._tiffDirectories) and
+                self._tiffDirectories[z] is not None):
+            self._tiffDirectories[z].setOccupancy(occupancy)
+
+    def _tileArray(self, tile, tileEncoding):
+        if tileEncoding == TILE_FORMAT_NUMPY:
+            array = tile
+        else:
+            if tileEncoding != TILE_FORMAT_PIL:
+                tile = PIL.Image.open(BytesIO(tile))
+            array = numpy.asarray(tile)
+        if array.ndim == 3 and array.shape[2] == 1:
+            array = array[:, :, 0]
+        return array
+
+    def _processTile(self, tile, tileEncoding, **kwargs):
+        """
+        Apply the normalize, oneHot, bit, label, and colormap parameters to a
+        tile using a single compiled lookup table.
+
+        :param tile: the tile data.
+        :param tileEncoding: the format of the tile data.
+        :param kwargs: the processing parameters.
+        :returns: the processed tile and its format.
+        """
+        if not self.hasProcessing(**kwargs):
             return tile, tileEncoding
-            raise NotImplementedError('single band label images only')
-        if label:
-            # ouch
-            mask = tile.point(lambda x: 0 if x == 0 else 255, '1')
-        # colormap = bytes(bytearray([0, 0, 0, 248, 21, 21, 78, 253, 4, 11, 0, 255]))
-
-        # palette = PIL.ImagePalette.ImagePalette(palette=colormap, size=len(colormap))
-        palette = PIL.ImagePalette.ImagePalette(palette=colormap)
-        # palette = [0, 255, 15, 41, 0, 0, 255, 0, 0, 0, 0, 255]
-        # palette = bytearray(b'\x00\xff\x0f)\x00\x00\xff\x00\x00\x00\x00\xff')
-        tile.putpalette(palette)
-
-        if label:
-            tile = tile.convert('RGB')
-            tile.putalpha(mask)
-        return tile, tileEncoding
-
-    def _labelImage(self, tile, tileEncoding, invert=True, flatten=False):
-        if tileEncoding != TILE_FORMAT_PIL:
-            tile = PIL.Image.open(BytesIO(tile))
-            tileEncoding = TILE_FORMAT_PIL
-        if len(tile.getbands()) > 1:
-            raise NotImplementedError('single band label images only')
-        if flatten:
-            if tile.mode == 'I':
-                n = 65536
-            elif tile.mode == 'L':
-                n = 256
-            else:
-                raise NotImplementedError('8-bit and 32-bit grayscale images only')
-            lut = numpy.zeros(n)
-            lut.fill(255)
-            lut[0] = 0
-            mask = tile.point(lut, 'L')
+        array, mode, palette = self.processArray(
+            self._tileArray(tile, tileEncoding), **kwargs)
+        if mode is None:
+            return tile, tileEncoding
+        if mode == 'P':
+            tile = PIL.Image.fromarray(array, 'L')
+            tile.putpalette(palette)
         else:
-            mask = tile.convert('L')
-        if invert:
-            mask = PIL.ImageOps.invert(mask)
-        tile = PIL.Image.new('RGBA', mask.size, 'white')
-        tile.putalpha(mask)
-        return tile, tileEncoding
-
-    def _outputTile(self, tile, tileEncoding, *args, **kwargs):
-        # print(tile)
-        encoding = self.encoding
-        # editing = kwargs.get('editing')
-        # if editing is not None:
-        #     if int(editing) != 0:
-        #         mask = numpy.zeros((256, 256), dtype=bool)
-        #         for x in range(63,128):
-        #             for y in range(63,128):
-        #                 mask[x][y] = 1
-        #         value = 0
-        #         tile, tileEncoding = self._editing(tile, tileEncoding, mask, value)
-
-        bit = kwargs.get('bit')
-        if bit is not None:
-            tile, tileEncoding = self._bit(tile, tileEncoding, bit,
-                                           kwargs.get('colormap'))
-            self.encoding = 'PNG'
-            result = super(TiffFileTileSource, self)._outputTile(tile,
-                                                                 tileEncoding,
-                                                                 *args,
-                                                                 **kwargs)
-            self.encoding = encoding
-            return result
-
-        oneHot = kwargs.get('oneHot', False)
-        if 'normalize' in kwargs and kwargs['normalize'] or oneHot:
-            min_ = kwargs.get('normalizeMin', 0)
-            max_ = kwargs.get('normalizeMax', 255)
-            exclude = kwargs.get('exclude')
-            tile, tileEncoding = self._normalizeImage(tile, tileEncoding,
-                                                      range_=(min_, max_),
-                                                      exclude=exclude,
-                                                      oneHot=oneHot)
-
-        label = kwargs.get('label', False)
-
-        if 'colormap' in kwargs and kwargs['colormap']:
-            colormap = kwargs['colormap']
-            tile, tileEncoding = self._colormapImage(tile, tileEncoding,
-                                                     colormap, label)
-            self.encoding = 'PNG'
-        elif label:
-            invert = kwargs.get('invertLabel', True)
-            flatten = kwargs.get('flattenLabel', False)
-            tile, tileEncoding = self._labelImage(tile, tileEncoding,
-                                                  invert=invert,
-                                                  flatten=flatten)
-            self.encoding = 'PNG'
-
-        result = super(TiffFileTileSource, self)._outputTile(tile,
-                                                             tileEncoding,
-                                                             *args, **kwargs)
-        self.encoding = encoding
-        return result
+            tile = PIL.Image.fromarray(array, mode)
+        return tile, TILE_FORMAT_PIL
+
+    @staticmethod
+    def hasProcessing(**kwargs):
+        """
+        Check if a set of parameters changes the pixels of a tile.
+
+        :param kwargs: the processing parameters.
+        :returns: True if the parameters require processing.
+        """
+        return bool(kwargs.get('bit') is not None or kwargs.get('bits') or
+                    kwargs.get('normalize') or kwargs.get('oneHot') or
+                    kwargs.get('colormap') or kwargs.get('label'))
+
+    def processArray(self, array, **kwargs):
+        """
+        Apply the normalize, oneHot, bit, label, and colormap parameters to
+        an image array.  This is used for tiles and for blocks of regions.
 
-    # def saveTile(self, x, y, z, data, **kwargs):
-    #     print 'save modified tile in tiff.py'
-    #     try:
-    #         if self._tiffDirectories[z] is None:
-    #             if sparseFallback:
-    #                 raise IOTiffException('Missing z level %d' % z)
-    #             tile = self.getTileFromEmptyDirectory(x, y, z)
-    #             format = TILE_FORMAT_PIL
-    #         else:
-    #             tile = self._tiffDirectories[z].saveTile(x, y, data)
-    #             format = 'JPEG'
-    #         if PIL and isinstance(tile, PIL.Image.Image):
-    #             format = TILE_FORMAT_PIL
-    #         return self._outputTile(tile, format, x, y, z, pilImageAllowed,
-    #                                 **kwargs)
-    #     except IndexError:
-    #         raise TileSourceException('z layer does not exist')
-    #     except InvalidOperationTiffException as e:
-    #         raise TileSourceException(e.args[0])
-    #     except IOTiffException as e:
-    #         if sparseFallback and z and PIL:
-    #             image = self.getTile(x / 2, y / 2, z - 1, pilImageAllowed=True,
-    #                                  sparseFallback=sparseFallback, edge=False)
-    #             if not isinstance(image, PIL.Image.Image):
-    #                 image = PIL.Image.open(BytesIO(image))
-    #             image = image.crop((
-    #                 self.tileWidth / 2 if x % 2 else 0,
-    #                 self.tileHeight / 2 if y % 2 else 0,
-    #                 self.tileWidth if x % 2 else self.tileWidth / 2,
-    #                 self.tileHeight if y % 2 else self.tileHeight / 2))
-    #             image = image.resize((self.tileWidth, self.tileHeight))
-    #             return self._outputTile(image, 'PIL', x, y, z, pilImageAllowed,
-    #                                     **kwargs)
-    #         raise TileSourceException('Internal I/O failure: %s' % e.args[0])
+        :param array: a two dimensional array, or a three dimensional array
+            with one or more bands.
+        :param kwargs: the processing parameters.
+        :returns: the processed array, its PIL mode, and, for 'P' mode, the
+            palette.  The mode is None if the array was not changed.
+        """
+        params = {k: kwargs[k] for k in ProcessingParams
+                  if kwargs.get(k) is not None}
+        if array.ndim == 3 and array.shape[2] == 1:
+            array = array[:, :, 0]
+        if not self.hasProcessing(**params):
+            return array, None, None
+        normalize = params.get('normalize') or params.get('oneHot')
+        bits = params.get('bit') is not None or params.get('bits')
+        if array.ndim > 2:
+            if bits:
+                raise NotImplementedError('8-bit oneHot images only')
+            if normalize and (
+                    (params.get('normalizeMin', 0),
+                     params.get('normalizeMax', 255)) != (0, 255) or
+                    params.get('exclude') or params.get('oneHot')):
+                raise NotImplementedError('single band label images only')
+            if params.get('label') and not params.get('colormap'):
+                raise NotImplementedError('single band label images only')
+            return array, None, None
+        if (bits or params.get('oneHot')) and array.dtype != numpy.uint8:
+            raise NotImplementedError('8-bit oneHot images only')
+        if array.dtype.kind not in 'ui':
+            raise NotImplementedError('integer images only')
+        depth = lutDepth(array)
+        if depth is None:
+            lut = directLut(array, **params)
+            return lut.table, lut.mode, lut.palette
+        lut = getLut(depth, lutStart(array), **params)
+        return lut.apply(array), lut.mode, lut.palette
+
+    def getOutputEncoding(self, **kwargs):
+        """
+        Get the encoding of tiles produced with a set of processing
+        parameters.  Bit, label, and colormap tiles have transparency or a
+        palette, so they are always PNG.
+
+        :param kwargs: the processing parameters.
+        :returns: the output encoding.
+        """
+        if (kwargs.get('bit') is not None or kwargs.get('bits') or
+                kwargs.get('colormap') or kwargs.get('label')):
+            return 'PNG'
+        return self.encoding
+
+    def _outputTile(self, tile, tileEncoding, x, y, z, pilImageAllowed=False,
+                    numpyAllowed=False, **kwargs):
+        # The encoding is chosen per call rather than by changing
+        # self.encoding, since a source is shared between threads.
+        rawTile = tile
+        tile, tileEncoding = self._processTile(tile, tileEncoding, **kwargs)
+        if (tile is rawTile and tileEncoding == TILE_FORMAT_NUMPY and
+                (pilImageAllowed or numpyAllowed)):
+            # Arrays from the directory reuse a read buffer
+            tile = tile.copy()
+        encoding = self.getOutputEncoding(**kwargs)
+        if encoding == self.encoding:
+            return super(TiffFileTileSource, self)._outputTile(
+                tile, tileEncoding, x, y, z, pilImageAllowed, numpyAllowed,
+                **kwargs)
+        tile = super(TiffFileTileSource, self)._outputTile(
+            tile, tileEncoding, x, y, z, True, numpyAllowed, **kwargs)
+        if isinstance(tile, numpy.ndarray):
+            if numpyAllowed:
+                return tile
+            tile = PIL.Image.fromarray(tile)
+        elif not isinstance(tile, PIL.Image.Image):
+            tile = PIL.Image.open(BytesIO(tile))
+        elif pilImageAllowed:
+            return tile
+        output = BytesIO()
+        tile.save(output, encoding)
+        return output.getvalue()
 
 
 class TiffGirderTileSource(TiffFileTileSource, girder_source.TiffGirderTileSource):
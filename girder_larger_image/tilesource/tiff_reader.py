@@ -1,7 +1,16 @@
 # import os
 # import six
+import ctypes
+import mmap
+import os
+import threading
+
+import numpy
+
 from girder import logger
 
+from ..cache_util import getConfig
+
 from large_image_source_tiff import tiff_reader
 
 try:
@@ -14,8 +23,99 @@ try:
 except ImportError:
     PIL = None
 
+# Compressions that are decoded by libtiff rather than passed through
+ArrayCompressionTypes = (
+    libtiff_ctypes.COMPRESSION_NONE,
+    libtiff_ctypes.COMPRESSION_ADOBE_DEFLATE,
+    libtiff_ctypes.COMPRESSION_LZW
+)
+
+# numpy kinds for TIFF SampleFormat values
+SampleFormatKinds = {1: 'u', 2: 'i', 3: 'f'}
+
+# Encoded empty tiles are remembered per directory if they are at most this
+# many bytes, up to this many different encodings
+MaxEmptySignatureSize = 65536
+MaxEmptySignatures = 4
+
+# Read-only maps of TIFF files by path, shared by the open directories of
+# each file.  Each entry is a list of the map and the number of directories
+# using it.
+_fileMaps = {}
+_fileMapsLock = threading.Lock()
+
+
+def _acquireFileMap(path):
+    """
+    Get a shared read-only memory map of a file.  The pages are backed by
+    the file, so processes that map the same file share the page cache
+    rather than holding private copies.  Each successful call must be
+    matched by a call to _releaseFileMap.
+
+    :param path: the path of the file.
+    :returns: an mmap object or None if the file could not be mapped.
+    """
+    path = os.path.realpath(path)
+    with _fileMapsLock:
+        if path not in _fileMaps:
+            try:
+                with open(path, 'rb') as f:
+                    fileMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as exc:
+                logger.info('Could not memory map %s (%s)' % (path, exc))
+                return None
+            _fileMaps[path] = [fileMap, 0]
+        _fileMaps[path][1] += 1
+        return _fileMaps[path][0]
+
+
+def _releaseFileMap(path):
+    """
+    Stop using a memory map from _acquireFileMap.  When no directory uses the
+    map, it is closed.  If tiles read from the map are still referenced, the
+    map is only dropped, and is unmapped when the last of those is freed.
+
+    :param path: the path of the file.
+    """
+    path = os.path.realpath(path)
+    with _fileMapsLock:
+        entry = _fileMaps.get(path)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _fileMaps[path]
+    try:
+        entry[0].close()
+    except BufferError:
+        pass
+
 
 class TiledTiffDirectory(tiff_reader.TiledTiffDirectory):
+    def __init__(self, *args, **kwargs):
+        self._readLock = threading.Lock()
+        self._threadBuffers = threading.local()
+        self._filePath = args[0] if args else kwargs.get('filePath')
+        self._directoryNum = (args[1] if len(args) > 1 else
+                              kwargs.get('directoryNum'))
+        self._tileLayout = None
+        self._tileOffsets = None
+        self._fileMapPath = None
+        self._occupancy = None
+        self._emptySignatures = {}
+        self._useMemoryMap = str(getConfig('memory_map', True)).lower() not in (
+            'false', '0', 'no')
+        super(TiledTiffDirectory, self).__init__(*args, **kwargs)
+
+    def _close(self):
+        if getattr(self, '_fileMapPath', None):
+            _releaseFileMap(self._fileMapPath)
+            self._fileMapPath = None
+            self._tileOffsets = None
+            self._tileLayout = None
+        super(TiledTiffDirectory, self)._close()
+
     # def _open(self, filePath, directoryNum):
     #     """
     #     Open a TIFF file to a given file and IFD number.
@@ -67,37 +167,232 @@ class TiledTiffDirectory(tiff_reader.TiledTiffDirectory):
                 not self._tiffInfo.get('tilewidth') or
                 not self._tiffInfo.get('tilelength')):
             raise tiff_reader.ValidationTiffException('Only tiled TIFF files are supported')
-    # TODO
-    # def _getJpegFrameAndSave(self, x, y, data, entire=False):
 
-    #     bytesWrite = libtiff_ctypes.libtiff.TIFFWriteTile(
-    #         self._tiffFile, data, x, y).value
-    def getTile(self, x, y):
+    def _arrayDtype(self):
+        kind = SampleFormatKinds.get(self._tiffInfo.get('sampleformat') or 1)
+        bits = self._tiffInfo.get('bitspersample') or 8
+        if kind is None or bits not in (8, 16, 32, 64) or (
+                kind == 'f' and bits < 32):
+            return None
+        return numpy.dtype('%s%d' % (kind, bits // 8))
+
+    def canReadArray(self):
+        """
+        Check if tiles of this directory can be read with getTile(asArray).
+
+        :returns: True if the tiles can be read as arrays.
+        """
+        samples = self._tiffInfo.get('samplesperpixel') or 1
+        return (
+            self._tiffInfo.get('compression') in ArrayCompressionTypes and
+            (samples == 1 or self._tiffInfo.get('planarconfig') !=
+             libtiff_ctypes.PLANARCONFIG_SEPARATE) and
+            self._arrayDtype() is not None)
+
+    def _tileBuffer(self):
+        buffer = getattr(self._threadBuffers, 'tile', None)
+        if buffer is None:
+            samples = self._tiffInfo.get('samplesperpixel') or 1
+            shape = (self._tileHeight, self._tileWidth)
+            if samples > 1:
+                shape += (samples, )
+            buffer = numpy.empty(shape, dtype=self._arrayDtype())
+            self._threadBuffers.tile = buffer
+        return buffer
+
+    def _getTileOffsets(self):
+        """
+        Get the locations of the tiles in the memory mapped file.
+
+        :returns: a tuple of the file map, an array of tile offsets, an array
+            of tile byte counts, and whether the file is byte swapped, or None
+            if the file is not memory mapped.
+        """
+        if self._tileOffsets is not None:
+            return self._tileOffsets or None
+        tileOffsets = False
+        if self._useMemoryMap and self._filePath:
+            offsets = ctypes.POINTER(ctypes.c_uint64)()
+            counts = ctypes.POINTER(ctypes.c_uint64)()
+            with self._readLock:
+                # The directory holds one reference to the map until it is
+                # closed
+                fileMap = _acquireFileMap(self._filePath)
+                if fileMap is not None:
+                    if self._fileMapPath:
+                        _releaseFileMap(self._fileMapPath)
+                    self._fileMapPath = self._filePath
+                found = fileMap is not None and (
+                    libtiff_ctypes.libtiff.TIFFGetField(
+                        self._tiffFile, libtiff_ctypes.TIFFTAG_TILEOFFSETS,
+                        ctypes.byref(offsets)) and
+                    libtiff_ctypes.libtiff.TIFFGetField(
+                        self._tiffFile, libtiff_ctypes.TIFFTAG_TILEBYTECOUNTS,
+                        ctypes.byref(counts)))
+                swapped = libtiff_ctypes.libtiff.TIFFIsByteSwapped(
+                    self._tiffFile)
+            if found:
+                numTiles = self._tilesAcross * self._tilesDown
+                tileOffsets = (
+                    fileMap,
+                    numpy.ctypeslib.as_array(offsets, (numTiles, )).copy(),
+                    numpy.ctypeslib.as_array(counts, (numTiles, )).copy(),
+                    bool(getattr(swapped, 'value', swapped)))
+            elif fileMap is not None:
+                with self._readLock:
+                    _releaseFileMap(self._fileMapPath)
+                    self._fileMapPath = None
+        self._tileOffsets = tileOffsets
+        return tileOffsets or None
+
+    def _getTileLayout(self):
+        """
+        Get what is needed to read uncompressed tiles from a memory map.
+
+        :returns: a tuple of the file map, an array of tile offsets, an array
+            of tile byte counts, and the dtype of the tile data in the file,
+            or None if tiles must be read through libtiff.
+        """
+        if self._tileLayout is not None:
+            return self._tileLayout or None
+        layout = False
+        samples = self._tiffInfo.get('samplesperpixel') or 1
+        tileOffsets = None
+        if (self._useMemoryMap and self._tiffInfo.get('compression') ==
+                libtiff_ctypes.COMPRESSION_NONE and self.canReadArray()):
+            tileOffsets = self._getTileOffsets()
+        if tileOffsets is not None:
+            fileMap, offsets, counts, swapped = tileOffsets
+            dtype = self._arrayDtype()
+            if swapped:
+                dtype = dtype.newbyteorder()
+            layout = (fileMap, offsets, counts, dtype,
+                      self._tileHeight * self._tileWidth * samples)
+        self._tileLayout = layout
+        return layout or None
+
+    def setOccupancy(self, occupancy):
+        """
+        Set which tiles have nonzero pixels, as found by a previous scan.
+
+        :param occupancy: a boolean array of (tilesDown, tilesAcross), or
+            None to forget a previous value.
+        """
+        if occupancy is not None and occupancy.shape != (
+                self._tilesDown, self._tilesAcross):
+            raise ValueError('Occupancy does not match the directory size')
+        self._occupancy = occupancy
+
+    def isTileEmpty(self, x, y):
+        """
+        Check if a tile has only zero pixels without decoding it, where this
+        is possible.  This uses the occupancy, if set, then tiles that were
+        never written, the pixels of memory mapped uncompressed tiles, and
+        the encoded bytes of tiles that were already found to be empty.
+
+        :param x: the 0-based horizontal tile number.
+        :param y: the 0-based vertical tile number.
+        :returns: True if the tile is empty, False if it has nonzero pixels,
+            or None if the tile must be decoded to tell.
+        """
+        if x < 0 or y < 0 or x >= self._tilesAcross or y >= self._tilesDown:
+            return None
+        if self._occupancy is not None:
+            return not self._occupancy[y, x]
+        tileOffsets = self._getTileOffsets()
+        if tileOffsets is None:
+            return None
+        fileMap, offsets, counts, _ = tileOffsets
+        tileNum = y * self._tilesAcross + x
+        count = int(counts[tileNum])
+        if not count:
+            return True
+        if self._getTileLayout() is not None:
+            tile = self._mapTileArray(x, y)
+            return None if tile is None else not tile.any()
+        signature = self._emptySignatures.get(count)
+        if signature is None:
+            return None
+        offset = int(offsets[tileNum])
+        return fileMap[offset:offset + count] == signature
+
+    def noteEmptyTile(self, x, y):
+        """
+        Record that a decoded tile was empty, so that other tiles with the
+        same encoded bytes are known to be empty without decoding them.
+
+        :param x: the 0-based horizontal tile number.
+        :param y: the 0-based vertical tile number.
+        """
+        tileOffsets = self._getTileOffsets()
+        if tileOffsets is None or self._getTileLayout() is not None:
+            return
+        fileMap, offsets, counts, _ = tileOffsets
+        tileNum = y * self._tilesAcross + x
+        count = int(counts[tileNum])
+        if (0 < count <= MaxEmptySignatureSize and
+                count not in self._emptySignatures and
+                len(self._emptySignatures) < MaxEmptySignatures):
+            offset = int(offsets[tileNum])
+            self._emptySignatures[count] = fileMap[offset:offset + count]
+
+    def _mapTileArray(self, x, y):
+        """
+        Get an uncompressed tile as a view of the memory mapped file.
+
+        :returns: a read-only array or None if the tile must be read through
+            libtiff.
+        """
+        layout = self._getTileLayout()
+        if layout is None:
+            return None
+        fileMap, offsets, counts, dtype, count = layout
+        tileNum = y * self._tilesAcross + x
+        if (counts[tileNum] < count * dtype.itemsize or
+                offsets[tileNum] + count * dtype.itemsize > len(fileMap)):
+            return None
+        tile = numpy.frombuffer(fileMap, dtype=dtype, count=count,
+                                offset=int(offsets[tileNum]))
+        return tile.reshape(self._tileBuffer().shape)
+
+    def _readTileArray(self, x, y):
+        if x < 0 or y < 0 or x >= self._tilesAcross or y >= self._tilesDown:
+            raise tiff_reader.InvalidOperationTiffException(
+                'Tile x=%d, y=%d does not exist' % (x, y))
+        tile = self._mapTileArray(x, y)
+        if tile is not None:
+            return tile
+        buffer = self._tileBuffer()
+        with self._readLock:
+            size = libtiff_ctypes.libtiff.TIFFReadTile(
+                self._tiffFile, buffer.ctypes.data, x * self._tileWidth,
+                y * self._tileHeight, 0, 0)
+        if size is not None and getattr(size, 'value', size) < 0:
+            raise tiff_reader.IOTiffException(
+                'Read an unexpected number of bytes from an encoded tile')
+        return buffer
+
+    def getTile(self, x, y, asArray=False):
+        """
+        Get a tile from this directory.
+
+        :param x: the 0-based horizontal tile number.
+        :param y: the 0-based vertical tile number.
+        :param asArray: if True and canReadArray() is True, return the decoded
+            tile as a numpy array.  To avoid allocating memory for each tile,
+            the array is either a read-only view of the memory mapped file
+            (for uncompressed tiles) or a buffer that is reused by the next
+            call from the same thread, so it must be copied if it is kept.
+        :returns: the tile as JPEG bytes, a PIL image, or a numpy array.
+        """
+        if asArray and self.canReadArray():
+            return self._readTileArray(x, y)
         tile = super(TiledTiffDirectory, self).getTile(x, y)
-        
+
         if isinstance(tile, bytes):
             return tile
 
-        compression_types = (
-            libtiff_ctypes.COMPRESSION_NONE,
-            libtiff_ctypes.COMPRESSION_ADOBE_DEFLATE,
-            libtiff_ctypes.COMPRESSION_LZW
-        )
-
-        if self._tiffInfo.get('compression') in compression_types:
+        if self._tiffInfo.get('compression') in ArrayCompressionTypes:
             tile_plane = self._tiffFile.read_one_tile(x*self._tileHeight,
                                                       y*self._tileWidth)
             return PIL.Image.fromarray(tile_plane)
-    # def saveTile(self, x, y, data):
-    #     print 'save modified tile in tiff_reader.py'
-    #     tileNum = self._toTileNum(x, y)
-    #     imageBuffer = six.BytesIO()
-
-    #     if self._tiffInfo.get('compression') == libtiff_ctypes.COMPRESSION_JPEG:
-    #         # Write JPEG Start Of Image marker
-    #         imageBuffer.write(b'\xff\xd8')
-    #         imageBuffer.write(self._getJpegTables())
-    #         imageBuffer.write(self._getJpegFrameAndSave(x, y, data))
-    #         # Write JPEG End Of Image marker
-    #         imageBuffer.write(b'\xff\xd9')
-    #         return imageBuffer.getvalue()
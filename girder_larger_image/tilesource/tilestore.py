@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+# A tile store is a single file of encoded tiles that are served without
+# decoding.  The tiles of all levels are written one after another, followed
+# by an index and a fixed size trailer:
+#
+#   index:   uint32 levels, then (tilesAcross, tilesDown) uint32 pairs per
+#            level, then (offset, length) uint64 pairs per tile, by level and
+#            then in row-major order.  A length of 0 is a missing tile.
+#   trailer: the magic bytes, then the uint64 offset of the index.
+
+import math
+import struct
+
+import numpy
+
+TileStoreMagic = b'LITILES1'
+TileStoreTrailer = struct.Struct('<8sQ')
+
+
+def levelTileCounts(sizeX, sizeY, tileWidth, tileHeight, levels):
+    """
+    Get the number of tiles of each level of an image.
+
+    :param sizeX: the width of the full resolution level.
+    :param sizeY: the height of the full resolution level.
+    :param tileWidth: the tile width.
+    :param tileHeight: the tile height.
+    :param levels: the number of levels.
+    :returns: a list of (tilesAcross, tilesDown) tuples, from level 0.
+    """
+    counts = []
+    for z in range(levels):
+        scale = 2 ** (levels - 1 - z)
+        counts.append((
+            max(1, int(math.ceil(float(sizeX) / scale / tileWidth))),
+            max(1, int(math.ceil(float(sizeY) / scale / tileHeight)))))
+    return counts
+
+
+def writeTileStore(fileobj, tileCounts, getTile, progress=None):
+    """
+    Write a tile store.
+
+    :param fileobj: a file opened for binary writing.
+    :param tileCounts: the result of levelTileCounts.
+    :param getTile: a function called with (x, y, z) that returns the encoded
+        tile or None if there is no tile.
+    :param progress: an optional function called with the number of tiles
+        done and the total number of tiles.
+    """
+    total = sum(across * down for across, down in tileCounts)
+    entries = numpy.zeros((total, 2), dtype='<u8')
+    offset = 0
+    tileNum = 0
+    for z, (across, down) in enumerate(tileCounts):
+        for y in range(down):
+            for x in range(across):
+                data = getTile(x, y, z)
+                if data:
+                    fileobj.write(data)
+                    entries[tileNum] = (offset, len(data))
+                    offset += len(data)
+                tileNum += 1
+                if progress and not tileNum % 256:
+                    progress(tileNum, total)
+    fileobj.write(struct.pack('<I', len(tileCounts)))
+    fileobj.write(numpy.array(tileCounts, dtype='<u4').tobytes())
+    fileobj.write(entries.tobytes())
+    fileobj.write(TileStoreTrailer.pack(TileStoreMagic, offset))
+    if progress:
+        progress(total, total)
+
+
+class TileStoreIndex(object):
+    """
+    The index of a tile store.
+
+    :param fileobj: a seekable file of the tile store opened for binary
+        reading.
+    :param size: the size of the file.
+    """
+    def __init__(self, fileobj, size):
+        fileobj.seek(size - TileStoreTrailer.size)
+        magic, indexOffset = TileStoreTrailer.unpack(
+            fileobj.read(TileStoreTrailer.size))
+        if magic != TileStoreMagic:
+            raise ValueError('Not a tile store')
+        fileobj.seek(indexOffset)
+        data = fileobj.read(size - TileStoreTrailer.size - indexOffset)
+        levels = struct.unpack('<I', data[:4])[0]
+        self.tileCounts = numpy.frombuffer(
+            data, dtype='<u4', count=levels * 2, offset=4).reshape(-1, 2)
+        self.levelStarts = numpy.concatenate((
+            [0], numpy.cumsum(self.tileCounts[:, 0].astype(numpy.int64) *
+                              self.tileCounts[:, 1])))
+        self.entries = numpy.frombuffer(
+            data, dtype='<u8', offset=4 + levels * 8).reshape(-1, 2)
+
+    def lookup(self, x, y, z):
+        """
+        Find a tile.
+
+        :param x: the tile column.
+        :param y: the tile row.
+        :param z: the tile level.
+        :returns: the offset and length of the tile, or None if the tile is
+            not in the store.
+        """
+        if not 0 <= z < len(self.tileCounts):
+            return None
+        across, down = self.tileCounts[z]
+        if not (0 <= x < across and 0 <= y < down):
+            return None
+        offset, length = self.entries[
+            self.levelStarts[z] + y * int(across) + x]
+        if not length:
+            return None
+        return int(offset), int(length)
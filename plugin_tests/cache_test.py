@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+import tempfile
+import time
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('larger_image')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class CacheTest(base.TestCase):
+    def testLruCache(self):
+        from girder.plugins.larger_image.cache_util import LruCache
+
+        cache = LruCache(maxSize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        # 'b' was the least recently used entry
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {
+            'hits': 2, 'misses': 1, 'size': 2, 'maxSize': 2})
+        self.assertEqual(cache.removeIf(lambda key: key == 'a'), 1)
+        self.assertNotIn('a', cache)
+
+    def testLruCacheMaxAge(self):
+        from girder.plugins.larger_image.cache_util import LruCache
+
+        cache = LruCache(maxSize=10, maxAge=0.1)
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def testTileCacheBackends(self):
+        from girder.plugins.larger_image.cache_util import DiskTileCache, \
+            MemcachedTileCache, MemoryTileCache
+
+        class StubMemcachedClient(object):
+            def __init__(self):
+                self.values = {}
+
+            def get(self, key):
+                return self.values.get(key)
+
+            def set(self, key, value, time=0):
+                self.values[key] = value
+
+            def flush_all(self):
+                self.values.clear()
+
+        caches = [
+            MemoryTileCache(maxSize=10),
+            DiskTileCache(path=tempfile.mkdtemp(), maxSize=10),
+            MemcachedTileCache(client=StubMemcachedClient()),
+        ]
+        for cache in caches:
+            self.assertIsNone(cache.get('["item", 0, 0, 0]'))
+            cache.set('["item", 0, 0, 0]', b'\x89PNG\0data', 'image/png')
+            self.assertEqual(cache.get('["item", 0, 0, 0]'),
+                             (b'\x89PNG\0data', 'image/png'))
+            self.assertEqual(cache.stats()['hits'], 1)
+            self.assertEqual(cache.stats()['misses'], 1)
+            cache.clear()
+            self.assertIsNone(cache.get('["item", 0, 0, 0]'))
+
+    def testDiskTileCachePrune(self):
+        from girder.plugins.larger_image.cache_util import DiskTileCache
+
+        cache = DiskTileCache(path=tempfile.mkdtemp(), maxSize=10)
+        for index in range(25):
+            cache.set(str(index), b'data', 'image/png')
+        self.assertLessEqual(cache.stats()['size'], 10)
+        self.assertIsNotNone(cache.get('24'))
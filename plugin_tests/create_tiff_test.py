@@ -48,3 +48,45 @@ class CreateTiffTest(base.TestCase):
         import girder.plugins.larger_image.create_tiff as create_tiff
         create_tiff.create_tiff(in_path, compression, quality, tile_size,
                                 out_path)
+
+    def testCreateTiffWithoutVips(self):
+        import tifffile
+
+        in_path = os.path.join(os.path.dirname(__file__), 'test_files',
+                               'grey10kx5kdeflate.tif')
+        out_path = os.path.join(tempfile.gettempdir(),
+                                'grey10kx5kdeflate_python.tif')
+        progress = []
+        import girder.plugins.larger_image.create_tiff as create_tiff
+        create_tiff.create_tiff(in_path, 'deflate', 90, 256, out_path,
+                                concurrency=2, use_vips=False,
+                                progress=lambda *args: progress.append(args))
+        self.assertEqual(progress[-1][0], progress[-1][1])
+        with tifffile.TiffFile(out_path) as tif:
+            self.assertEqual(len(tif.pages), 7)
+            self.assertEqual(tif.pages[0].shape, (5000, 10000))
+            self.assertEqual(tif.pages[0].tilewidth, 256)
+            self.assertEqual(tif.pages[6].shape, (79, 157))
+
+    def testLabelReducers(self):
+        import numpy
+
+        import girder.plugins.larger_image.create_tiff as create_tiff
+        block = numpy.array([
+            [1, 1, 0, 3],
+            [2, 0, 0, 3],
+            [5, 5, 4, 4],
+            [5, 5, 4, 6],
+        ], dtype=numpy.uint8)[:, :, numpy.newaxis]
+        mode = create_tiff.REDUCERS['mode'](block, 2)
+        self.assertEqual(mode[:, :, 0].tolist(), [[1, 3], [5, 4]])
+        bits = create_tiff.REDUCERS['or'](block, 2)
+        self.assertEqual(bits[:, :, 0].tolist(), [[3, 3], [5, 6]])
+        # Tiles that aren't square are reduced the same way
+        bits = create_tiff.REDUCERS['or'](block[:2], (1, 2))
+        self.assertEqual(bits[:, :, 0].tolist(), [[3, 3]])
+        mean = create_tiff.REDUCERS['mean'](block[:, :2], (2, 1))
+        self.assertEqual(mean[:, :, 0].tolist(), [[1], [5]])
+        with self.assertRaises(ValueError):
+            create_tiff.create_tiff('in.tif', 'none', 90, 256, 'out.tif',
+                                    reducer='median')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Girder, large_image plugin framework and tests adapted from Kitware Inc.
+#  source and documentation by the Imaging and Visualization Group, Advanced
+#  Biomedical Computational Science, Frederick National Laboratory for Cancer
+#  Research.
+#
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+import numpy
+
+from tests import base
+
+
+def setUpModule():
+    base.enabledPlugins.append('larger_image')
+    base.startServer()
+
+
+def tearDownModule():
+    base.stopServer()
+
+
+class LutTest(base.TestCase):
+    def testLabelLut(self):
+        from girder.plugins.larger_image.tilesource.lut import getLut
+
+        array = numpy.array([[0, 1], [200, 255]], dtype=numpy.uint8)
+        lut = getLut(256, label=True, flattenLabel=True, invertLabel=False)
+        self.assertEqual(lut.mode, 'RGBA')
+        result = lut.apply(array)
+        self.assertEqual(result.shape, (2, 2, 4))
+        self.assertEqual(result[:, :, 3].tolist(), [[0, 255], [255, 255]])
+        # Tables are shared between requests with the same parameters
+        self.assertIs(lut, getLut(256, label=True, flattenLabel=True,
+                                  invertLabel=False))
+
+    def testOneHotLut(self):
+        from girder.plugins.larger_image.tilesource.lut import getLut
+
+        array = numpy.array([[0, 1], [2, 6]], dtype=numpy.uint8)
+        lut = getLut(256, oneHot=True, exclude=[3])
+        self.assertEqual(lut.mode, 'L')
+        self.assertEqual(lut.apply(array).tolist(), [[0, 31], [63, 63]])
+
+    def testBitLut(self):
+        from girder.plugins.larger_image.tilesource.lut import getLut
+
+        array = numpy.array([[0, 1], [2, 3]], dtype=numpy.uint8)
+        colormap = [[index, 0, 0] for index in range(256)]
+        result = getLut(256, bit=2, colormap=colormap).apply(array)
+        self.assertEqual(result[:, :, 3].tolist(), [[0, 0], [255, 255]])
+        self.assertEqual(result[1, 1, :3].tolist(), [64, 0, 0])
+
+    def testCompositeBitsLut(self):
+        from girder.plugins.larger_image.tilesource.lut import getLut
+
+        array = numpy.array([[0, 1], [2, 3]], dtype=numpy.uint8)
+        lut = getLut(256, bits=[[1, [255, 0, 0], 1.0], [2, [0, 0, 255], 0.5]])
+        self.assertEqual(lut.mode, 'RGBA')
+        result = lut.apply(array)
+        self.assertEqual(result[0, 0].tolist(), [0, 0, 0, 0])
+        self.assertEqual(result[0, 1].tolist(), [255, 0, 0, 255])
+        self.assertEqual(result[1, 0].tolist(), [0, 0, 255, 128])
+        # Bit 2 is blended over bit 1
+        self.assertEqual(result[1, 1].tolist(), [128, 0, 128, 255])
+
+    def testWideLabelLut(self):
+        from girder.plugins.larger_image.tilesource.lut import directLut, \
+            getLut, lutDepth, lutStart
+
+        # Negative 16-bit values have their own rows
+        array = numpy.array([[-5, 0], [3, 300]], dtype=numpy.int16)
+        lut = getLut(lutDepth(array), lutStart(array), label=True,
+                     flattenLabel=True, invertLabel=False)
+        self.assertEqual(lut.apply(array)[:, :, 3].tolist(),
+                         [[255, 0], [255, 255]])
+        # Labels past 16 bits are mapped without a table
+        array = numpy.array([[0, 70000], [65536, 1]], dtype=numpy.uint32)
+        self.assertIsNone(lutDepth(array))
+        result = directLut(array, label=True, flattenLabel=True,
+                           invertLabel=False).table
+        self.assertEqual(result[:, :, 3].tolist(), [[0, 255], [255, 255]])
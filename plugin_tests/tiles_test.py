@@ -22,8 +22,11 @@
 #  limitations under the License.
 ###############################################################################
 
+import functools
+import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from six import BytesIO
 
@@ -83,6 +86,853 @@ class LargeImageTilesTest(common.LargeImageCommonTest):
         self.assertEqual(image.format, 'PNG')
         self.assertEqual(image.mode, 'RGBA')
 
+    def testTileSourceCache(self):
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        self._postTileViaHttp(itemId, fileId)
+        resp = self.request(path='/item/tiles/extended/cache',
+                            method='DELETE', user=self.admin)
+        self.assertStatusOk(resp)
+        for x in range(2):
+            resp = self.request(
+                path='/item/%s/tiles/extended/zxy/1/%d/0' % (itemId, x),
+                isJson=False, user=self.admin)
+            self.assertStatusOk(resp)
+        resp = self.request(path='/item/tiles/extended/cache', user=self.admin)
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['tilesource']['misses'], 1)
+        self.assertEqual(resp.json['tilesource']['hits'], 1)
+
+    def testTileResultCache(self):
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        self._postTileViaHttp(itemId, fileId)
+        resp = self.request(path='/item/tiles/extended/cache',
+                            method='DELETE', user=self.admin)
+        tiles = []
+        for params in ({'label': 1, 'flattenLabel': 'true'},
+                       {'flattenLabel': 'true', 'label': 'true'}):
+            resp = self.request(
+                path='/item/%s/tiles/extended/zxy/0/0/0' % itemId,
+                params=params, isJson=False, user=self.admin)
+            self.assertStatusOk(resp)
+            self.assertEqual(resp.headers['Content-Type'], 'image/png')
+            tiles.append(self.getBody(resp, text=False))
+        self.assertEqual(tiles[0], tiles[1])
+        resp = self.request(path='/item/tiles/extended/cache', user=self.admin)
+        self.assertEqual(resp.json['tileresult']['hits'], 1)
+        self.assertEqual(resp.json['tileresult']['misses'], 1)
+
+    def testColormapCache(self):
+        import time
+
+        from bson import ObjectId
+        from girder import events
+        from girder.plugins.larger_image.rest.tiles import _loadColormap, \
+            colormapCache
+
+        colormapId = str(ObjectId())
+        entry = {'loaded': time.time(), 'version': 'abc',
+                 'palette': b'\x00\x00\x00\xff\x00\x00',
+                 'colors': ((0, 0, 0), (255, 0, 0))}
+        colormapCache.put(colormapId, entry)
+        # Cached colormaps are used without loading them
+        hits = colormapCache.hits
+        self.assertIs(_loadColormap(colormapId), entry)
+        self.assertEqual(colormapCache.hits, hits + 1)
+        # Saving or removing a colormap drops it from the cache
+        for eventName in ('model.colormap.save.after',
+                          'model.colormap.remove'):
+            colormapCache.put(colormapId, entry)
+            events.trigger(eventName, {'_id': ObjectId(colormapId)})
+            self.assertNotIn(colormapId, colormapCache)
+
+    def testTileETag(self):
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        self._postTileViaHttp(itemId, fileId)
+        path = '/item/%s/tiles/extended/zxy/0/0/0' % itemId
+        resp = self.request(path=path, params={'label': 'true'},
+                            isJson=False, user=self.admin)
+        self.assertStatusOk(resp)
+        etag = resp.headers['ETag']
+        # Browsers recheck tiles when they expire
+        self.assertEqual(resp.headers['Cache-control'], 'max-age=600')
+        resp = self.request(path=path, params={'label': 'true'},
+                            isJson=False, user=self.admin,
+                            additionalHeaders=[('If-None-Match', etag)])
+        self.assertStatus(resp, 304)
+        resp = self.request(path=path, params={'label': 'false'},
+                            isJson=False, user=self.admin,
+                            additionalHeaders=[('If-None-Match', etag)])
+        self.assertStatusOk(resp)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def testTileBatch(self):
+        import tempfile
+
+        import numpy
+        import tifffile
+
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        self._postTileViaHttp(itemId, fileId)
+        resp = self.request(
+            path='/item/%s/tiles/extended/batch' % itemId, method='POST',
+            params={'tiles': json.dumps([[0, 0, 0], [1, 1, 0], [20, 0, 0]]),
+                    'label': 'true'},
+            isJson=False, user=self.admin)
+        self.assertStatusOk(resp)
+        contentType = resp.headers['Content-Type']
+        self.assertTrue(contentType.startswith('multipart/mixed'))
+        boundary = contentType.split('boundary=')[1].encode()
+        body = self.getBody(resp, text=False)
+        parts = body.split(b'--' + boundary)[1:-1]
+        self.assertEqual(len(parts), 3)
+        for index, location in enumerate((b'0/0/0', b'1/1/0')):
+            headers, data = parts[index].split(b'\r\n\r\n', 1)
+            self.assertIn(b'Content-Location: ' + location, headers)
+            self.assertIn(b'Content-Type: image/png', headers)
+            image = PIL.Image.open(BytesIO(data[:-2]))
+            self.assertEqual(image.mode, 'RGBA')
+        self.assertIn(b'X-Tile-Error', parts[2])
+        resp = self.request(
+            path='/item/%s/tiles/extended/batch' % itemId, method='POST',
+            params={'tiles': '[[0, 0]]'}, user=self.admin)
+        self.assertStatus(resp, 400)
+        # Parameters that don't apply to an image are reported per tile
+        path = os.path.join(tempfile.mkdtemp(), 'grey16.tiff')
+        tifffile.imwrite(path, numpy.full((256, 256), 1000,
+                                          dtype=numpy.uint16),
+                         tile=(256, 256), compression='zlib')
+        file = self._uploadFile(path)
+        itemId = str(file['itemId'])
+        self._postTileViaHttp(itemId, str(file['_id']))
+        resp = self.request(
+            path='/item/%s/tiles/extended/batch' % itemId, method='POST',
+            params={'tiles': '[[0, 0, 0]]', 'bit': 1},
+            isJson=False, user=self.admin)
+        self.assertStatusOk(resp)
+        body = self.getBody(resp, text=False)
+        self.assertIn(b'X-Tile-Error: 8-bit oneHot images only', body)
+        self.assertTrue(body.endswith(b'--\r\n'))
+        resp = self.request(
+            path='/item/%s/tiles/extended/zxy/0/0/0' % itemId,
+            params={'bit': 1}, isJson=False, user=self.admin)
+        self.assertStatus(resp, 400)
+
+    def testMemoryMappedTiles(self):
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        # The conversion uses no compression
+        self._postTileViaHttp(itemId, fileId)
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+        directory = tileSource._tiffDirectories[-1]
+        mapped = directory._mapTileArray(1, 1)
+        self.assertIsNotNone(mapped)
+        self.assertFalse(mapped.flags.writeable)
+        directory._useMemoryMap = False
+        directory._tileLayout = None
+        read = directory.getTile(1, 1, asArray=True)
+        self.assertTrue((mapped == read).all())
+
+    def testTileArrays(self):
+        import tempfile
+
+        import numpy
+        import tifffile
+        from girder.plugins.larger_image.tilesource.tiff_reader import \
+            TiledTiffDirectory
+
+        # The image isn't a multiple of the tile size, so the last row and
+        # column of tiles are padded
+        image = numpy.random.RandomState(0).randint(
+            0, 256, (300, 400, 3)).astype(numpy.uint8)
+        tempDir = tempfile.mkdtemp()
+        for compression in ('zlib', 'lzw', None):
+            path = os.path.join(tempDir, '%s.tiff' % compression)
+            tifffile.imwrite(path, image, tile=(256, 256),
+                             compression=compression, photometric='rgb')
+            directory = TiledTiffDirectory(path, 0)
+            # Read uncompressed tiles with TIFFReadTile rather than the
+            # memory map
+            directory._useMemoryMap = False
+            self.assertTrue(directory.canReadArray())
+            for x, y in ((0, 0), (1, 0), (0, 1), (1, 1)):
+                read = directory.getTile(x, y, asArray=True)
+                self.assertEqual(read.shape, (256, 256, 3))
+                self.assertEqual(read.dtype, numpy.uint8)
+                decoded = numpy.asarray(directory.getTile(x, y))
+                self.assertTrue((read == decoded).all())
+                expected = image[y * 256:(y + 1) * 256, x * 256:(x + 1) * 256]
+                height, width = expected.shape[:2]
+                self.assertTrue((read[:height, :width] == expected).all())
+            directory._close()
+
+    def testConcurrentTileEncoding(self):
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        self._postTileViaHttp(itemId, fileId)
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+
+        def getTile(index):
+            label = bool(index % 2)
+            tile = tileSource.getTile(index % 4, 0, 2, label=label,
+                                      flattenLabel=bool(index % 3))
+            return label, PIL.Image.open(BytesIO(tile)).format
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(getTile, range(200)))
+        for label, format in results:
+            self.assertEqual(format, 'PNG' if label else 'JPEG')
+        self.assertEqual(tileSource.encoding, 'JPEG')
+
+    def testStreamedRegion(self):
+        import numpy
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+        from large_image.constants import TILE_FORMAT_NUMPY
+
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        self._postTileViaHttp(itemId, fileId)
+        item = Item().load(itemId, force=True)
+        # The first region doesn't start or end on tile boundaries
+        for params in (
+                {'left': 100, 'top': 200, 'right': 1400, 'bottom': 900},
+                {'left': 256, 'top': 512, 'right': 1024, 'bottom': 768}):
+            width = params['right'] - params['left']
+            height = params['bottom'] - params['top']
+            expected = LargerImageItem().getRegion(
+                item, format=TILE_FORMAT_NUMPY, **params)[0]
+            if expected.ndim == 2:
+                expected = expected[:, :, numpy.newaxis]
+            for encoding in ('PNG', 'TIFF'):
+                resp = self.request(
+                    path='/item/%s/tiles/extended/region' % itemId,
+                    user=self.admin, isJson=False,
+                    params=dict(params, encoding=encoding))
+                self.assertStatusOk(resp)
+                region = PIL.Image.open(BytesIO(self.getBody(
+                    resp, text=False)))
+                self.assertEqual(region.size, (width, height))
+                region = numpy.asarray(region)
+                if region.ndim == 2:
+                    region = region[:, :, numpy.newaxis]
+                self.assertTrue(numpy.array_equal(
+                    region, expected[:, :, :region.shape[2]]))
+        # Resampled regions still use the whole-region path
+        resp = self.request(
+            path='/item/%s/tiles/extended/region' % itemId,
+            user=self.admin, isJson=False,
+            params=dict(params, encoding='PNG', width=500, resample='true'))
+        self.assertStatusOk(resp)
+        image = PIL.Image.open(BytesIO(self.getBody(resp, text=False)))
+        self.assertEqual(image.size[0], 500)
+
+    def testProcessedRegion(self):
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif'))
+        itemId = str(file['itemId'])
+        fileId = str(file['_id'])
+        self._postTileViaHttp(itemId, fileId)
+        params = {'left': 0, 'top': 0, 'right': 512, 'bottom': 512,
+                  'label': 'true'}
+        resp = self.request(path='/item/%s/tiles/extended/region' % itemId,
+                            user=self.admin, isJson=False, params=params)
+        self.assertStatusOk(resp)
+        region = PIL.Image.open(BytesIO(self.getBody(resp, text=False)))
+        self.assertEqual(region.format, 'PNG')
+        self.assertEqual(region.mode, 'RGBA')
+        self.assertEqual(region.size, (512, 512))
+        # The region matches the tiles it covers
+        resp = self.request(path='/item/%s/tiles/extended/zxy/6/1/1' % itemId,
+                            user=self.admin, isJson=False,
+                            params={'label': 'true'})
+        tile = PIL.Image.open(BytesIO(self.getBody(resp, text=False)))
+        self.assertEqual(region.crop((256, 256, 512, 512)).tobytes(),
+                         tile.tobytes())
+        # A resized label region only has the colors of the labels
+        resp = self.request(path='/item/%s/tiles/extended/region' % itemId,
+                            user=self.admin, isJson=False,
+                            params=dict(params, width=300))
+        self.assertStatusOk(resp)
+        scaled = PIL.Image.open(BytesIO(self.getBody(resp, text=False)))
+        self.assertEqual(scaled.size, (300, 300))
+        self.assertLessEqual(
+            {color for _, color in scaled.getcolors(300 * 300)},
+            {color for _, color in region.getcolors(512 * 512)})
+
+    def testCompositeTile(self):
+        path = os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif')
+        items = []
+        for _ in range(2):
+            file = self._uploadFile(path)
+            self._postTileViaHttp(str(file['itemId']), str(file['_id']))
+            items.append(str(file['itemId']))
+        layers = [{'itemId': items[1], 'label': True, 'flattenLabel': True,
+                   'opacity': 0.5}]
+        resp = self.request(
+            path='/item/%s/tiles/extended/composite/2/0/0' % items[0],
+            user=self.admin, isJson=False,
+            params={'layers': json.dumps(layers)})
+        self.assertStatusOk(resp)
+        image = PIL.Image.open(BytesIO(self.getBody(resp, text=False)))
+        self.assertEqual(image.format, 'PNG')
+        self.assertEqual(image.mode, 'RGBA')
+        self.assertEqual(image.size, (256, 256))
+        resp = self.request(
+            path='/item/%s/tiles/extended/composite/2/0/0' % items[0],
+            user=self.admin, params={'layers': '{}'})
+        self.assertStatus(resp, 400)
+
+    def testEmptyLabelTiles(self):
+        import base64
+        import tempfile
+
+        import numpy
+        import tifffile
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+        from girder.plugins.larger_image.models.tile_index import TileIndex
+
+        label = numpy.zeros((512, 512), dtype=numpy.uint8)
+        label[10:100, 20:200] = 3
+        path = os.path.join(tempfile.mkdtemp(), 'label.tiff')
+        with tifffile.TiffWriter(path) as tif:
+            tif.write(label, tile=(256, 256), compression='zlib')
+            tif.write(label[::2, ::2], tile=(256, 256), compression='zlib',
+                      subfiletype=1)
+        file = self._uploadFile(path)
+        itemId = str(file['itemId'])
+        self._postTileViaHttp(itemId, str(file['_id']))
+        resp = self.request(
+            path='/item/%s/tiles/extended/occupancy' % itemId,
+            user=self.admin, params={'level': 1})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['tilesAcross'], 2)
+        occupancy = numpy.unpackbits(numpy.frombuffer(
+            base64.b64decode(resp.json['occupancy']), dtype=numpy.uint8))
+        self.assertEqual(occupancy[:4].tolist(), [1, 0, 0, 0])
+        tiles = []
+        for x, y in ((1, 0), (1, 1)):
+            resp = self.request(
+                path='/item/%s/tiles/extended/zxy/1/%d/%d' % (itemId, x, y),
+                user=self.admin, isJson=False, params={'label': 'true'})
+            self.assertStatusOk(resp)
+            tiles.append(self.getBody(resp, text=False))
+        self.assertEqual(tiles[0], tiles[1])
+        image = PIL.Image.open(BytesIO(tiles[0]))
+        self.assertEqual(image.mode, 'RGBA')
+        # Inverted labels make zero opaque white
+        self.assertTrue((numpy.asarray(image) == 255).all())
+        # The shared empty tile matches a tile decoded from the file
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+        decoded = tileSource._outputTile(
+            tileSource._tiffDirectories[1].getTile(1, 0, asArray=True),
+            'numpy', 1, 0, 1, label=True)
+        self.assertTrue(numpy.array_equal(
+            numpy.asarray(PIL.Image.open(BytesIO(decoded))),
+            numpy.asarray(image)))
+        resp = self.request(
+            path='/item/%s/tiles/extended/zxy/1/1/0' % itemId,
+            user=self.admin, isJson=False,
+            params={'label': 'true', 'invertLabel': 'false'})
+        self.assertStatusOk(resp)
+        image = PIL.Image.open(BytesIO(self.getBody(resp, text=False)))
+        self.assertFalse(numpy.asarray(image)[:, :, 3].any())
+        # Build the whole index and check its summary
+        resp = self.request(
+            path='/item/%s/tiles/extended/index' % itemId,
+            user=self.admin, method='POST')
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['type'], 'larger_image_index')
+        item = Item().load(itemId, force=True)
+        LargerImageItem().buildTileIndex(item)
+        resp = self.request(
+            path='/item/%s/tiles/extended/index' % itemId,
+            user=self.admin, params={'level': 0})
+        self.assertStatusOk(resp)
+        self.assertEqual(len(resp.json), 1)
+        self.assertEqual(resp.json[0]['occupied'], 1)
+        self.assertEqual(resp.json[0]['labels'], [0, 3])
+        self.assertEqual(resp.json[0]['bits'], [1, 2])
+        self.assertEqual(resp.json[0]['max'], 3)
+        self.assertNotIn('occupancy', resp.json[0])
+        # Levels are split across documents by rows of tiles as needed
+        whole = LargerImageItem().getTileIndex(item, 1, tiles=True)
+        settings = config.getConfig().setdefault('larger_image', {})
+        settings['index_part_bytes'] = 1
+        try:
+            LargerImageItem().buildTileIndex(item, [1])
+        finally:
+            del settings['index_part_bytes']
+        self.assertEqual(len(TileIndex().getLevels(item, 1)[0]['parts']), 2)
+        self.assertEqual(
+            LargerImageItem().getTileIndex(item, 1, tiles=True), whole)
+
+    def testPreRenderedStyle(self):
+        import tempfile
+
+        import numpy
+        import tifffile
+
+        label = numpy.zeros((512, 512), dtype=numpy.uint8)
+        label[10:300, 20:200] = 3
+        path = os.path.join(tempfile.mkdtemp(), 'label.tiff')
+        with tifffile.TiffWriter(path) as tif:
+            tif.write(label, tile=(256, 256), compression='zlib')
+            tif.write(label[::2, ::2], tile=(256, 256), compression='zlib',
+                      subfiletype=1)
+        file = self._uploadFile(path)
+        itemId = str(file['itemId'])
+        self._postTileViaHttp(itemId, str(file['_id']))
+        tilePath = '/item/%s/tiles/extended/zxy/1/0/1' % itemId
+        resp = self.request(path=tilePath, user=self.admin, isJson=False,
+                            params={'label': 'true'})
+        self.assertStatusOk(resp)
+        rendered = self.getBody(resp, text=False)
+        resp = self.request(
+            path='/item/%s/tiles/extended/styles' % itemId, method='POST',
+            user=self.admin, params={'label': 'true'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['type'], 'larger_image_style')
+        resp = self.request(
+            path='/item/%s/tiles/extended/styles' % itemId, method='POST',
+            user=self.admin)
+        self.assertStatus(resp, 400)
+        starttime = time.time()
+        while time.time() - starttime < 30:
+            resp = self.request(
+                path='/item/%s/tiles/extended/styles' % itemId,
+                user=self.admin)
+            self.assertStatusOk(resp)
+            if resp.json:
+                break
+            time.sleep(0.1)
+        self.assertEqual(len(resp.json), 1)
+        self.assertEqual(resp.json[0]['params'], {'label': True})
+        self.assertEqual(resp.json[0]['mimeType'], 'image/png')
+        # Stored tiles are the same as rendered ones
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+        from girder.plugins.larger_image.rest.tiles import styleKey
+        item = Item().load(itemId, force=True)
+        styled = LargerImageItem().getStyledTile(
+            item, 0, 1, 1, styleKey({'label': True}))
+        self.assertEqual(styled, (rendered, 'image/png'))
+        self.assertIsNone(LargerImageItem().getStyledTile(
+            item, 0, 1, 1, styleKey({'label': True, 'invertLabel': False})))
+        resp = self.request(path=tilePath, user=self.admin, isJson=False,
+                            params={'label': 'true'})
+        self.assertStatusOk(resp)
+        self.assertEqual(self.getBody(resp, text=False), rendered)
+
+    def testSparseFallback(self):
+        import tempfile
+
+        import numpy
+        import tifffile
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+
+        label = numpy.zeros((1024, 1024), dtype=numpy.uint8)
+        label[:600, 300:] = 5
+        label[700:, :200] = 7
+        # The file has no 512 x 512 level
+        path = os.path.join(tempfile.mkdtemp(), 'sparse.tiff')
+        with tifffile.TiffWriter(path) as tif:
+            tif.write(label, tile=(256, 256), compression='zlib')
+            tif.write(label[::4, ::4], tile=(256, 256), compression='zlib',
+                      subfiletype=1)
+        file = self._uploadFile(path)
+        itemId = str(file['itemId'])
+        self._postTileViaHttp(itemId, str(file['_id']))
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+        self.assertEqual(tileSource.levels, 3)
+        self.assertIsNone(tileSource._tiffDirectories[1])
+        for x, y in ((0, 0), (1, 1), (0, 1)):
+            tile = tileSource.getTile(x, y, 1, numpyAllowed='always')
+            tile = tile[:, :, 0] if tile.ndim == 3 else tile
+            parent = label[::4, ::4][y * 128:(y + 1) * 128,
+                                     x * 128:(x + 1) * 128]
+            self.assertTrue(numpy.array_equal(
+                tile, parent.repeat(2, axis=0).repeat(2, axis=1)))
+            # Only existing label values are produced
+            self.assertTrue(set(numpy.unique(tile)) <= {0, 5, 7})
+        resp = self.request(
+            path='/item/%s/tiles/extended/zxy/1/1/0' % itemId,
+            user=self.admin, isJson=False, params={'label': 'true'})
+        self.assertStatusOk(resp)
+        # Missing levels of other images are built from finer levels
+        rgb = numpy.zeros((1024, 1024, 3), dtype=numpy.uint8)
+        rgb[:, 511:] = 255
+        path = os.path.join(tempfile.mkdtemp(), 'sparsergb.tiff')
+        with tifffile.TiffWriter(path) as tif:
+            tif.write(rgb, tile=(256, 256), compression='zlib',
+                      photometric='rgb')
+            tif.write(rgb[::4, ::4], tile=(256, 256), compression='zlib',
+                      photometric='rgb', subfiletype=1)
+        file = self._uploadFile(path)
+        itemId = str(file['itemId'])
+        self._postTileViaHttp(itemId, str(file['_id']))
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+        self.assertIsNone(tileSource._tiffDirectories[1])
+        self.assertFalse(tileSource._useSparseFallback(False))
+        tile = tileSource.getTile(0, 0, 1, numpyAllowed='always')
+        # The column at 511 is half of an output pixel, which only the finer
+        # level has
+        self.assertTrue(0 < tile[0, 255, 0] < 255)
+
+    def testTileEdits(self):
+        import tempfile
+
+        import numpy
+        import tifffile
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+        from girder.plugins.larger_image.models.tile_overlay import \
+            TileOverlay
+
+        label = numpy.zeros((512, 512), dtype=numpy.uint8)
+        label[300:, 300:] = 2
+        path = os.path.join(tempfile.mkdtemp(), 'label.tiff')
+        with tifffile.TiffWriter(path) as tif:
+            tif.write(label, tile=(256, 256), compression='zlib')
+            tif.write(label[::2, ::2], tile=(256, 256), compression='zlib',
+                      subfiletype=1)
+        file = self._uploadFile(path)
+        itemId = str(file['itemId'])
+        self._postTileViaHttp(itemId, str(file['_id']))
+
+        def png(array):
+            output = BytesIO()
+            PIL.Image.fromarray(array).save(output, 'PNG')
+            return output.getvalue()
+
+        regionPath = '/item/%s/tiles/extended/region' % itemId
+        regionParams = {'left': 200, 'top': 200, 'right': 300,
+                        'bottom': 300, 'encoding': 'PNG'}
+        resp = self.request(path=regionPath, params=regionParams,
+                            isJson=False, user=self.admin)
+        self.assertStatusOk(resp)
+        regionETag = resp.headers['ETag']
+        # Label a square that crosses four tiles
+        resp = self.request(
+            path='/item/%s/tiles/extended/region/mask' % itemId,
+            method='POST', user=self.admin, type='image/png',
+            body=png(numpy.full((20, 20), 255, dtype=numpy.uint8)),
+            params={'left': 246, 'top': 246, 'value': 7, 'fold': 'false'})
+        self.assertStatusOk(resp)
+        # Regions that were cached before the edit are stale
+        resp = self.request(path=regionPath, params=regionParams,
+                            isJson=False, user=self.admin,
+                            additionalHeaders=[('If-None-Match', regionETag)])
+        self.assertStatusOk(resp)
+        self.assertNotEqual(resp.headers['ETag'], regionETag)
+        self.assertEqual(sorted(resp.json['tiles']), [
+            [1, 0, 0], [1, 0, 1], [1, 1, 0], [1, 1, 1]])
+        self.assertIsNone(resp.json['jobId'])
+        resp = self.request(
+            path='/item/%s/tiles/extended/zxy/1/0/0' % itemId,
+            method='POST', user=self.admin, type='image/png',
+            body=png(numpy.zeros((10, 10), dtype=numpy.uint8)),
+            params={'fold': 'false'})
+        self.assertStatus(resp, 400)
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+        tile = tileSource.getTileArray(1, 1, 1)
+        self.assertTrue((tile[:10, :10] == 7).all())
+        self.assertEqual(tile[10, 10], 0)
+        self.assertEqual(tile[50, 50], 2)
+        # An edit based on a tile that has changed since it was read is not
+        # stored
+        stored, storedVersion = TileOverlay().getTileAndVersion(item, 1, 1, 1)
+        self.assertFalse(TileOverlay().setTile(
+            item, 1, 1, 1, stored, 1000, previous=storedVersion - 1))
+        self.assertFalse(TileOverlay().setTile(
+            item, 1, 1, 1, stored, 1000, previous=None))
+        self.assertEqual(
+            TileOverlay().getTileAndVersion(item, 1, 1, 1)[1], storedVersion)
+        # The coarser level is rebuilt from the edited tiles
+        self.assertEqual(LargerImageItem().foldOverlay(item), 1)
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+        tile = tileSource.getTileArray(0, 0, 0)
+        self.assertTrue((tile[123:133, 123:133] == 7).all())
+        self.assertEqual(tile[200, 200], 2)
+        self.assertEqual(LargerImageItem().foldOverlay(item), 0)
+        # A later edit only changes the versions of the tiles it covers, and
+        # a one pixel line survives the label-preserving reducer
+        version = LargerImageItem().getTileEditVersion(item, 1, 1, 1)
+        resp = self.request(
+            path='/item/%s/tiles/extended/region/mask' % itemId,
+            method='POST', user=self.admin, type='image/png',
+            body=png(numpy.full((1, 40), 255, dtype=numpy.uint8)),
+            params={'left': 0, 'top': 21, 'value': 5, 'fold': 'false'})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['tiles'], [[1, 0, 0]])
+        item = Item().load(itemId, force=True)
+        self.assertGreater(
+            LargerImageItem().getTileEditVersion(item, 0, 0, 1), version)
+        self.assertEqual(
+            LargerImageItem().getTileEditVersion(item, 1, 1, 1), version)
+        self.assertEqual(LargerImageItem().foldOverlay(item), 1)
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+        tile = tileSource.getTileArray(0, 0, 0)
+        self.assertTrue((tile[10, :20] == 5).all())
+        self.assertTrue((tile[123:133, 123:133] == 7).all())
+        LargerImageItem().buildTileIndex(item, [1])
+        self.assertEqual(
+            LargerImageItem().getHistogram(item, 1)['bands'][0]['max'], 7)
+        # The mask of an image with an alpha channel is its alpha channel
+        rgba = numpy.full((20, 20, 4), 255, dtype=numpy.uint8)
+        rgba[5:, :, 3] = 0
+        resp = self.request(
+            path='/item/%s/tiles/extended/region/mask' % itemId,
+            method='POST', user=self.admin, type='image/png',
+            body=png(rgba),
+            params={'left': 400, 'top': 10, 'value': 9, 'fold': 'false'})
+        self.assertStatusOk(resp)
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+        tile = tileSource.getTileArray(1, 0, 1)
+        self.assertTrue((tile[10:15, 144:164] == 9).all())
+        self.assertFalse((tile[15:30, 144:164] == 9).any())
+        # The index and histogram of an edited level are computed again with
+        # the edits
+        self.assertEqual(LargerImageItem().getTileIndex(item, 1), [])
+        LargerImageItem().buildTileIndex(item, [1])
+        self.assertIn(9, LargerImageItem().getTileIndex(item, 1)[0]['labels'])
+        histogram = LargerImageItem().getHistogram(item, 1)['bands'][0]
+        self.assertEqual(histogram['max'], 9)
+        self.assertEqual(histogram['samples'], 512 * 512)
+        # Edits can be discarded
+        resp = self.request(
+            path='/item/%s/tiles/extended/edits' % itemId, method='DELETE',
+            user=self.admin)
+        self.assertStatusOk(resp)
+        item = Item().load(itemId, force=True)
+        tileSource = LargerImageItem._loadTileSource(item)
+        self.assertEqual(tileSource.getTileArray(1, 1, 1)[0, 0], 0)
+        # A conditional request of an item that has been edited is answered
+        # without opening a tile source
+        path = '/item/%s/tiles/extended/zxy/1/1/1' % itemId
+        resp = self.request(path=path, isJson=False, user=self.admin)
+        self.assertStatusOk(resp)
+        etag = resp.headers['ETag']
+        resp = self.request(path='/item/tiles/extended/cache',
+                            method='DELETE', user=self.admin)
+        self.assertStatusOk(resp)
+        resp = self.request(path=path, isJson=False, user=self.admin,
+                            additionalHeaders=[('If-None-Match', etag)])
+        self.assertStatus(resp, 304)
+        resp = self.request(path='/item/tiles/extended/cache', user=self.admin)
+        self.assertEqual(resp.json['tilesource']['misses'], 0)
+
+    def testFolderImport(self):
+        from girder.models.folder import Folder
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+
+        path = os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif')
+        file = self._uploadFile(path)
+        imported = self._uploadFile(path)
+        self._postTileViaHttp(str(imported['itemId']), str(imported['_id']))
+        item = Item().load(file['itemId'], force=True)
+        folder = Folder().load(item['folderId'], force=True)
+        Item().createItem('empty', self.admin, folder)
+        counts = LargerImageItem().importFolder(folder, self.admin)
+        self.assertEqual(counts, {
+            'direct': 1, 'converting': 0, 'skipped': 1, 'failed': 0})
+        item = Item().load(file['itemId'], force=True)
+        self.assertEqual(item['largeImage']['fileId'], file['_id'])
+        self.assertIn('sourceName', item['largeImage'])
+        # Imported items are not imported again
+        counts = LargerImageItem().importFolder(folder, self.admin)
+        self.assertEqual(counts['direct'] + counts['converting'], 0)
+        resp = self.request(
+            path='/folder/%s/tiles/extended' % folder['_id'], method='POST',
+            user=self.admin, params={'maxConversions': 0})
+        self.assertStatus(resp, 400)
+
+    def testLocalConversion(self):
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+
+        file = self._uploadFile(os.path.join(
+            os.path.dirname(__file__), 'test_files', 'grey10kx5kdeflate.tif'))
+        item = Item().load(file['itemId'], force=True)
+        settings = config.getConfig().setdefault('larger_image', {})
+        settings['local_conversion'] = 'true'
+        try:
+            job = LargerImageItem().createImageItem(
+                item, file, self.admin, sourceName=False)
+        finally:
+            del settings['local_conversion']
+        # Images converted with the default reducer use create_tiff too
+        self.assertEqual(job['type'], 'larger_image_tiff')
+        self.assertEqual(job['kwargs']['reducer'], 'mean')
+
+    def testSourceDetection(self):
+        import tempfile
+
+        import numpy
+        import tifffile
+        from girder.models.item import Item
+        from girder.plugins.larger_image.models.larger_image_item import \
+            LargerImageItem
+        from girder.plugins.larger_image.tilesource.sniff import \
+            HeaderSize, plausibleSources, sniffHeader
+
+        path = os.path.join(tempfile.mkdtemp(), 'tiled.tiff')
+        tifffile.imwrite(path, numpy.zeros((512, 512), dtype=numpy.uint8),
+                         tile=(256, 256), compression='zlib')
+        with open(path, 'rb') as f:
+            info = sniffHeader(f.read(HeaderSize))
+        self.assertEqual(info, {'format': 'tiff', 'tiled': True,
+                                'compression': 8, 'vendor': ''})
+        self.assertEqual(plausibleSources(info, ['pil', 'tiff', 'gdal']),
+                         ['tiff', 'gdal'])
+        self.assertEqual(plausibleSources(
+            sniffHeader(b'\x89PNG\r\n\x1a\n'), ['openslide', 'tiff', 'pil']),
+            ['pil'])
+        # Unknown formats are tried with every source
+        self.assertEqual(plausibleSources(
+            sniffHeader(b'unknown'), ['openslide', 'gdal']),
+            ['openslide', 'gdal'])
+        file = self._uploadFile(path)
+        item = Item().load(file['itemId'], force=True)
+        resp = self.request(path='/item/tiles/extended/cache',
+                            method='DELETE', user=self.admin)
+        self.assertStatusOk(resp)
+        sourceName = LargerImageItem().probeTileSource(item, file)
+        self.assertIsNotNone(sourceName)
+        self.assertNotIn('fileId', item['largeImage'])
+        self.assertEqual(
+            LargerImageItem().probeTileSource(item, file), sourceName)
+        resp = self.request(path='/item/tiles/extended/cache', user=self.admin)
+        self.assertEqual(resp.json['sourcedetect']['misses'], 1)
+        self.assertEqual(resp.json['sourcedetect']['hits'], 1)
+
+    def testTilePrefetcher(self):
+        from girder.plugins.larger_image.prefetch import TilePrefetcher, \
+            predictTiles
+
+        self.assertEqual(predictTiles(0, 0, 0, [(1, 1), (2, 2)]), [
+            (1, 0, 0), (1, 1, 0), (1, 0, 1), (1, 1, 1)])
+        self.assertEqual(predictTiles(1, 1, 1, [(1, 1), (2, 2)]), [
+            (1, 0, 1), (1, 1, 0), (1, 0, 0)])
+        prefetcher = TilePrefetcher(workers=2, ratePerItem=4)
+        done = []
+        prefetcher.schedule('item', [
+            (key, functools.partial(done.append, key)) for key in range(6)])
+        starttime = time.time()
+        while prefetcher.stats()['rendered'] < 4 and (
+                time.time() - starttime < 10):
+            time.sleep(0.05)
+        self.assertEqual(sorted(done), [0, 1, 2, 3])
+        prefetcher.noteUsed(2)
+        prefetcher.noteUsed(2)
+        stats = prefetcher.stats()
+        self.assertEqual((stats['queued'], stats['limited'], stats['used']),
+                         (4, 2, 1))
+        # Work that is already done is not queued again
+        prefetcher.schedule('other', [(1, lambda: None)])
+        self.assertEqual(prefetcher.stats()['queued'], 4)
+
+    def testHistogram(self):
+        import tempfile
+
+        import numpy
+        import tifffile
+
+        image = numpy.zeros((512, 512), dtype=numpy.uint16)
+        image[:256] = 1000
+        image[256:, :128] = 3000
+        path = os.path.join(tempfile.mkdtemp(), 'grey16.tiff')
+        with tifffile.TiffWriter(path) as tif:
+            tif.write(image, tile=(256, 256), compression='zlib')
+            tif.write(image[::2, ::2], tile=(256, 256), compression='zlib',
+                      subfiletype=1)
+        file = self._uploadFile(path)
+        itemId = str(file['itemId'])
+        self._postTileViaHttp(itemId, str(file['_id']))
+        resp = self.request(
+            path='/item/%s/tiles/extended/histogram' % itemId,
+            user=self.admin, params={'percentiles': '[0, 40, 60, 100]',
+                                     'bins': 3})
+        self.assertStatusOk(resp)
+        self.assertEqual(resp.json['level'], 1)
+        band = resp.json['bands'][0]
+        self.assertEqual(band['samples'], 512 * 512)
+        self.assertEqual((band['min'], band['max']), (0, 3000))
+        self.assertEqual(band['percentiles'],
+                         {'0': 0, '40': 1000, '60': 1000, '100': 3000})
+        self.assertEqual(band['histogram'], [229376, 0, 32768])
+        # The counts are stored with the item
+        from girder.models.item import Item
+        item = Item().load(itemId, force=True)
+        self.assertEqual(list(item['largeImageHistogram']['levels']), ['1'])
+        resp = self.request(
+            path='/item/%s/tiles/extended/histogram' % itemId,
+            user=self.admin, params={'level': 0, 'bins': 0})
+        self.assertStatusOk(resp)
+        self.assertNotIn('histogram', resp.json['bands'][0])
+        self.assertEqual(resp.json['bands'][0]['samples'], 256 * 256)
+        resp = self.request(
+            path='/item/%s/tiles/extended/histogram' % itemId,
+            user=self.admin, params={'percentiles': '[101]'})
+        self.assertStatus(resp, 400)
+        # Tiles known to be empty are counted as zero without being read,
+        # even when the first tile is empty
+        from girder.plugins.larger_image.tilesource.histogram import \
+            countRows
+        occupancy = numpy.ones((2, 2), dtype=bool)
+        occupancy[0, 0] = False
+        counts = countRows(path, 0, 0, 2, occupancy)
+        self.assertEqual(counts.shape, (1, 65536))
+        self.assertEqual(counts[0, 0], 256 * 256 * 2 + 256 * 128)
+        self.assertEqual(counts[0, 1000], 256 * 256)
+        self.assertEqual(counts[0, 3000], 256 * 128)
+
     def _postTileViaHttp(self, itemId, fileId, jobAction=None):
         """
         When we know we need to process a job, we have to use an actual http